@@ -0,0 +1,10 @@
+# Benchmarks for the scripts in bin/.
+# synth.py writes synthetic WorldView/Landsat 8 scenes, run.py times the scripts on them (throughput and
+# peak RSS of each run) and keeps a JSON history per git commit. The bench_*.py scripts are single
+# micro-benchmarks that run.py also includes as cases.
+
+import os
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BIN_DIR = os.path.join(REPO_DIR, 'bin')
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Write MB/s, read MB/s and compression ratio of each output codec (bin/out_profile.py) on sample rasters,
+# e.g. TOA reflectance or index outputs. Each input is read into memory once and rewritten with every
+# codec in the same tiling, so only the encoder is timed.
+
+# USAGE:
+# bench_codecs.py -in scene1_refl.tif scene2_refl.tif -codecs lzw lzw:3 zstd:1 zstd:9 deflate:6 lerc_zstd -threads 4
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import rasterio as rio
+from rasterio.windows import Window
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+import out_profile
+
+DEFAULT_CODECS = ['lzw', 'lzw:3', 'deflate:6', 'zstd:1', 'zstd:9', 'lerc_zstd', 'none']
+
+def parse_codec(spec):
+    """'zstd:9' -> update_profile keyword arguments; 'lzw:3' is LZW with predictor 3"""
+    codec, _, level = spec.partition(':')
+    if not level:
+        return dict(codec=codec)
+    if codec == 'lzw':
+        return dict(codec=codec, predictor=int(level))
+    return dict(codec=codec, level=int(level))
+
+def read_sample(fn, size=None):
+    """Whole raster, or its central size x size window, and the profile to write it with"""
+    with rio.open(fn) as src:
+        window = None
+        if size is not None:
+            w, h = min(size, src.width), min(size, src.height)
+            window = Window((src.width - w) // 2, (src.height - h) // 2, w, h)
+        arr = src.read(window=window)
+        profile = src.profile
+        profile.update(driver='GTiff', width=arr.shape[2], height=arr.shape[1], tiled=True,
+                       blockxsize=512, blockysize=512, interleave='band', BIGTIFF='IF_SAFER')
+        if window is not None:
+            profile['transform'] = src.window_transform(window)
+    return arr, profile
+
+def time_codec(arr, profile, out_fn, repeat):
+    """Best write seconds, best read seconds, file size"""
+    t_write, t_read = [], []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        with rio.open(out_fn, 'w', **profile) as dst:
+            dst.write(arr)
+        t_write.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        with rio.open(out_fn) as src:
+            src.read()
+        t_read.append(time.perf_counter() - t0)
+    return min(t_write), min(t_read), os.path.getsize(out_fn)
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Output codec write speed and compression ratio')
+    parser.add_argument('-in', '--input_files', help='Sample rasters', nargs='+', required=True)
+    parser.add_argument('-codecs', '--codecs', help='codec[:level] to test, lzw:N sets the predictor, default is %s' % ' '.join(DEFAULT_CODECS),
+                        nargs='+', default=DEFAULT_CODECS)
+    parser.add_argument('-size', '--size', help='Only use the central size x size window of each input', type=int)
+    parser.add_argument('-block', '--block', help='Tile size, default is 512', type=int, default=512)
+    parser.add_argument('-threads', '--threads', help='GDAL compression threads, number or ALL_CPUS')
+    parser.add_argument('-zerr', '--max_z_error', help='LERC maximum error, default is 0 (lossless)', type=float)
+    parser.add_argument('-r', '--repeat', help='Runs per codec, best is reported', type=int, default=3)
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    print('%-24s %-14s %10s %10s %8s' % ('input', 'codec', 'write MB/s', 'read MB/s', 'ratio'))
+    with tempfile.TemporaryDirectory() as tmp:
+        out_fn = os.path.join(tmp, 'codec.tif')
+        for fn in args.input_files:
+            arr, profile = read_sample(fn, args.size)
+            mb = arr.nbytes / 1e6
+            for spec in args.codecs:
+                prf = out_profile.update_profile(profile.copy(), block=args.block, threads=args.threads,
+                                                 max_z_error=args.max_z_error, **parse_codec(spec))
+                t_write, t_read, size = time_codec(arr, prf, out_fn, args.repeat)
+                print('%-24s %-14s %10.1f %10.1f %8.2f' % (os.path.basename(fn)[-24:], spec, mb / t_write, mb / t_read, arr.nbytes / size))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# Benchmark wv_TOA_refl_con throughput against worker count for the thread and process backends
+
+# USAGE:
+# bench_toa_con.py -in band.tif -in_band G -in_x scene.xml -n 1 2 4 8
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import rasterio as rio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+import wv_TOA_refl_con
+
+def time_run(in_fn, coeffs, out_fn, workers, backend, batch):
+    t0 = time.perf_counter()
+    wv_TOA_refl_con.main(in_fn, *coeffs, out_fn, max_workers=workers, backend=backend, batch=batch)
+    return time.perf_counter() - t0
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='wv_TOA_refl_con throughput vs. worker count')
+    parser.add_argument('-in', '--input_file', help='Single band L1B GeoTiff', required=True)
+    parser.add_argument('-in_band', '--input_band', help='Band code, e.g. G', required=True)
+    parser.add_argument('-in_x', '--input_xml', help='DigitalGlobe xml file', required=True)
+    parser.add_argument('-n', '--workers', help='Worker counts to test', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()])
+    parser.add_argument('-backend', '--backend', help='Backends to test', nargs='+', choices=['thread', 'process'], default=['thread', 'process'])
+    parser.add_argument('-batch', '--batch', help='Windows per process worker task', type=int, default=wv_TOA_refl_con.BATCH)
+    parser.add_argument('-r', '--repeat', help='Runs per setting, best is reported', type=int, default=3)
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    coeffs = wv_TOA_refl_con.toa_coeffs(args.input_xml, args.input_band)
+
+    with rio.open(args.input_file) as src:
+        mpx = src.width * src.height / 1e6
+        mb = mpx * np.dtype(src.dtypes[0]).itemsize
+
+    print('%-8s %8s %10s %10s %10s' % ('backend', 'workers', 'seconds', 'Mpx/s', 'MB/s in'))
+    with tempfile.TemporaryDirectory() as tmp:
+        out_fn = os.path.join(tmp, 'toa.tif')
+        for backend in args.backend:
+            for n in args.workers:
+                best = min(time_run(args.input_file, coeffs, out_fn, n, backend, args.batch)
+                           for i in range(args.repeat))
+                print('%-8s %8d %10.3f %10.1f %10.1f' % (backend, n, best, mpx / best, mb / best))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Compare the float64 TOA expression (wv_TOA_refl.calc_toa) with the folded float32 kernel
+# (wv_TOA_refl.calc_toa_f32): peak temporary memory, throughput and numeric difference.
+# Exits non-zero if the largest difference exceeds -tol, so it can be used as a check.
+
+# USAGE:
+# bench_toa_kernel.py -size 512 -count 8 -n 200
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+from wv_TOA_refl import calc_toa, calc_toa_f32, fold_coeffs
+
+# WV03 green band factors with a typical abscal/effbw and sun geometry
+COEFFS = (0.938, 0.01 / 0.0585, -4.996, 1.0152, 1830.18, 34.7)
+NDV = 0
+
+def f64_path(data, coeffs, ndv):
+    TOA_arr = calc_toa(data, *coeffs)
+    TOA_arr[data==ndv] = ndv
+    return TOA_arr.astype(np.float32)
+
+def f32_path(data, folded, ndv, buf):
+    return calc_toa_f32(data, *folded, ndv=ndv, out=buf)
+
+def measure(fn, blocks, *args):
+    """Seconds for one pass over blocks, and peak bytes allocated by a single call"""
+    tracemalloc.start()
+    fn(blocks[0], *args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    t0 = time.perf_counter()
+    for data in blocks:
+        fn(data, *args)
+    return time.perf_counter() - t0, peak
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='float64 vs folded float32 TOA kernel comparison')
+    parser.add_argument('-size', '--block_size', help='Block edge length, default is 512', type=int, default=512)
+    parser.add_argument('-count', '--band_count', help='Bands per block, default is 1', type=int, default=1)
+    parser.add_argument('-n', '--blocks', help='Number of distinct blocks to convert, default is 64', type=int, default=64)
+    parser.add_argument('-tol', '--tolerance', help='Maximum allowed absolute reflectance difference, default is 1e-5', type=float, default=1e-5)
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    rng = np.random.default_rng(0)
+    shape = (args.band_count, args.block_size, args.block_size)
+    blocks = [rng.integers(0, 2048, shape).astype(np.uint16) for i in range(args.blocks)]
+    folded = fold_coeffs(*COEFFS)
+    buf = np.empty(np.prod(shape), dtype=np.float32)
+
+    t64, m64 = measure(f64_path, blocks, COEFFS, NDV)
+    t32, m32 = measure(f32_path, blocks, folded, NDV, buf)
+    diff = max(np.abs(f64_path(d, COEFFS, NDV) - f32_path(d, folded, NDV, buf)).max() for d in blocks)
+
+    mpx = args.blocks * np.prod(shape) / 1e6
+    print('%-8s %12s %12s' % ('kernel', 'Mpx/s', 'peak MB'))
+    print('%-8s %12.1f %12.2f' % ('float64', mpx / t64, m64 / 1e6))
+    print('%-8s %12.1f %12.2f' % ('float32', mpx / t32, m32 / 1e6))
+    print('max abs difference: %.3g (tolerance %.3g)' % (diff, args.tolerance))
+    if diff > args.tolerance:
+        sys.exit("float32 kernel differs from float64 expression by more than the tolerance")
+
+if __name__ == "__main__":
+    main()
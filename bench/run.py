@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+# Time the bin/ scripts on synthetic scenes (bench/synth.py). Every case runs as its own child process,
+# so the reported peak RSS (from wait4, includes reaped worker processes) is that of the script alone.
+# Results are appended to a JSON history keyed by git commit, and -compare prints the change
+# against an earlier commit in the history.
+
+# USAGE:
+# python -m bench.run -data_dir /tmp/scenes -size medium -cases wv_toa wv_toa_con ndvi -n 1 2 4
+# python -m bench.run -data_dir /tmp/scenes -size medium -compare HEAD~3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import rasterio as rio
+
+from bench import BENCH_DIR, BIN_DIR, REPO_DIR, synth
+
+PY = sys.executable
+
+def script(name):
+    return os.path.join(BIN_DIR, name)
+
+def refl_files(scenes):
+    """Per-band _refl.tif files of the MS and SWIR scenes, as read by the index scripts (setup, not timed)"""
+    for kind in ('ms', 'swir'):
+        fn = scenes[kind]
+        if not os.path.exists(fn[:-4] + '_b8_12_refl.tif'):
+            subprocess.check_call([PY, script('wv_TOA_refl.py'), '-in', fn, '-in_x', scenes[kind + '_xml'],
+                                   '-in_band', 'all', '-split'])
+
+# Case name: function(scenes, out_dir, args) -> list of (label, argv, cwd, input raster for throughput)
+def case_wv_toa(scenes, out, args):
+    base = [PY, script('wv_TOA_refl.py'), '-in', scenes['band'], '-in_x', scenes['band_xml'], '-in_band', 'G',
+            '-out', os.path.join(out, 'toa.tif')]
+    return [('wv_toa', base, None, scenes['band']),
+            ('wv_toa/stream', base + ['-stream'], None, scenes['band']),
+            ('wv_toa/f32', base + ['-f32'], None, scenes['band'])]
+
+def case_wv_toa_all(scenes, out, args):
+    return [('wv_toa_all', [PY, script('wv_TOA_refl.py'), '-in', scenes['ms'], '-in_x', scenes['ms_xml'],
+                            '-in_band', 'all', '-out', os.path.join(out, 'toa_all.tif')], None, scenes['ms'])]
+
+def case_wv_toa_con(scenes, out, args):
+    runs = []
+    for backend in ('thread', 'process'):
+        for n in args.workers:
+            runs.append(('wv_toa_con/%s/%d' % (backend, n),
+                         [PY, script('wv_TOA_refl_con.py'), '-in', scenes['band'], '-in_x', scenes['band_xml'],
+                          '-in_band', 'G', '-out', os.path.join(out, 'toa_con.tif'), '-n', str(n), '-backend', backend],
+                         None, scenes['band']))
+    return runs
+
+def case_l8_toa(scenes, out, args):
+    return [('l8_toa', [PY, script('L8_TOA_refl.py'), '-in', scenes['l8'], '-in_MTL', scenes['l8_mtl'],
+                        '-out', os.path.join(out, 'l8_toa.tif')], None, scenes['l8'])]
+
+def case_ndvi(scenes, out, args):
+    refl_files(scenes)
+    return [('ndvi', [PY, script('ndvi.py'), '-in', scenes['ms'], '-out', os.path.join(out, 'ndvi.tif')],
+             os.path.dirname(scenes['ms']), scenes['ms'][:-4] + '_b5_12_refl.tif')]
+
+def case_ndwi(scenes, out, args):
+    refl_files(scenes)
+    return [('ndwi', [PY, script('ndwi.py'), '-in', scenes['ms'], '-out', os.path.join(out, 'ndwi.tif')],
+             os.path.dirname(scenes['ms']), scenes['ms'][:-4] + '_b3_12_refl.tif')]
+
+def case_ndsi(scenes, out, args):
+    refl_files(scenes)
+    return [('ndsi', [PY, script('ndsi.py'), '-in', scenes['ms'], '-in2', scenes['swir'], '-out', os.path.join(out, 'ndsi.tif')],
+             os.path.dirname(scenes['ms']), scenes['ms'][:-4] + '_b3_12_refl.tif')]
+
+def case_indices(scenes, out, args):
+    refl_files(scenes)
+    dn = [PY, script('indices.py'), '-dn', '-in', scenes['ms'], '-in_x', scenes['ms_xml'],
+          '-in2', scenes['swir'], '-in2_x', scenes['swir_xml'], '-out_dir', out]
+    return [('indices', [PY, script('indices.py'), '-in', scenes['ms'], '-in2', scenes['swir'], '-out_dir', out],
+             None, scenes['ms'][:-4] + '_b3_12_refl.tif'),
+            ('indices/dn', dn, None, scenes['ms'])]
+
+UTM_SNIPPET = """
+import sys
+sys.path.insert(0, %r)
+from utm_convert import get_utm_epsg_code
+# points strictly inside zones (lat -79.5..83.5, lon -179.5..179.5): zone edges raise InputError
+for i in range(%d):
+    get_utm_epsg_code(-79.5 + (i * 7.31) %% 163, -179.5 + (i * 13.7) %% 359)
+"""
+
+def case_utm_epsg(scenes, out, args):
+    return [('utm_epsg/%d' % args.points, [PY, '-c', UTM_SNIPPET % (BIN_DIR, args.points)], None, None)]
+
+def case_toa_kernel(scenes, out, args):
+    return [('toa_kernel', [PY, os.path.join(BENCH_DIR, 'bench_toa_kernel.py'), '-count', '8', '-n', '16'], None, None)]
+
+def case_codecs(scenes, out, args):
+    refl_files(scenes)
+    return [('codecs', [PY, os.path.join(BENCH_DIR, 'bench_codecs.py'), '-in', scenes['ms'][:-4] + '_b3_12_refl.tif',
+                        '-r', '1'], None, None)]
+
+CASES = {
+'wv_toa': case_wv_toa,
+'wv_toa_all': case_wv_toa_all,
+'wv_toa_con': case_wv_toa_con,
+'l8_toa': case_l8_toa,
+'ndvi': case_ndvi,
+'ndwi': case_ndwi,
+'ndsi': case_ndsi,
+'indices': case_indices,
+'utm_epsg': case_utm_epsg,
+'toa_kernel': case_toa_kernel,
+'codecs': case_codecs,
+}
+
+def run_child(argv, cwd, log):
+    """(seconds, peak RSS MB, exit code) of one child process"""
+    t0 = time.perf_counter()
+    p = subprocess.Popen(argv, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+    pid, status, usage = os.wait4(p.pid, 0)
+    seconds = time.perf_counter() - t0
+    p.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kB on Linux
+    return seconds, usage.ru_maxrss / 1024., p.returncode
+
+def input_size(fn):
+    """(Mpx over all bands, MB) of a raster, None if there is no input raster"""
+    if fn is None:
+        return None
+    with rio.open(fn) as f:
+        px = f.width * f.height * f.count
+        return px / 1e6, px * np.dtype(f.dtypes[0]).itemsize / 1e6
+
+def git_commit():
+    """Short HEAD hash, with -dirty if tracked files are modified"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + '-dirty' if dirty else commit
+
+def resolve_commit(ref):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', ref], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ref
+
+def load_history(fn):
+    if os.path.exists(fn):
+        with open(fn) as f:
+            return json.load(f)
+    return dict()
+
+def save_history(fn, history):
+    tmp = fn + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+    os.replace(tmp, fn)
+
+def print_results(results, ref=None):
+    print('%-24s %9s %9s %9s %10s %9s' % ('case', 'seconds', 'Mpx/s', 'MB/s', 'peak MB', 'vs ref'))
+    for label, r in results.items():
+        if r['returncode'] != 0:
+            print('%-24s failed with exit code %d, see %s' % (label, r['returncode'], r['log']))
+            continue
+        speedup = ''
+        if ref is not None and ref.get(label, {}).get('returncode') == 0:
+            speedup = '%8.2fx' % (ref[label]['seconds'] / r['seconds'])
+        print('%-24s %9.3f %9s %9s %10.1f %9s' % (label, r['seconds'],
+              '%.1f' % r['mpx_s'] if r.get('mpx_s') else '-', '%.1f' % r['mb_s'] if r.get('mb_s') else '-',
+              r['peak_rss_mb'], speedup))
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the bin/ scripts on synthetic scenes')
+    parser.add_argument('-data_dir', '--data_dir', help='Where synthetic scenes are generated and reused', required=True)
+    parser.add_argument('-size', '--size', help='Scene size preset, default is small', choices=list(synth.SIZES), default='small')
+    parser.add_argument('-block', '--block', help='Tile size of the input scenes, default is striped', type=int)
+    parser.add_argument('-cases', '--cases', help='Cases to run, default is all', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('-n', '--workers', help='Worker counts for wv_toa_con', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('-points', '--points', help='Points looked up by utm_epsg, default is 20', type=int, default=20)
+    parser.add_argument('-r', '--repeat', help='Runs per case, best time is reported', type=int, default=1)
+    parser.add_argument('-history', '--history', help='JSON history file, default is bench_history.json', default='bench_history.json')
+    parser.add_argument('-compare', '--compare', help='Commit in the history to compare against')
+    parser.add_argument('-no_save', '--no_save', help='Do not add this run to the history', action='store_true')
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    scenes = synth.make_scenes(args.data_dir, args.size, args.block)
+    tag = args.size if args.block is None else '%s_%d' % (args.size, args.block)
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as out:
+        for name in args.cases:
+            for label, argv, cwd, in_fn in CASES[name](scenes, out, args):
+                log_fn = os.path.join(args.data_dir, tag, label.replace('/', '_') + '.log')
+                best = None
+                for i in range(args.repeat):
+                    with open(log_fn, 'w') as log:
+                        seconds, rss, code = run_child(argv, cwd, log)
+                    if (best is None) or (code != 0) or (seconds < best[0]):
+                        best = (seconds, rss, code)
+                    if code != 0:
+                        break
+                seconds, rss, code = best
+                r = dict(seconds=seconds, peak_rss_mb=rss, returncode=code, log=log_fn)
+                size = input_size(in_fn)
+                if size is not None:
+                    r.update(mpx_s=size[0] / seconds, mb_s=size[1] / seconds)
+                results[label] = r
+
+    history = load_history(args.history)
+    ref = None
+    if args.compare is not None:
+        ref = history.get(resolve_commit(args.compare), {}).get(tag, {}).get('results')
+        if ref is None:
+            print("No %s results for %s in %s" % (tag, args.compare, args.history))
+    print_results(results, ref)
+
+    if not args.no_save:
+        commit = git_commit()
+        entry = history.setdefault(commit, dict()).setdefault(tag, dict(results=dict()))
+        entry['date'] = datetime.now().isoformat(timespec='seconds')
+        entry['python'] = sys.version.split()[0]
+        entry['cpus'] = os.cpu_count()
+        entry['results'].update(results)
+        save_history(args.history, history)
+        print("Saved to %s under %s/%s" % (args.history, commit, tag))
+
+if __name__ == "__main__":
+    main()
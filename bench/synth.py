@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+# Synthetic scenes for benchmarks: uint16 L1B-like GeoTIFFs with matching DigitalGlobe XML, and
+# Landsat 8 multiband GeoTIFFs with an MTL file. Pixel values are smooth fields plus noise with a
+# nodata corner, so compression and nodata handling behave roughly like real imagery.
+# Scenes are written in row strips, so full-size scenes need little memory.
+
+# USAGE:
+# python -m bench.synth -out_dir /tmp/scenes -size medium -block 256
+
+import argparse
+import os
+
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+
+# Scene (height, width) per size preset, WorldView at 1.2 m (MS, SWIR resampled to MS) and Landsat 8 at 30 m
+SIZES = {
+'small': {'wv': (1024, 1024), 'l8': (1024, 1024)},
+'medium': {'wv': (4096, 4096), 'l8': (4096, 4096)},
+'full': {'wv': (9216, 9216), 'l8': (7801, 7681)},
+}
+
+WV_BANDS = {
+'ms': ['C', 'B', 'G', 'Y', 'R', 'RE', 'N', 'N2'],
+'swir': ['S1', 'S2', 'S3', 'S4', 'S5', 'S6', 'S7', 'S8'],
+}
+
+# Landsat 8 OLI bands 1-7, reflectance scaling as delivered in Collection 1 MTL files
+L8_BANDS = 7
+
+STRIP = 512
+
+def dn_strip(row_off, height, width, count, seed, ndv=0):
+    """uint16 DN rows [row_off, row_off + height) of a count band scene"""
+    rng = np.random.default_rng(seed + row_off)
+    y = np.arange(row_off, row_off + height, dtype=np.float32)[:, None]
+    x = np.arange(width, dtype=np.float32)[None, :]
+    out = np.empty((count, height, width), dtype=np.uint16)
+    for b in range(count):
+        field = 600 + 300 * np.sin(x / (97. + 11 * b)) * np.cos(y / (131. + 7 * b)) + 150 * np.sin((x + y) / 1000.)
+        field += rng.normal(0, 25, field.shape)
+        out[b] = np.clip(field, 1, 2047)
+    # nodata triangle in the upper left, like an off-nadir strip edge
+    out[:, x + y < width // 8] = ndv
+    return out
+
+def write_tif(fn, height, width, count, seed=0, block=None, res=1.2, epsg=32610, dtype='uint16'):
+    """Write a synthetic DN GeoTIFF, striped (block None) or tiled with block x block tiles"""
+    profile = dict(driver='GTiff', dtype=dtype, count=count, height=height, width=width, nodata=0,
+                   crs='EPSG:%d' % epsg, transform=from_origin(600000, 5400000, res, res))
+    if block is not None:
+        profile.update(tiled=True, blockxsize=block, blockysize=block)
+    with rio.open(fn, 'w', **profile) as dst:
+        for row_off in range(0, height, STRIP):
+            h = min(STRIP, height - row_off)
+            dst.write(dn_strip(row_off, h, width, count, seed), window=((row_off, row_off + h), (0, width)))
+    return fn
+
+def write_dg_xml(fn, bands, satid='WV03', bandid='Multi'):
+    """DigitalGlobe style XML with the tags read by dg_xml.DGMetadata"""
+    corners = ('<ULLON>-121.5</ULLON><ULLAT>48.6</ULLAT><URLON>-121.2</URLON><URLAT>48.6</URLAT>'
+               '<LRLON>-121.2</LRLON><LRLAT>48.3</LRLAT><LLLON>-121.5</LLLON><LLLAT>48.3</LLLAT>')
+    parts = ['<isd><IMD><VERSION>AA</VERSION><BANDID>%s</BANDID>' % bandid]
+    for i, band in enumerate(bands):
+        parts.append('<BAND_%s>%s<ABSCALFACTOR>%g</ABSCALFACTOR><EFFECTIVEBANDWIDTH>%g</EFFECTIVEBANDWIDTH></BAND_%s>'
+                     % (band, corners, 0.01 + 0.001 * i, 0.05 + 0.01 * i, band))
+    parts.append('<IMAGE><SATID>%s</SATID><FIRSTLINETIME>2017-06-12T19:05:03.123456Z</FIRSTLINETIME>'
+                 '<MEANSUNEL>55.3</MEANSUNEL></IMAGE></IMD></isd>' % satid)
+    with open(fn, 'w') as f:
+        f.write(''.join(parts))
+    return fn
+
+def write_mtl(fn, image_fn, count=L8_BANDS):
+    """Landsat 8 MTL text file with the reflectance rescaling and sun angle groups"""
+    lines = ['GROUP = L1_METADATA_FILE',
+             '  GROUP = PRODUCT_METADATA',
+             '    SPACECRAFT_ID = "LANDSAT_8"',
+             '    SENSOR_ID = "OLI_TIRS"',
+             '    DATE_ACQUIRED = 2017-06-12',
+             '    SCENE_CENTER_TIME = "18:55:43.1234560Z"',
+             '    CORNER_UL_LAT_PRODUCT = 48.6',
+             '    CORNER_UL_LON_PRODUCT = -121.5',
+             '    CORNER_LR_LAT_PRODUCT = 48.3',
+             '    CORNER_LR_LON_PRODUCT = -121.2',
+             '    FILE_NAME_BAND_1 = "%s"' % os.path.basename(image_fn),
+             '  END_GROUP = PRODUCT_METADATA',
+             '  GROUP = IMAGE_ATTRIBUTES',
+             '    CLOUD_COVER = 4.21',
+             '    SUN_AZIMUTH = 142.10',
+             '    SUN_ELEVATION = 58.72',
+             '    EARTH_SUN_DISTANCE = 1.0155',
+             '  END_GROUP = IMAGE_ATTRIBUTES',
+             '  GROUP = RADIOMETRIC_RESCALING']
+    for b in range(1, count + 1):
+        lines.append('    REFLECTANCE_MULT_BAND_%d = 2.0000E-05' % b)
+    for b in range(1, count + 1):
+        lines.append('    REFLECTANCE_ADD_BAND_%d = -0.100000' % b)
+    lines += ['  END_GROUP = RADIOMETRIC_RESCALING',
+              'END_GROUP = L1_METADATA_FILE',
+              'END']
+    with open(fn, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return fn
+
+def make_scenes(out_dir, size='small', block=None):
+    """Write (or reuse) the benchmark scenes of a size preset. Returns a dict of filenames:
+    ms/ms_xml, swir/swir_xml (8 band WV03), band/band_xml (single-band green), l8/l8_mtl
+    """
+    wv_h, wv_w = SIZES[size]['wv']
+    l8_h, l8_w = SIZES[size]['l8']
+    tag = size if block is None else '%s_%d' % (size, block)
+    out_dir = os.path.join(out_dir, tag)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    scenes = dict()
+    for kind, seed in (('ms', 1), ('swir', 2)):
+        fn = os.path.join(out_dir, kind + '.tif')
+        if not os.path.exists(fn):
+            write_tif(fn, wv_h, wv_w, len(WV_BANDS[kind]), seed, block)
+        scenes[kind] = fn
+        scenes[kind + '_xml'] = write_dg_xml(fn[:-4] + '.xml', WV_BANDS[kind], bandid='Multi' if kind == 'ms' else 'SWIR')
+
+    fn = os.path.join(out_dir, 'band.tif')
+    if not os.path.exists(fn):
+        write_tif(fn, wv_h, wv_w, 1, 3, block)
+    scenes['band'] = fn
+    scenes['band_xml'] = scenes['ms_xml']
+
+    fn = os.path.join(out_dir, 'l8.tif')
+    if not os.path.exists(fn):
+        write_tif(fn, l8_h, l8_w, L8_BANDS, 4, block, res=30.)
+    scenes['l8'] = fn
+    scenes['l8_mtl'] = write_mtl(fn[:-4] + '_MTL.txt', fn)
+    return scenes
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Synthetic WorldView/Landsat 8 benchmark scenes')
+    parser.add_argument('-out_dir', '--output_dir', help='Where scenes are written (in a <size>[_<block>] subdirectory)', required=True)
+    parser.add_argument('-size', '--size', help='Scene size preset, default is small', choices=list(SIZES), default='small')
+    parser.add_argument('-block', '--block', help='Tile size of the inputs, default is striped', type=int)
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    for name, fn in sorted(make_scenes(args.output_dir, args.size, args.block).items()):
+        print('%-10s %s' % (name, fn))
+
+if __name__ == "__main__":
+    main()
@@ -1,114 +1,95 @@
 #!/usr/bin/env python
 
 # This script calculates TOA reflectance for Landsat 8 Level 1 imagery
+# equations from https://landsat.usgs.gov/using-usgs-landsat-8-product:
+#   TOA reflectance = (Mp * DN + Ap) / cos(solar zenith)
+# with the REFLECTANCE_MULT_BAND_n (Mp) and REFLECTANCE_ADD_BAND_n (Ap) of each band from the MTL file (mtl.py).
 
-# import libraries
-# requires gdal and geoio from https://github.com/DigitalGlobe/geoio
-# uses functions created by dshean's dgtools github repo
+# The image is read block by block with rasterio, so memory stays bounded for full scenes and stacked
+# bulk orders. Per-band coefficients are folded with the sun angle into one float32 scale and bias per
+# band and applied by broadcasting (wv_TOA_refl.calc_toa_f32). Pixels equal to the input nodata (fill)
+# keep that value, or become the int16 nodata with -int16.
 
-import math
-import geoio
-from gdalconst import *
-import argparse
-import re
-
-# Have user define input data from MTL file and output filename
-parser = argparse.ArgumentParser(description='GeoTiff Landsat 8 Multispectral Image to TOA Reflectance Script')
-
-parser.add_argument('-in', '--input_file', help='GeoTiff multi band MS image file', required=True)
-# parser.add_argument('-in_band', '--input_band', help='GeoTiff multi band', required=True)
-# parser.add_argument('-M', '--input_Mp', help='GeoTiff multi band Reflectance Multiplication input', required=True)
-# parser.add_argument('-A', '--input_Ap', help='GeoTiff multi band Reflectance Addition input', required=True)
-# parser.add_argument('-sun', '--input_SunEl', help='GeoTiff multi band Sun Elevation input', required=True)
-
-parser.add_argument('-in_MTL', '--input_MTL_textfile', help='Delivered with L8 imagery', required=True)
-
-parser.add_argument('-out', '--output_file', help='Where TOA reflectance image is to be saved', required=True)
-args = parser.parse_args()
-
-in_filename = args.input_file
-# Mp = float(args.input_Mp)
-# Ap = float(args.input_Ap)
-# sunelev = float(args.input_SunEl)
-in_MTL_filename = args.input_MTL_textfile
-out_filename = args.output_file
-
-######## --------- Define functions --------- ########
-
-# Check that values for list are equivalent.  Sourced from https://stackoverflow.com/questions/3844801/check-if-all-elements-in-a-list-are-identical
-
-def check_equal(some_list):
-    # return boolean of equality for 2nd element to end and 1st element to penultimate
-   return some_list[1:] == some_list[:-1]
-
-def get_val(some_list):
-    # extract value after " = " in list of strings
-    vals = [val.split(' = ')[1] for val in some_list]
-    return(vals)
-
-
-### --- Extract Mp, Ap, and sunelev values from MTL file --- ###
-mtl_list = []
-
-with open(in_MTL_filename, 'r') as f:
-    for line in f:
-        # strip the trailing newline character
-        line=line.rstrip()
-        # and strip the leading whitespaces, newline, and tab characters
-        line=line.lstrip()
-        # append this to the list
-        mtl_list.append(line)
-
-# Use regular expressions to find matches for the Mp, Ap, and SunEl values
-Mp_pattern=re.compile(r"(REFLECTANCE_MULT).*")
-Ap_pattern=re.compile(r"(REFLECTANCE_ADD).*")
-Sun_pattern=re.compile(r"(SUN_).*")
+# USAGE:
+# python L8_TOA_refl.py -in LC08_stack.tif -in_MTL LC08_MTL.txt -out LC08_toa.tif
+# python L8_TOA_refl.py -in LC08_B2_B5.tif -in_MTL LC08_MTL.txt -bands 2 3 4 5 -out LC08_toa.tif -int16
 
-
-# iterate through each line in the list and return matches
-Mp_list = [m.group() for line in mtl_list for m in [Mp_pattern.search(line)] if m]
-Ap_list = [m.group() for line in mtl_list for m in [Ap_pattern.search(line)] if m]
-Sun_list = [m.group() for line in mtl_list for m in [Sun_pattern.search(line)] if m]
-
-# extract corresponding value (i.e. the bit after " = ")
-Mp_val = get_val(Mp_list)
-Ap_val = get_val(Ap_list)
-Sun_val = get_val(Sun_list)
-
-# Check that each band has the same value for Mp and Ap, and save extracted values as floats in the Mp, Ap, and sunel variables to be used in L8_toa_refl calculations.  Otherwise, flag it and tell the user to check the MTL file
-
-if check_equal(Mp_val):
-    Mp=float(Mp_val[0])
-else:
-    print("Mp values are not equal, examine MTL file")
-    print(Mp_list)
-
-if check_equal(Ap_val):
-    Ap=float(Ap_val[0])
-else:
-    print("Ap values are not equal, examine MTL file")
-    print(Ap_list)
-
-if (float(Sun_val[1]) <= 90.0 and float(Sun_val[1]) >=0.0):
-    sunelev = float(Sun_val[1])
-else:
-    print("Sun elevation value out of bounds, examine MTL file")
-    print(Sun_val)
-
-print(Mp, Ap, sunelev)
-
-######## --------- CONVERT TO TOA REFLECTANCE --------- ########
-
-# Open the multiband landsat image
-img=geoio.GeoImage(in_filename)
-
-# Numpy arrays of tif
-data=img.get_data()
-
-# Calculate TOA reflectances - equations from https://landsat.usgs.gov/using-usgs-landsat-8-product
-
-newdata = Mp * data + Ap
-solzenith = 90-sunelev
-TOA_refl = newdata/math.cos(solzenith/360*2*math.pi)
-
-img.write_img_like_this(out_filename, TOA_refl)
+import argparse
+import math
+import sys
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio as rio
+
+import out_profile
+from mtl import read_mtl
+from wv_TOA_refl import get_profile, open_out, encode, calc_toa_f32
+
+def toa_coeffs(mtl_fn, bands):
+    """float64 (Mp, Ap) arrays for the Landsat band numbers in bands, and the sun elevation in degrees"""
+    md = read_mtl(mtl_fn)
+    missing = [b for b in bands if (b not in md.reflectance_mult) or (b not in md.reflectance_add)]
+    if missing:
+        sys.exit("No REFLECTANCE_MULT/ADD values for band(s) %s in %s" % (', '.join(map(str, missing)), mtl_fn))
+    sunelev = md.sun_elevation
+    if (sunelev is None) or not (0.0 <= sunelev <= 90.0):
+        sys.exit("Sun elevation value %s out of bounds, examine MTL file %s" % (sunelev, mtl_fn))
+    return md.band_array('REFLECTANCE_MULT', bands), md.band_array('REFLECTANCE_ADD', bands), sunelev
+
+def fold_coeffs(Mp, Ap, sunelev, dtype=np.float32):
+    """Per-band (scale, bias) with TOA reflectance = scale * DN + bias, shaped to broadcast over
+    (bands, rows, cols) blocks"""
+    solzenith = 90 - sunelev
+    cos_z = math.cos(math.radians(solzenith))
+    scale = (np.asarray(Mp, dtype=np.float64) / cos_z).astype(dtype).reshape(-1, 1, 1)
+    bias = (np.asarray(Ap, dtype=np.float64) / cos_z).astype(dtype).reshape(-1, 1, 1)
+    return scale, bias
+
+def calc_toa(data, Mp, Ap, sunelev):
+    """TOA reflectance of a (bands, rows, cols) DN array in float64 (reference for the folded float32 path)"""
+    solzenith = 90 - sunelev
+    Mp = np.asarray(Mp).reshape(-1, 1, 1)
+    Ap = np.asarray(Ap).reshape(-1, 1, 1)
+    return (Mp * data + Ap) / math.cos(math.radians(solzenith))
+
+def run(in_fn, mtl_fn, out_fn, bands=None, int16=False, out_opts=None, cog=False):
+    """Write TOA reflectance of every band of in_fn to out_fn.
+    bands are the Landsat band numbers of the input bands, default 1..count (a stack of bands 1-n).
+    """
+    with rio.Env(), ExitStack() as stack:
+        f = stack.enter_context(rio.open(in_fn))
+        if bands is None:
+            bands = list(range(1, f.count + 1))
+        if len(bands) != f.count:
+            sys.exit("%d band numbers given for the %d bands of %s" % (len(bands), f.count, in_fn))
+        ndv = f.nodata
+        Mp, Ap, sunelev = toa_coeffs(mtl_fn, bands)
+        print("Bands %s, Mp %s, Ap %s, sun elevation %s" % (bands, Mp.tolist(), Ap.tolist(), sunelev))
+        scale, bias = fold_coeffs(Mp, Ap, sunelev)
+
+        profile = get_profile(f.profile, int16, out_opts)
+        profile.update(count=f.count)
+        dst = stack.enter_context(open_out(out_fn, profile, int16, cog))
+
+        buf = np.empty(f.count * profile['blockxsize'] * profile['blockysize'], dtype=np.float32)
+        for ij, window in dst.block_windows(1):
+            data = f.read(window=window)
+            TOA_arr = calc_toa_f32(data, scale, bias, ndv, buf)
+            dst.write(encode(TOA_arr, ndv, int16), window=window)
+
+def get_parser():
+    # Have user define input data from MTL file and output filename
+    parser = argparse.ArgumentParser(description='GeoTiff Landsat 8 Multispectral Image to TOA Reflectance Script')
+    parser.add_argument('-in', '--input_file', help='GeoTiff multi band MS image file', required=True)
+    parser.add_argument('-in_MTL', '--input_MTL_textfile', help='Delivered with L8 imagery', required=True)
+    parser.add_argument('-out', '--output_file', help='Where TOA reflectance image is to be saved', required=True)
+    parser.add_argument('-bands', '--bands', help='Landsat band number of each input band, default is 1 2 3 ...', type=int, nargs='+')
+    parser.add_argument('-int16', '--int16', help='Write reflectance x 10000 as int16 (scale factor in the band metadata)', action='store_true')
+    out_profile.add_args(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    run(args.input_file, args.input_MTL_textfile, args.output_file, args.bands, args.int16,
+        out_profile.from_args(args), args.cog)
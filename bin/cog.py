@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+# Cloud-Optimized GeoTIFF output with overviews built while streaming.
+# CogWriter stands in for a rasterio dataset opened for writing: every block written to it goes to a
+# base GeoTIFF and is also reduced 2x2 (nodata-aware average, cascaded like gdaladdo) into one GeoTIFF
+# per overview level. On close, a VRT lists the base file with the level files as <Overview> elements
+# and the GDAL COG driver copies it with OVERVIEWS=FORCE_USE_EXISTING, so the output is never re-read
+# to compute overviews.
+
+# Blocks must start on a multiple of the largest overview factor: any block grid of the output
+# (block_windows) works, as levels stop at the block size.
+
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import rasterio as rio
+import rasterio.shutil
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+# numpy/rasterio dtype -> GDAL data type name used in VRT XML
+GDAL_DTYPES = {
+'uint8': 'Byte',
+'int8': 'Int8',
+'uint16': 'UInt16',
+'int16': 'Int16',
+'uint32': 'UInt32',
+'int32': 'Int32',
+'float32': 'Float32',
+'float64': 'Float64',
+}
+
+# Intermediate base and level files are lossless and fast to write: they are read once by the COG copy
+TEMP_OPTIONS = dict(compress='zstd', zstd_level=1, tiled=True, BIGTIFF='IF_SAFER')
+
+# out_profile predictor -> COG driver PREDICTOR
+COG_PREDICTORS = {1: 'NO', 2: 'STANDARD', 3: 'FLOATING_POINT'}
+
+def overview_factors(width, height, block=512):
+    """2, 4, 8, ... until the coarsest level fits in one block (GDAL COG default). Factors stop at the
+    largest power of 2 dividing block (block itself for 512, 16 for 48), so every block origin stays
+    aligned to every overview level."""
+    factors = []
+    f = 1
+    while (max(-(-width // f), -(-height // f)) > block) & (f < (block & -block)):
+        f *= 2
+        factors.append(f)
+    return factors
+
+def reduce2(arr, ndv=None):
+    """Average 2x2 pixel groups of the last two axes, ignoring ndv (and NaN) pixels.
+    Odd edges are padded as nodata; groups without valid pixels become ndv.
+    """
+    valid = np.ones(arr.shape, dtype=bool) if ndv is None else (arr != ndv)
+    if np.issubdtype(arr.dtype, np.floating):
+        valid &= ~np.isnan(arr)
+    h, w = arr.shape[-2:]
+    pad = [(0, 0)] * (arr.ndim - 2) + [(0, h % 2), (0, w % 2)]
+    data = np.pad(np.where(valid, arr, 0).astype(np.float64), pad)
+    valid = np.pad(valid, pad)
+    shape = arr.shape[:-2] + (data.shape[-2] // 2, 2, data.shape[-1] // 2, 2)
+    total = data.reshape(shape).sum(axis=(-3, -1))
+    count = valid.reshape(shape).sum(axis=(-3, -1))
+    out = total / np.maximum(count, 1)
+    if np.issubdtype(arr.dtype, np.integer):
+        out = np.rint(out)
+    out[count == 0] = np.nan if ndv is None else ndv
+    return out.astype(arr.dtype)
+
+def cog_options(profile):
+    """COG driver creation options matching the compression settings of a GTiff write profile"""
+    opts = dict(OVERVIEWS='FORCE_USE_EXISTING', BIGTIFF='IF_SAFER',
+                COMPRESS=str(profile.get('compress', 'lzw')).upper(),
+                BLOCKSIZE=profile.get('blockxsize', 512))
+    if profile.get('interleave') is not None:
+        opts['INTERLEAVE'] = str(profile['interleave']).upper()
+    if profile.get('predictor') is not None:
+        opts['PREDICTOR'] = COG_PREDICTORS[int(profile['predictor'])]
+    for key in ('zlevel', 'zstd_level'):
+        if profile.get(key) is not None:
+            opts['LEVEL'] = profile[key]
+    if profile.get('max_z_error') is not None:
+        opts['MAX_Z_ERROR'] = profile['max_z_error']
+    if profile.get('num_threads') is not None:
+        opts['NUM_THREADS'] = profile['num_threads']
+    return opts
+
+def write_overview_vrt(base_fn, level_fns, vrt_fn):
+    """VRT of base_fn whose bands list the level files as overviews"""
+    with rio.open(base_fn) as f:
+        vrt = ET.Element('VRTDataset', rasterXSize=str(f.width), rasterYSize=str(f.height))
+        if f.crs is not None:
+            ET.SubElement(vrt, 'SRS').text = f.crs.to_wkt()
+        ET.SubElement(vrt, 'GeoTransform').text = ', '.join(repr(v) for v in f.transform.to_gdal())
+        for n in range(1, f.count + 1):
+            band = ET.SubElement(vrt, 'VRTRasterBand', dataType=GDAL_DTYPES[f.dtypes[n-1]], band=str(n))
+            if f.nodata is not None:
+                ET.SubElement(band, 'NoDataValue').text = repr(f.nodata)
+            if (f.scales[n-1] != 1.0) | (f.offsets[n-1] != 0.0):
+                ET.SubElement(band, 'Offset').text = repr(f.offsets[n-1])
+                ET.SubElement(band, 'Scale').text = repr(f.scales[n-1])
+            src = ET.SubElement(band, 'SimpleSource')
+            ET.SubElement(src, 'SourceFilename', relativeToVRT='1').text = os.path.basename(base_fn)
+            ET.SubElement(src, 'SourceBand').text = str(n)
+            for level_fn in level_fns:
+                ovr = ET.SubElement(band, 'Overview')
+                ET.SubElement(ovr, 'SourceFilename', relativeToVRT='1').text = os.path.basename(level_fn)
+                ET.SubElement(ovr, 'SourceBand').text = str(n)
+    ET.ElementTree(vrt).write(vrt_fn)
+
+class CogWriter(object):
+    """Write-only dataset producing a COG at out_fn with internal overviews.
+
+    Supports the parts of the rasterio writer API the scripts use: write(arr, indexes, window),
+    block_windows, profile, count, scales/offsets, and use as a context manager.
+    """
+    def __init__(self, out_fn, profile):
+        self.out_fn = out_fn
+        self.cog_profile = dict(profile)
+        self.tmp = tempfile.mkdtemp(prefix='.cog_', dir=os.path.dirname(os.path.abspath(out_fn)))
+        block = profile.get('blockxsize', 512) if profile.get('tiled') else 512
+
+        base_prf = dict(profile)
+        for key in ('predictor', 'zlevel', 'zstd_level', 'max_z_error'):
+            base_prf.pop(key, None)
+        base_prf.update(TEMP_OPTIONS, driver='GTiff', blockxsize=block, blockysize=block)
+        self.base_fn = os.path.join(self.tmp, 'base.tif')
+        self.dst = rio.open(self.base_fn, 'w', **base_prf)
+
+        self.ndv = profile.get('nodata')
+        self.factors = overview_factors(profile['width'], profile['height'], block)
+        self.level_fns = []
+        self.levels = []
+        for f in self.factors:
+            level_prf = dict(base_prf, width=-(-profile['width'] // f), height=-(-profile['height'] // f),
+                             transform=profile['transform'] * Affine.scale(f))
+            level_fn = os.path.join(self.tmp, 'ovr_%d.tif' % f)
+            self.level_fns.append(level_fn)
+            self.levels.append(rio.open(level_fn, 'w', **level_prf))
+
+    def __getattr__(self, name):
+        # block_windows, profile, count, shape, ... of the base file
+        if name == 'dst':
+            raise AttributeError(name)
+        return getattr(self.dst, name)
+
+    @property
+    def scales(self):
+        return self.dst.scales
+
+    @scales.setter
+    def scales(self, value):
+        self.dst.scales = value
+
+    @property
+    def offsets(self):
+        return self.dst.offsets
+
+    @offsets.setter
+    def offsets(self, value):
+        self.dst.offsets = value
+
+    def write(self, arr, indexes=None, window=None):
+        """rasterio write, also reducing the block into every overview level"""
+        self.dst.write(arr, indexes, window=window)
+        if window is None:
+            window = Window(0, 0, self.dst.width, self.dst.height)
+        col, row = int(window.col_off), int(window.row_off)
+        for f, level in zip(self.factors, self.levels):
+            if (col % f) | (row % f):
+                raise ValueError("Window at (%d, %d) is not aligned to overview factor %d" % (col, row, f))
+            arr = reduce2(arr, self.ndv)
+            h, w = arr.shape[-2:]
+            level.write(arr, indexes, window=Window(col // f, row // f, w, h))
+
+    def close(self):
+        if self.dst.closed:
+            return
+        self.dst.close()
+        for level in self.levels:
+            level.close()
+        try:
+            vrt_fn = os.path.join(self.tmp, 'cog.vrt')
+            write_overview_vrt(self.base_fn, self.level_fns, vrt_fn)
+            rasterio.shutil.copy(vrt_fn, self.out_fn, driver='COG', **cog_options(self.cog_profile))
+        finally:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def abort(self):
+        """Close without writing out_fn, discarding the temporary files"""
+        try:
+            for ds in [self.dst] + self.levels:
+                if not ds.closed:
+                    ds.close()
+        finally:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # a failed write loop must not publish a partial COG
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+def open_raster(out_fn, profile, cog=False):
+    """rio.open(out_fn, 'w', **profile), or a CogWriter with the same profile"""
+    if cog:
+        return CogWriter(out_fn, profile)
+    return rio.open(out_fn, 'w', **profile)
@@ -7,7 +7,7 @@
 import rasterio
 import sys
 import concurrent.futures
-from itertools import islice
+from window_sched import run_windows
 
 # Have user define input bands and output filename
 # parser = argparse.ArgumentParser(description='GeoTiff WorldView Multispectral Image to TOA Reflection Image Conversion Script')
@@ -23,19 +23,6 @@ from itertools import islice
 # xml_fn = in_dir + "/" + in_fn.split("/")[-1][:-10]+".xml"
 # out_fn = in_dir + "/" + in_fn.split("/")[-1][:-4]+"toa_concurrent.tif"
 
-CHUNK = 100
-
-
-def chunkify(iterable, chunk=CHUNK):
-    it = iter(iterable)
-    while True:
-        piece = list(islice(it, chunk))
-        if piece:
-            yield piece
-        else:
-            return
-
-
 def compute(path, window):
     """Simulates an expensive computation
     Gets source data for a window, sleeps, reverses bands.
@@ -48,7 +35,10 @@ def compute(path, window):
     return data[::-1]
 
 
-def main(infile, outfile, max_workers=1):
+def main(infile, outfile, max_workers=1, max_in_flight=None, ordered=False):
+
+    if max_in_flight is None:
+        max_in_flight = 4 * max_workers
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
 
@@ -56,23 +46,15 @@ def main(infile, outfile, max_workers=1):
 
             with rasterio.open(outfile, "w", **src.profile) as dst:
 
-                windows = [window for ij, window in dst.block_windows()]
-                
-                for chunk in [windows]:  # chunkify(windows):
-                    print(chunk)
+                windows = (window for ij, window in dst.block_windows())
 
-                    future_to_window = dict()
+                def submit(window):
+                    return executor.submit(compute, infile, window)
 
-                    for window in chunk:
-                        print(window)
+                def write(window, result):
+                    dst.write(result, window=window)
 
-                        future = executor.submit(compute, infile, window)
-                        future_to_window[future] = window
-                        
-                    for future in concurrent.futures.as_completed(future_to_window):
-                        window = future_to_window[future]
-                        result = future.result()
-                        dst.write(result, window=window)
+                run_windows(submit, windows, write, max_in_flight, ordered)
 
 
 if __name__ == "__main__":
@@ -81,6 +63,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='GeoTiff WorldView Multispectral Image to TOA Reflection Image Conversion Script')
     parser.add_argument('input_file', help='GeoTiff multi band MS image file')
     parser.add_argument('-n', '--number', help='Number of workers', required=False)
+    parser.add_argument('-inflight', '--max_in_flight', help='Windows submitted but not yet written, default is 4 per worker', type=int, required=False)
+    parser.add_argument('-ordered', '--ordered', help='Write blocks in raster order', action='store_true')
     args = parser.parse_args()
     
     in_fn = args.input_file
@@ -96,4 +80,4 @@ if __name__ == "__main__":
     xml_fn = in_dir + "/" + in_fn.split("/")[-1][:-10]+".xml"
     out_fn = in_dir + "/" + in_fn.split("/")[-1][:-4]+"_toa_concurrent.tif"
     
-    main(in_fn, out_fn, max_workers=int(num))
+    main(in_fn, out_fn, max_workers=int(num), max_in_flight=args.max_in_flight, ordered=args.ordered)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+# Prepare DEM tiles for orthorectification: geoid adjustment (dem_geoid --reverse-adjustment, ASP)
+# and reprojection (gdalwarp) of each tile in a process pool, then a VRT of the results (gdalbuildvrt).
+# Reprojected tiles are kept in a content-addressed cache, keyed by the sha1 of the whole tile and the
+# processing parameters, so overlapping images reuse tiles across runs and directories. Tile digests are
+# remembered in the cache (digests.json, by path, size and mtime), so each tile is only hashed once.
+# The least recently used tiles are evicted when the cache grows past a size cap.
+
+# USAGE:
+# python dem_prep.py -in tile1.img tile2.img -epsg 32610 -out img_NED_13.vrt
+# python dem_prep.py -list ned_list.txt -epsg 32610 -out img_NED_13.vrt -cache_dir /data/dem_cache -cache_gb 100
+
+# requires dem_geoid (Ames Stereo Pipeline), gdalwarp and gdalbuildvrt on the PATH
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+DEFAULT_CACHE = os.environ.get('RS_DEM_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'rs_tools', 'dem'))
+
+# Bytes read at a time while hashing a tile
+DIGEST_CHUNK = 1 << 20
+
+# Bump when the processing below changes, so older cache entries are not reused
+CACHE_VERSION = 2
+
+# Digest index in the cache directory: {abspath: [size, mtime_ns, sha1]}
+DIGEST_INDEX = 'digests.json'
+
+def file_sha1(fn):
+    '''sha1 of the whole file, streamed in DIGEST_CHUNK pieces'''
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def tile_digest(fn, index=None):
+    '''sha1 of a tile's content. With an index dict (read_index), reuses the digest recorded for the
+    same path, size and mtime, and records new ones.'''
+    path = os.path.abspath(fn)
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime_ns]
+    if index is not None and index.get(path, [None])[:2] == stamp:
+        return index[path][2]
+    digest = file_sha1(path)
+    if index is not None:
+        index[path] = stamp + [digest]
+    return digest
+
+def read_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, DIGEST_INDEX)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def write_index(cache_dir, index):
+    '''Atomically replace the digest index; a read-only cache only costs rehashing next time'''
+    tmp = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(cache_dir, DIGEST_INDEX))
+    except OSError:
+        if (tmp is not None) and os.path.exists(tmp):
+            os.remove(tmp)
+
+def cache_key(tile, epsg, geoid=True, res=10., resampling='cubic', index=None):
+    '''Cache key of a prepared tile: the tile digest and every parameter that changes the output'''
+    params = dict(version=CACHE_VERSION, tile=tile_digest(tile, index), epsg=int(epsg), geoid=bool(geoid),
+                  res=float(res), resampling=resampling)
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key + '.tif')
+
+def run_cmd(cmd):
+    '''Run a command, raising RuntimeError with the end of its output if it fails'''
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if p.returncode != 0:
+        raise RuntimeError("%s failed (exit code %d):\n%s" % (' '.join(cmd), p.returncode,
+                           p.stdout.decode(errors='replace')[-2000:]))
+
+def prep_tile(tile, out_fn, epsg, geoid=True, res=10., resampling='cubic'):
+    '''Geoid-adjust and reproject one tile to out_fn.
+    Work happens in a temporary directory next to out_fn and the result is moved into place,
+    so concurrent runs sharing a cache never see a partial tile.'''
+    out_dir = os.path.dirname(out_fn)
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=out_dir, prefix='.tmp')
+    try:
+        src = os.path.abspath(tile)
+        if geoid:
+            prefix = os.path.join(tmp_dir, 'dem')
+            run_cmd(['dem_geoid', '--reverse-adjustment', src, '-o', prefix])
+            src = prefix + '-adj.tif'
+        tmp_fn = os.path.join(tmp_dir, 'warp.tif')
+        run_cmd(['gdalwarp', '-co', 'COMPRESS=LZW', '-co', 'TILED=YES', '-co', 'BIGTIFF=IF_SAFER', '-overwrite',
+                 '-r', resampling, '-t_srs', 'EPSG:%d' % int(epsg), '-dstnodata', '-9999',
+                 '-tr', '%g' % res, '%g' % res, src, tmp_fn])
+        os.replace(tmp_fn, out_fn)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_fn
+
+def cache_size(cache_dir):
+    '''[(mtime, bytes, path)] of the cached tiles, oldest first'''
+    entries = []
+    for root, dirs, files in os.walk(cache_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.tmp')]
+        for name in files:
+            if name.endswith('.tif'):
+                fn = os.path.join(root, name)
+                try:
+                    st = os.stat(fn)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fn))
+    return sorted(entries)
+
+def evict(cache_dir, max_bytes, keep=()):
+    '''Delete the least recently used tiles until the cache is at most max_bytes, never those in keep.
+    Returns the number of bytes freed.'''
+    entries = cache_size(cache_dir)
+    total = sum(e[1] for e in entries)
+    keep = set(os.path.abspath(fn) for fn in keep)
+    freed = 0
+    for mtime, size, fn in entries:
+        if total - freed <= max_bytes:
+            break
+        if os.path.abspath(fn) in keep:
+            continue
+        try:
+            os.remove(fn)
+        except FileNotFoundError:
+            continue
+        freed += size
+    return freed
+
+def prep_dems(tiles, epsg, out_vrt, cache_dir=DEFAULT_CACHE, geoid=True, res=10., resampling='cubic',
+              max_workers=None, max_gb=None):
+    '''Prepare tiles through the cache and build out_vrt from them. Returns the list of cached tiles.
+    The VRT points into the cache: tiles of the current run are never evicted, but a later run may
+    evict them, so rebuild the VRT (cheap once tiles are cached) rather than keeping it around.'''
+    cache_dir = os.path.abspath(cache_dir)
+    # cached tile -> input tile, tiles with the same content are prepared and mosaicked once
+    sources = dict()
+    index = read_index(cache_dir)
+    known = dict(index)
+    for tile in tiles:
+        sources.setdefault(cache_path(cache_dir, cache_key(tile, epsg, geoid, res, resampling, index)), tile)
+    if index != known:
+        write_index(cache_dir, index)
+    paths = list(sources)
+
+    todo = dict()
+    for fn, tile in sources.items():
+        if os.path.exists(fn):
+            # mtime marks use, for eviction
+            os.utime(fn)
+        else:
+            todo[fn] = tile
+    print("%d of %d tiles cached, preparing %d" % (len(paths) - len(todo), len(paths), len(todo)))
+
+    if todo:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(prep_tile, tile, fn, epsg, geoid, res, resampling): tile
+                       for fn, tile in todo.items()}
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                print("Prepared %s" % futures[future])
+
+    list_fn = out_vrt + '.txt'
+    with open(list_fn, 'w') as f:
+        f.write('\n'.join(paths) + '\n')
+    try:
+        run_cmd(['gdalbuildvrt', '-overwrite', '-input_file_list', list_fn, out_vrt])
+    finally:
+        os.remove(list_fn)
+
+    if max_gb is not None:
+        freed = evict(cache_dir, max_gb * 1e9, keep=paths)
+        if freed:
+            print("Evicted %.1f MB from %s" % (freed / 1e6, cache_dir))
+    return paths
+
+def read_tiles(in_fns, list_fn):
+    '''Tiles from -in and -list (one path per line, - for stdin)'''
+    tiles = list(in_fns or [])
+    if list_fn is not None:
+        f = sys.stdin if list_fn == '-' else open(list_fn)
+        try:
+            tiles += [line.strip() for line in f if line.strip()]
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    return tiles
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Geoid-adjust, reproject and mosaic DEM tiles (e.g. NED) through a shared cache')
+    parser.add_argument('-in', '--input_file', help='DEM tiles', nargs='+')
+    parser.add_argument('-list', '--input_list', help='Text file of DEM tiles, one per line (- for stdin)')
+    parser.add_argument('-epsg', '--epsg', help='Output EPSG code, e.g. 32610', type=int, required=True)
+    parser.add_argument('-out', '--output_file', help='Output VRT', required=True)
+    parser.add_argument('-tr', '--resolution', help='Output resolution in meters, default is 10', type=float, default=10.)
+    parser.add_argument('-r', '--resampling', help='gdalwarp resampling method, default is cubic', default='cubic')
+    parser.add_argument('-no_geoid', '--no_geoid', help='Skip the dem_geoid --reverse-adjustment step', action='store_true')
+    parser.add_argument('-n', '--number', help='Number of worker processes, default is the number of CPUs', type=int)
+    parser.add_argument('-cache_dir', '--cache_dir', help='Tile cache directory, default is $RS_DEM_CACHE or %s' % DEFAULT_CACHE,
+                        default=DEFAULT_CACHE)
+    parser.add_argument('-cache_gb', '--cache_gb', help='Evict least recently used tiles above this cache size (GB), default is no limit',
+                        type=float)
+    return parser
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    tiles = read_tiles(args.input_file, args.input_list)
+    if not tiles:
+        parser.error("No DEM tiles given, use -in or -list")
+    missing = [t for t in tiles if not os.path.exists(t)]
+    if missing:
+        sys.exit("DEM tiles not found: %s" % ', '.join(missing))
+    tools = ['gdalwarp', 'gdalbuildvrt'] + ([] if args.no_geoid else ['dem_geoid'])
+    missing = [t for t in tools if shutil.which(t) is None]
+    if missing:
+        sys.exit("Not found on the PATH: %s" % ', '.join(missing))
+
+    try:
+        prep_dems(tiles, args.epsg, args.output_file, args.cache_dir, not args.no_geoid, args.resolution,
+                  args.resampling, args.number, args.cache_gb)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    print("Built %s" % args.output_file)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Parse-once access to DigitalGlobe XML metadata (calibration factors, acquisition time, corners).
+# Tag lookups follow dshean's dgtools getTag/getAllTag: first match / all matches anywhere in the tree.
+
+import os
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+CORNER_TAGS = ['ULLON', 'ULLAT', 'URLON', 'URLAT', 'LRLON', 'LRLAT', 'LLLON', 'LLLAT']
+
+class DGMetadata(object):
+    """DigitalGlobe XML metadata, parsed once.
+
+    satid:              e.g. 'WV03'
+    bandid:             e.g. 'Multi', 'P', 'SWIR'
+    bands:              band codes in file order, from the IMD BAND_* elements (e.g. ['C', 'B', ...])
+    meansunel:          mean sun elevation (degrees)
+    meansunaz:          mean sun azimuth (degrees)
+    firstlinetime:      acquisition datetime
+    abscalfactor:       per-band absolute calibration factors (array)
+    effectivebandwidth: per-band effective bandwidths (array)
+    corners:            dict of ULLON, ULLAT, ... LLLAT floats (None if missing)
+    """
+    def __init__(self, xml_fn):
+        self.xml_fn = xml_fn
+        self.root = ET.parse(xml_fn).getroot()
+
+        self.satid = self.tag('SATID')
+        self.bandid = self.tag('BANDID')
+        imd = self.root.find('.//IMD')
+        imd = imd if imd is not None else self.root
+        self.bands = [elem.tag[5:] for elem in imd if elem.tag.startswith('BAND_')]
+
+        msunel = self.tag('MEANSUNEL')
+        self.meansunel = float(msunel) if msunel is not None else None
+        msunaz = self.tag('MEANSUNAZ')
+        self.meansunaz = float(msunaz) if msunaz is not None else None
+        t = self.tag('FIRSTLINETIME')
+        self.firstlinetime = datetime.strptime(t, "%Y-%m-%dT%H:%M:%S.%fZ") if t is not None else None
+
+        self.abscalfactor = np.array(self.all_tags('ABSCALFACTOR'), dtype=float)
+        self.effectivebandwidth = np.array(self.all_tags('EFFECTIVEBANDWIDTH'), dtype=float)
+
+        self.corners = dict()
+        for tag in CORNER_TAGS:
+            val = self.tag(tag)
+            self.corners[tag] = float(val) if val is not None else None
+
+    def tag(self, tag):
+        """Text of the first element named tag, None if absent"""
+        elem = self.root.find('.//%s' % tag)
+        if elem is not None:
+            return elem.text
+
+    def all_tags(self, tag):
+        """Text of every element named tag"""
+        return [i.text for i in self.root.findall('.//%s' % tag)]
+
+    def key(self, band):
+        """Calibration dictionary key, e.g. WV03_BAND_G"""
+        return '%s_BAND_%s' % (self.satid, band.upper())
+
+    @property
+    def toa_rad_coeffs(self):
+        """abscal/effbw for every band: multiply L1B DN by this to obtain TOA spectral radiance"""
+        return self.abscalfactor / self.effectivebandwidth
+
+@lru_cache(maxsize=256)
+def _read_xml(path, mtime):
+    return DGMetadata(path)
+
+def read_xml(xml_fn):
+    """Cached DGMetadata for xml_fn, reparsed only when the file's mtime changes"""
+    path = os.path.abspath(xml_fn)
+    return _read_xml(path, os.path.getmtime(path))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+# Spatial index of scene footprints for "which scenes cover this AOI" queries.
+# The footprints of the harvest.py catalog (scenes table) are kept in a SQLite R*Tree, maintained by
+# triggers as scenes are added or removed, so an AOI query reads only the index nodes near the AOI
+# instead of scanning the archive. Candidates from the R*Tree bounding boxes are checked against the
+# corner polygon of each scene (shapely) and filtered by acquisition date and satellite.
+
+# USAGE:
+# python footprints.py -db catalog.sqlite -bbox -121.6 48.2 -121.0 48.7 -start 2017-01-01 -end 2017-12-31
+# python footprints.py -db catalog.sqlite -aoi aoi.geojson -satid WV02 WV03
+# python footprints.py -db catalog.sqlite -aoi "POLYGON ((-121.6 48.2, ...))" -zones
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+import shapely
+
+# Polygon ring of the corner columns of the scenes table
+RING = ['ul', 'ur', 'lr', 'll']
+
+def create_index(con):
+    """Create the footprints R*Tree and its triggers on the scenes table, indexing existing scenes once"""
+    exists = con.execute("SELECT 1 FROM sqlite_master WHERE name = 'footprints'").fetchone()
+    con.execute('CREATE VIRTUAL TABLE IF NOT EXISTS footprints USING rtree(id, min_lon, max_lon, min_lat, max_lat)')
+    # REPLACE deletes without firing triggers, so writers delete and insert scenes rows explicitly
+    con.execute('''CREATE TRIGGER IF NOT EXISTS scenes_footprint_insert AFTER INSERT ON scenes
+        WHEN new.min_lon IS NOT NULL BEGIN
+        INSERT INTO footprints VALUES (new.rowid, new.min_lon, new.max_lon, new.min_lat, new.max_lat); END''')
+    con.execute('''CREATE TRIGGER IF NOT EXISTS scenes_footprint_delete AFTER DELETE ON scenes BEGIN
+        DELETE FROM footprints WHERE id = old.rowid; END''')
+    if not exists:
+        con.execute('''INSERT INTO footprints SELECT rowid, min_lon, max_lon, min_lat, max_lat
+            FROM scenes WHERE min_lon IS NOT NULL''')
+
+def rebuild_index(con):
+    """Re-index every scene, e.g. after rows were written with INSERT OR REPLACE"""
+    with con:
+        con.execute('DELETE FROM footprints')
+        con.execute('''INSERT INTO footprints SELECT rowid, min_lon, max_lon, min_lat, max_lat
+            FROM scenes WHERE min_lon IS NOT NULL''')
+
+def footprint(row):
+    """Scene polygon from the corner columns of a row, its bounding box if a corner is missing"""
+    coords = [(row[c + 'lon'], row[c + 'lat']) for c in RING]
+    if any(v is None for xy in coords for v in xy):
+        return shapely.box(row['min_lon'], row['min_lat'], row['max_lon'], row['max_lat'])
+    return shapely.Polygon(coords)
+
+def read_aoi(aoi):
+    """AOI geometry (lon/lat) from a WKT or GeoJSON string or file; GeoJSON features and collections are unioned"""
+    if os.path.exists(aoi):
+        with open(aoi) as f:
+            aoi = f.read()
+    aoi = aoi.strip()
+    if not aoi.startswith('{'):
+        return shapely.from_wkt(aoi)
+    gj = json.loads(aoi)
+    if gj.get('type') == 'FeatureCollection':
+        geoms = [feat['geometry'] for feat in gj['features']]
+    elif gj.get('type') == 'Feature':
+        geoms = [gj['geometry']]
+    else:
+        geoms = [gj]
+    return shapely.union_all([shapely.from_geojson(json.dumps(g)) for g in geoms])
+
+def query(con, geom=None, start=None, end=None, satids=None, exact=True):
+    """Scenes (sqlite3.Row) whose footprint intersects geom (any shapely geometry in lon/lat, None for all)
+    and acquired within [start, end] (ISO date or time strings; a date end includes the whole day).
+    exact=False returns every scene whose bounding box intersects, without the polygon test."""
+    sql = 'SELECT scenes.* FROM scenes'
+    where, params = [], []
+    if geom is not None:
+        xmin, ymin, xmax, ymax = shapely.bounds(geom).tolist()
+        # CROSS JOIN keeps the R*Tree as the outer loop; otherwise SQLite may scan a date range of scenes
+        # and probe the R*Tree once per scene
+        sql = 'SELECT scenes.* FROM footprints CROSS JOIN scenes ON footprints.id = scenes.rowid'
+        where += ['footprints.max_lon >= ?', 'footprints.min_lon <= ?', 'footprints.max_lat >= ?', 'footprints.min_lat <= ?']
+        params += [xmin, xmax, ymin, ymax]
+    if start is not None:
+        where.append('scenes.acquired >= ?')
+        params.append(start)
+    if end is not None:
+        # '2017-12-31' also matches '2017-12-31T23:59:59'
+        where.append('scenes.acquired <= ?')
+        params.append(end + 'T99' if len(end) == 10 else end)
+    if satids:
+        where.append('scenes.satid IN (%s)' % ', '.join('?' * len(satids)))
+        params += list(satids)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY scenes.acquired'
+
+    con.row_factory = sqlite3.Row
+    rows = con.execute(sql, params).fetchall()
+    if (geom is None) or (not exact) or (not rows):
+        return rows
+    shapely.prepare(geom)
+    polys = [footprint(row) for row in rows]
+    hits = shapely.intersects(geom, polys)
+    return [row for row, hit in zip(rows, hits.tolist()) if hit]
+
+def utm_zone(epsg):
+    """UTM zone string (e.g. '10N') of a 326xx/327xx EPSG code, None if not UTM"""
+    if epsg is None or not (32601 <= epsg <= 32660 or 32701 <= epsg <= 32760):
+        return None
+    return '%d%s' % (epsg % 100, 'N' if epsg < 32700 else 'S')
+
+def zones(rows):
+    """{EPSG code: number of scenes} of query results"""
+    out = dict()
+    for row in rows:
+        out[row['epsg']] = out.get(row['epsg'], 0) + 1
+    return out
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Find catalog scenes (harvest.py) covering an area of interest and date range')
+    parser.add_argument('-db', '--database', help='SQLite catalog written by harvest.py', required=True)
+    parser.add_argument('-bbox', '--bbox', help='Lon/lat bounding box', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'))
+    parser.add_argument('-aoi', '--aoi', help='Area of interest in lon/lat: WKT or GeoJSON, inline or as a file')
+    parser.add_argument('-start', '--start_date', help='Earliest acquisition, YYYY-MM-DD or ISO time')
+    parser.add_argument('-end', '--end_date', help='Latest acquisition, YYYY-MM-DD (inclusive) or ISO time')
+    parser.add_argument('-satid', '--satid', help='Only these satellites, e.g. WV02 WV03 LANDSAT_8', nargs='+')
+    parser.add_argument('-zones', '--zones', help='Only print the UTM zones of the matching scenes', action='store_true')
+    parser.add_argument('-rebuild', '--rebuild', help='Rebuild the footprint index before querying', action='store_true')
+    return parser
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.bbox and args.aoi:
+        parser.error("Use either -bbox or -aoi")
+    if not os.path.exists(args.database):
+        sys.exit("No catalog %s, run harvest.py first" % args.database)
+
+    geom = None
+    if args.bbox:
+        geom = shapely.box(*args.bbox)
+    elif args.aoi:
+        geom = read_aoi(args.aoi)
+
+    con = sqlite3.connect(args.database)
+    with con:
+        create_index(con)
+    if args.rebuild:
+        rebuild_index(con)
+    rows = query(con, geom, args.start_date, args.end_date, args.satid)
+    con.close()
+
+    if args.zones:
+        for epsg, n in sorted(zones(rows).items(), key=lambda kv: -kv[1]):
+            print("%s,%s,%d" % (epsg, utm_zone(epsg), n))
+        return
+    for row in rows:
+        print("%s,%s,%s,%s,%s" % (row['path'], row['satid'], row['acquired'], row['epsg'], utm_zone(row['epsg'])))
+    print("%d scenes" % len(rows), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
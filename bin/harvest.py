@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+# Harvest scene metadata from every DigitalGlobe XML and Landsat MTL file under one or more directories
+# into a SQLite catalog, parsing files in a process pool (dg_xml.read_xml, mtl.read_mtl).
+# One row per metadata file: satellite, acquisition time, sun angles, calibration factors, corner
+# coordinates, UTM EPSG code (the utm_convert zone of the whole-degree bounds centre, computed for all
+# new scenes in one vectorized lookup) and the image files of the scene.
+# Re-runs only parse files that are new or changed (mtime and size) and drop rows of files that are gone.
+# XML files that are not scene metadata (ESRI/shapefile sidecars, order READMEs, ...) are remembered in the
+# skipped table, so they are not reparsed either.
+
+# USAGE:
+# python harvest.py -in /data/bulk_order_1 /data/bulk_order_2 -db catalog.sqlite -n 8
+# sqlite3 catalog.sqlite "select path, acquired, epsg from scenes where satid = 'WV03' and acquired > '2017'"
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sqlite3
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+
+from dg_xml import read_xml, CORNER_TAGS
+from footprints import create_index
+from mtl import read_mtl
+from utm_convert import corner_bounds, get_utm_epsg_codes
+
+# Column name: SQLite type, in table order
+COLUMNS = [
+('path', 'TEXT PRIMARY KEY'),
+('kind', 'TEXT'),           # 'dg' or 'mtl'
+('mtime_ns', 'INTEGER'),
+('size', 'INTEGER'),
+('satid', 'TEXT'),
+('bandid', 'TEXT'),
+('acquired', 'TEXT'),       # ISO 8601 UTC, sorts as text
+('sun_elevation', 'REAL'),
+('sun_azimuth', 'REAL'),
+] + [(tag.lower(), 'REAL') for tag in CORNER_TAGS] + [
+('min_lon', 'REAL'),
+('min_lat', 'REAL'),
+('max_lon', 'REAL'),
+('max_lat', 'REAL'),
+('epsg', 'INTEGER'),
+('bands', 'TEXT'),          # JSON list of band names/numbers
+('calibration', 'TEXT'),    # JSON {coefficient: {band: value}}
+('files', 'TEXT'),          # JSON list of image files of the scene
+('harvested', 'TEXT'),
+]
+NAMES = [name for name, kind in COLUMNS]
+
+# Bump when records change (e.g. new fields), so scenes of older catalogs are reparsed once
+CATALOG_VERSION = 2
+
+# Image extensions of the files listed for DigitalGlobe scenes (same name as the XML)
+IMAGE_EXTS = ('.tif', '.TIF', '.ntf', '.NTF')
+
+def is_metadata(fn):
+    """DigitalGlobe XML or Landsat MTL by filename (GDAL .aux.xml sidecars excluded)"""
+    low = fn.lower()
+    return low.endswith('_mtl.txt') or (low.endswith('.xml') and not low.endswith('.aux.xml'))
+
+def walk(roots):
+    """Metadata files under the root directories, as absolute paths"""
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            for fn in filenames:
+                if is_metadata(fn):
+                    yield os.path.abspath(os.path.join(dirpath, fn))
+
+def dg_record(path):
+    md = read_xml(path)
+    if md.satid is None:
+        return None
+    stem = os.path.splitext(path)[0]
+    files = [stem + ext for ext in IMAGE_EXTS if os.path.exists(stem + ext)]
+    calibration = dict(abscalfactor=dict(zip(md.bands, md.abscalfactor.tolist())),
+                       effectivebandwidth=dict(zip(md.bands, md.effectivebandwidth.tolist())))
+    return dict(kind='dg', satid=md.satid, bandid=md.bandid,
+                acquired=md.firstlinetime.isoformat() if md.firstlinetime is not None else None,
+                sun_elevation=md.meansunel, sun_azimuth=md.meansunaz, corners=md.corners,
+                bands=md.bands, calibration=calibration, files=files)
+
+def mtl_time(md):
+    """DATE_ACQUIRED and SCENE_CENTER_TIME as ISO 8601 (seconds to microseconds)"""
+    if md.date_acquired is None:
+        return None
+    t = md.scene_center_time
+    if not isinstance(t, str):
+        return md.date_acquired.isoformat()
+    t = t.rstrip('Z')
+    if '.' in t:
+        t = t[:t.index('.') + 7]
+    return '%sT%s' % (md.date_acquired.isoformat(), t)
+
+def mtl_record(path):
+    md = read_mtl(path)
+    corners = dict()
+    for corner in ('UL', 'UR', 'LR', 'LL'):
+        corners[corner + 'LON'] = md.get('CORNER_%s_LON_PRODUCT' % corner)
+        corners[corner + 'LAT'] = md.get('CORNER_%s_LAT_PRODUCT' % corner)
+    names = md.per_band('FILE_NAME')
+    dirname = os.path.dirname(path)
+    files = [os.path.join(dirname, names[b]) for b in sorted(names) if os.path.exists(os.path.join(dirname, names[b]))]
+    calibration = dict((key.lower(), dict((str(b), v) for b, v in sorted(md.per_band(key).items())))
+                       for key in ('REFLECTANCE_MULT', 'REFLECTANCE_ADD', 'RADIANCE_MULT', 'RADIANCE_ADD'))
+    return dict(kind='mtl', satid=md.spacecraft_id, bandid=md.sensor_id, acquired=mtl_time(md),
+                sun_elevation=md.sun_elevation, sun_azimuth=md.sun_azimuth, corners=corners,
+                bands=sorted(md.reflectance_mult) or sorted(names), calibration=calibration, files=files)
+
+def harvest_file(path):
+    """(path, record dict or None if not scene metadata, error message or None), run in the pool"""
+    try:
+        st = os.stat(path)
+        if path.lower().endswith('_mtl.txt'):
+            rec = mtl_record(path)
+        else:
+            rec = dg_record(path)
+    except Exception as e:
+        return path, None, '%s: %s' % (type(e).__name__, e)
+    if rec is not None:
+        rec.update(path=path, mtime_ns=st.st_mtime_ns, size=st.st_size)
+    return path, rec, None
+
+def add_zones(recs):
+    """Set bounds and EPSG code of every record from its corners, with one vectorized zone lookup"""
+    centres = []
+    for rec in recs:
+        corners = rec.pop('corners')
+        for tag in CORNER_TAGS:
+            rec[tag.lower()] = corners.get(tag)
+        try:
+            xmin, ymin, xmax, ymax = corner_bounds(corners)
+        except (ValueError, TypeError):
+            rec.update(min_lon=None, min_lat=None, max_lon=None, max_lat=None, epsg=None)
+            continue
+        lons = [corners[t] for t in CORNER_TAGS if t.endswith('LON')]
+        lats = [corners[t] for t in CORNER_TAGS if t.endswith('LAT')]
+        rec.update(min_lon=min(lons), min_lat=min(lats), max_lon=max(lons), max_lat=max(lats))
+        centres.append((rec, (ymin + ymax) / 2., (xmin + xmax) / 2.))
+    if centres:
+        zones, hemis, epsgs = get_utm_epsg_codes(np.array([c[1] for c in centres]), np.array([c[2] for c in centres]))
+        for (rec, lat, lon), epsg in zip(centres, epsgs.tolist()):
+            rec['epsg'] = epsg if epsg else None
+    return recs
+
+def row(rec, now):
+    rec = dict(rec, harvested=now)
+    for key in ('bands', 'calibration', 'files'):
+        rec[key] = json.dumps(rec[key])
+    return [rec.get(name) for name in NAMES]
+
+def open_catalog(db_fn):
+    """SQLite catalog with the scenes table and its footprint index (created if needed)"""
+    con = sqlite3.connect(db_fn)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('CREATE TABLE IF NOT EXISTS scenes (%s)' % ', '.join('%s %s' % c for c in COLUMNS))
+    for col in ('satid', 'acquired', 'epsg'):
+        con.execute('CREATE INDEX IF NOT EXISTS scenes_%s ON scenes (%s)' % (col, col))
+    # files that parse but are not scene metadata
+    con.execute('CREATE TABLE IF NOT EXISTS skipped (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER)')
+    with con:
+        create_index(con)
+    return con
+
+def under(path, roots):
+    return any(path == r or path.startswith(r.rstrip(os.sep) + os.sep) for r in roots)
+
+def harvest(roots, db_fn, max_workers=None, chunksize=16, prune=True):
+    """Add new and changed metadata files under roots to the catalog db_fn, removing rows of files under
+    roots that no longer exist. Returns counts of added/updated, unchanged, removed, skipped and failed files."""
+    roots = [os.path.abspath(r) for r in roots]
+    con = open_catalog(db_fn)
+    known = dict((path, (mtime_ns, size)) for path, mtime_ns, size in
+                 con.execute('SELECT path, mtime_ns, size FROM scenes'))
+    outdated = con.execute('PRAGMA user_version').fetchone()[0] < CATALOG_VERSION
+    known_skipped = dict((path, (mtime_ns, size)) for path, mtime_ns, size in
+                         con.execute('SELECT path, mtime_ns, size FROM skipped'))
+
+    found, todo, stamps = set(), [], dict()
+    for path in walk(roots):
+        found.add(path)
+        st = os.stat(path)
+        stamps[path] = (st.st_mtime_ns, st.st_size)
+        if outdated or stamps[path] not in (known.get(path), known_skipped.get(path)):
+            todo.append(path)
+
+    recs, failed, skipped = [], [], []
+    if todo:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for path, rec, err in executor.map(harvest_file, todo, chunksize=chunksize):
+                if err is not None:
+                    failed.append((path, err))
+                elif rec is None:
+                    skipped.append(path)
+                else:
+                    recs.append(rec)
+    add_zones(recs)
+
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    gone = [p for p in known if under(p, roots) and p not in found] if prune else []
+    gone_skipped = [p for p in known_skipped if under(p, roots) and p not in found] if prune else []
+    with con:
+        # changed files are deleted and reinserted (not REPLACEd) so the footprint triggers fire; files that
+        # stopped being scene metadata, or failed to parse, lose their old row
+        con.executemany('DELETE FROM scenes WHERE path = ?', [(p,) for p in gone + todo if p in known])
+        con.executemany('INSERT INTO scenes (%s) VALUES (%s)' % (', '.join(NAMES), ', '.join('?' * len(NAMES))),
+                        [row(rec, now) for rec in recs])
+        con.executemany('DELETE FROM skipped WHERE path = ?', [(p,) for p in gone_skipped + todo if p in known_skipped])
+        con.executemany('INSERT INTO skipped VALUES (?, ?, ?)', [(p,) + stamps[p] for p in skipped])
+        if outdated:
+            con.execute('PRAGMA user_version = %d' % CATALOG_VERSION)
+    con.close()
+
+    for path, err in failed:
+        print("Failed to parse %s: %s" % (path, err), file=sys.stderr)
+    return dict(updated=len(recs), unchanged=len(found) - len(todo), removed=len(gone), skipped=len(skipped),
+                failed=len(failed))
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Harvest DigitalGlobe XML and Landsat MTL metadata into a SQLite catalog')
+    parser.add_argument('-in', '--input_dir', help='Directories to scan', nargs='+', required=True)
+    parser.add_argument('-db', '--database', help='SQLite catalog, created if needed', required=True)
+    parser.add_argument('-n', '--number', help='Number of worker processes, default is the number of CPUs', type=int)
+    parser.add_argument('-no_prune', '--no_prune', help='Keep rows of files that no longer exist', action='store_true')
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    for d in args.input_dir:
+        if not os.path.isdir(d):
+            sys.exit("Not a directory: %s" % d)
+    counts = harvest(args.input_dir, args.database, args.number, prune=not args.no_prune)
+    print("%(updated)d added or updated, %(unchanged)d unchanged, %(removed)d removed, "
+          "%(skipped)d not scene metadata, %(failed)d failed" % counts)
+    if counts['failed']:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
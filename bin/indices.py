@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+# Script to calculate several normalized difference indices in one pass over the per-band reflectance files.
+# Each band needed by any requested index is read once per window and shared between indices.
+# Formulas and output names are those of ndvi.py, ndwi.py and ndsi.py.
+
+# With -dn, the inputs are the raw L1B DN images: TOA reflectance is applied in memory per window
+# (wv_TOA_refl.calc_toa) and the _refl.tif files are only written if -write_refl is given.
+
+# USAGE:
+# indices.py -in ms_fn.tif -in2 swir_fn.tif -idx ndvi ndvi_RE ndwi ndsi -m 'mos'
+# indices.py -dn -in ms_fn.tif -in_x ms_fn.xml -in2 swir_fn.tif -in2_x swir_fn.xml
+
+import argparse
+import os
+import sys
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio as rio
+
+from ndvi import calc_ndvi
+from ndwi import calc_ndwi
+from ndsi import calc_ndsi
+from refl_io import read_refl
+import out_profile
+from cog import open_raster
+from wv_TOA_refl import band_fn, get_modifier, get_profile, band_codes, toa_coeff_arrays, calc_toa, fold_coeffs, calc_toa_f32
+
+# Index name: (calc function, bands in calc argument order, default output filename)
+INDICES = {
+'ndvi': (calc_ndvi, ('red', 'nir1'), 'ndvi.tif'),
+'ndvi_RE': (calc_ndvi, ('RE', 'nir1'), 'ndvi_RE.tif'),
+'ndwi': (calc_ndwi, ('green', 'nir2'), 'ndwi.tif'),
+'ndsi': (calc_ndsi, ('green', 'swir3'), 'ndsi.tif'),
+}
+
+# Band name: (input image, 1-based band number in that image's per-band reflectance files)
+BANDS = {
+'green': ('ms', 3),
+'red': ('ms', 5),
+'RE': ('ms', 6),
+'nir1': ('ms', 7),
+'nir2': ('ms', 8),
+'swir3': ('swir', 3),
+}
+
+def required_bands(indices):
+    """Bands needed by the requested indices, each listed once"""
+    bands = []
+    for name in indices:
+        for band in INDICES[name][1]:
+            if band not in bands:
+                bands.append(band)
+    return bands
+
+def band_sources(bands, ms_fn=None, swir_fn=None, modifier=None, band_files=None):
+    """Filename for each band: explicit single-band files first, then the per-band files of the MS/SWIR
+    inputs (_refl.tif, or _refl.vrt if only the VRT exists)"""
+    inputs = {'ms': ms_fn, 'swir': swir_fn}
+    srcs = dict()
+    for band in bands:
+        if band_files and band_files.get(band) is not None:
+            srcs[band] = band_files[band]
+        else:
+            image, n = BANDS[band]
+            if (inputs[image] is None) | (modifier is None):
+                sys.exit("Check input files, missing proper input for %s band" % band)
+            srcs[band] = band_fn(inputs[image], n, modifier)
+            # Virtual reflectance from wv_TOA_refl.py -vrt, transformed by GDAL on read
+            vrt_fn = srcs[band][:-4] + ".vrt"
+            if not os.path.exists(srcs[band]) and os.path.exists(vrt_fn):
+                srcs[band] = vrt_fn
+    return srcs
+
+def out_names(indices, out_dir='.'):
+    """(index, min-max scaled index) output filenames"""
+    outs = dict()
+    for name in indices:
+        out_fn = os.path.join(out_dir, INDICES[name][2])
+        outs[name] = (out_fn, out_fn[:-4]+"_minmax.tif")
+    return outs
+
+def calc_window(indices, arrs, ndvs):
+    """Compute every requested index from one window of band arrays.
+    Returns {index: (index array, min-max scaled array)}
+    """
+    results = dict()
+    for name in indices:
+        calc, (b1, b2), _ = INDICES[name]
+        results[name] = calc(arrs[b1], arrs[b2], ndvs[b1], ndvs[b2])
+    return results
+
+def open_outputs(stack, indices, outs, prf, cog=False):
+    return dict((name, [stack.enter_context(open_raster(fn, prf, cog)) for fn in outs[name]]) for name in indices)
+
+def write_window(dsts, results, window):
+    for name, arrs in results.items():
+        for dst, arr in zip(dsts[name], arrs):
+            dst.write(arr.astype(rio.float32), 1, window=window)
+
+def run(indices, srcs, outs, out_opts=None, cog=False):
+    """Calculate indices from the band files in srcs, writing outs[index] = (out_fn, minmax_fn)"""
+    with rio.Env(), ExitStack() as stack:
+        files = dict((band, stack.enter_context(rio.open(fn))) for band, fn in srcs.items())
+        ndvs = dict((band, f.nodata) for band, f in files.items())
+        ref = files[required_bands(indices)[0]]
+        for band, f in files.items():
+            if f.shape != ref.shape:
+                sys.exit("Band %s (%s) does not match the shape of the other inputs" % (band, srcs[band]))
+
+        prf = ref.profile
+        if prf['driver'] != 'GTiff':
+            # e.g. reflectance VRTs: write GeoTIFFs tiled like wv_TOA_refl.py output
+            prf = get_profile(prf)
+            prf['driver'] = 'GTiff'
+        prf.update(
+            dtype=rio.float32,
+            count=1)
+        out_profile.update_profile(prf, **(out_opts or {}))
+        dsts = open_outputs(stack, indices, outs, prf, cog)
+
+        # Output blocks, so that COG overviews can be reduced from each one
+        for ij, window in dsts[indices[0]][0].block_windows(1):
+            arrs = dict((band, read_refl(f, 1, window=window)) for band, f in files.items())
+            write_window(dsts, calc_window(indices, arrs, ndvs), window)
+
+def dn_sources(bands, ms_fn=None, ms_xml=None, swir_fn=None, swir_xml=None):
+    """Group the bands by raw DN image: {(image fn, xml fn): [(band, 1-based band number), ...]}"""
+    inputs = {'ms': (ms_fn, ms_xml), 'swir': (swir_fn, swir_xml)}
+    groups = dict()
+    for band in bands:
+        image, n = BANDS[band]
+        if None in inputs[image]:
+            sys.exit("Check input files, missing %s image or xml for %s band" % (image.upper(), band))
+        groups.setdefault(inputs[image], []).append((band, n))
+    return groups
+
+def run_dn(indices, groups, outs, modifier=None, f32=False, out_opts=None, cog=False):
+    """Calculate indices straight from L1B DN images, applying TOA reflectance per window in memory.
+    groups is the output of dn_sources; if modifier is given the per-band _refl.tif files are written too.
+    With f32, reflectance is computed by calc_toa_f32 into one reused buffer per input.
+    """
+    with rio.Env(), ExitStack() as stack:
+        readers = []
+        for (in_fn, xml_fn), bands in groups.items():
+            f = stack.enter_context(rio.open(in_fn))
+            ns = [n for band, n in bands]
+            codes = band_codes(xml_fn, f.count)
+            coeffs = toa_coeff_arrays(xml_fn, [codes[n-1] for n in ns])
+            if f32:
+                coeffs = fold_coeffs(*coeffs)
+            readers.append((f, bands, ns, coeffs))
+
+        ref = readers[0][0]
+        for f, bands, ns, coeffs in readers:
+            if f.shape != ref.shape:
+                sys.exit("%s does not match the shape of the other inputs" % f.name)
+
+        # Same layout as the chain through wv_TOA_refl.py: 512x512 float32 tiles unless out_opts say otherwise
+        prf = get_profile(ref.profile, out_opts=out_opts)
+        dsts = open_outputs(stack, indices, outs, prf, cog)
+        refl_dsts = dict()
+        if modifier is not None:
+            for f, bands, ns, coeffs in readers:
+                for band, n in bands:
+                    refl_dsts[band] = stack.enter_context(open_raster(band_fn(f.name, n, modifier), get_profile(f.profile, out_opts=out_opts), cog))
+
+        ndvs = dict((band, f.nodata) for f, bands, ns, coeffs in readers for band, n in bands)
+        out_ref = dsts[indices[0]][0]
+        bufs = dict((f.name, np.empty(len(ns) * prf['blockxsize'] * prf['blockysize'], dtype=np.float32))
+                    for f, bands, ns, coeffs in readers) if f32 else dict()
+        for ij, window in out_ref.block_windows(1):
+            arrs = dict()
+            for f, bands, ns, coeffs in readers:
+                data = f.read(ns, window=window)
+                if f32:
+                    TOA_arr = calc_toa_f32(data, *coeffs, ndv=f.nodata, out=bufs[f.name])
+                else:
+                    TOA_arr = calc_toa(data, *coeffs)
+                    TOA_arr[data==f.nodata] = f.nodata
+                    TOA_arr = TOA_arr.astype(rio.float32)
+                for i, (band, n) in enumerate(bands):
+                    arrs[band] = TOA_arr[i]
+                    if band in refl_dsts:
+                        refl_dsts[band].write(TOA_arr[i], 1, window=window)
+            write_window(dsts, calc_window(indices, arrs, ndvs), window)
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Multiple Normalized Difference Index Calculation Script')
+    parser.add_argument('-in', '--MS_input_file', help='Multiband MS image file', required=False)
+    parser.add_argument('-in2', '--SWIR_input_file', help='Multiband SWIR image file for WV3', required=False)
+    parser.add_argument('-idx', '--indices', help='Indices to calculate, default is ndvi ndvi_RE ndwi (and ndsi with -in2 or -s3)',
+                        nargs='+', choices=list(INDICES), required=False)
+    parser.add_argument('-out_dir', '--output_dir', help='Where index images are to be saved', default=".", required=False)
+    parser.add_argument('-g', '--green_band', help='Single-band green input', required=False)
+    parser.add_argument('-r', '--red_band', help='Single-band red input', required=False)
+    parser.add_argument('-re', '--red_edge_band', help='Single-band red edge input', required=False)
+    parser.add_argument('-n', '--nir_band', help='Single-band NIR channel input', required=False)
+    parser.add_argument('-n2', '--nir2_band', help='Single-band NIR2 channel input', required=False)
+    parser.add_argument('-s3', '--swir_3_band', help='Single band SWIR input', required=False)
+    parser.add_argument('-res', '--px_res', help='Pixel resolution, default is 1.2m', default="1.2", required=False)
+    parser.add_argument('-m', '--mod', help='Modifiers to single band filenames')
+    parser.add_argument('-dn', '--from_dn', help='Inputs are L1B DN images, apply TOA reflectance in memory', action='store_true')
+    parser.add_argument('-in_x', '--MS_input_xml', help='MS image xml file, with -dn', required=False)
+    parser.add_argument('-in2_x', '--SWIR_input_xml', help='SWIR image xml file, with -dn', required=False)
+    parser.add_argument('-write_refl', '--write_refl', help='With -dn, also write the per-band _refl.tif files', action='store_true')
+    parser.add_argument('-f32', '--f32', help='With -dn, use the float32 folded TOA kernel (differences ~1e-7)', action='store_true')
+    out_profile.add_args(parser)
+    return parser
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    # Mosaicked handling
+    modifier = get_modifier(args.px_res, args.mod)
+
+    band_files = {'green': args.green_band, 'red': args.red_band, 'RE': args.red_edge_band,
+                  'nir1': args.nir_band, 'nir2': args.nir2_band, 'swir3': args.swir_3_band}
+
+    indices = args.indices
+    if indices is None:
+        indices = ['ndvi', 'ndvi_RE', 'ndwi']
+        if (args.SWIR_input_file is not None) | (args.swir_3_band is not None):
+            indices.append('ndsi')
+
+    out_opts = out_profile.from_args(args)
+    if args.from_dn:
+        groups = dn_sources(required_bands(indices), args.MS_input_file, args.MS_input_xml,
+                            args.SWIR_input_file, args.SWIR_input_xml)
+        run_dn(indices, groups, out_names(indices, args.output_dir), modifier if args.write_refl else None, f32=args.f32,
+               out_opts=out_opts, cog=args.cog)
+    else:
+        srcs = band_sources(required_bands(indices), args.MS_input_file, args.SWIR_input_file, modifier, band_files)
+        run(indices, srcs, out_names(indices, args.output_dir), out_opts, args.cog)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+# Parse-once access to Landsat MTL metadata (the _MTL.txt delivered with Level 1 products).
+# The GROUP = ... / END_GROUP = ... hierarchy is read in a single pass into nested dicts of typed values
+# (int, float or str), with per-band values (REFLECTANCE_MULT_BAND_n, ...) available as arrays.
+# Parsed files are cached in memory and on disk (one JSON file per MTL, keyed by path, mtime and size),
+# so scheduling or TOA runs over thousands of scenes do not re-tokenize MTL files already seen.
+# Set RS_MTL_CACHE to choose the disk cache directory, or to an empty string to disable it.
+
+# USAGE:
+# python mtl.py -in LC08_..._MTL.txt
+# python mtl.py -in LC08_..._MTL.txt -key SUN_ELEVATION REFLECTANCE_MULT_BAND_4
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import tempfile
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+CACHE_DIR = os.environ.get('RS_MTL_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'rs_tools', 'mtl'))
+
+# Bump when parsing changes, so older cache files are reparsed
+CACHE_VERSION = 1
+
+INT_PATTERN = re.compile(r"^[+-]?\d+$")
+FLOAT_PATTERN = re.compile(r"^[+-]?(\d+\.\d*|\.\d+|\d+)([eE][+-]?\d+)?$")
+BAND_PATTERN = re.compile(r"^(.*)_BAND_(\d+)$")
+
+def parse_value(text):
+    """Typed MTL value: quoted strings without quotes, ints, floats, anything else as text
+    (e.g. dates, which stay ISO strings)"""
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] == '"':
+        return text[1:-1]
+    if INT_PATTERN.match(text):
+        return int(text)
+    if FLOAT_PATTERN.match(text):
+        return float(text)
+    return text
+
+def parse_mtl(lines):
+    """Nested dict of an MTL file's groups, from an iterable of lines, in one pass"""
+    root = dict()
+    stack = [('', root)]
+    for n, line in enumerate(lines, 1):
+        line = line.strip()
+        if (not line) or (line == 'END'):
+            continue
+        key, sep, value = line.partition('=')
+        if not sep:
+            raise ValueError("Line %d is not KEY = VALUE: %s" % (n, line))
+        key, value = key.strip(), value.strip()
+        if key == 'GROUP':
+            group = dict()
+            stack[-1][1][value] = group
+            stack.append((value, group))
+        elif key == 'END_GROUP':
+            if stack[-1][0] != value:
+                raise ValueError("Line %d: END_GROUP = %s closes GROUP = %s" % (n, value, stack[-1][0]))
+            stack.pop()
+        else:
+            stack[-1][1][key] = parse_value(value)
+    if len(stack) > 1:
+        raise ValueError("GROUP = %s is never closed" % stack[-1][0])
+    return root
+
+class MTLMetadata(object):
+    """Landsat MTL metadata, parsed once.
+
+    groups:             nested dict of the whole file, e.g. groups['L1_METADATA_FILE']['IMAGE_ATTRIBUTES']
+    spacecraft_id:      e.g. 'LANDSAT_8'
+    date_acquired:      acquisition date (datetime.date)
+    sun_elevation, sun_azimuth, earth_sun_distance, cloud_cover
+    reflectance_mult, reflectance_add, radiance_mult, radiance_add:
+                        {band number: value} rescaling coefficients
+    """
+    def __init__(self, mtl_fn, groups):
+        self.mtl_fn = mtl_fn
+        self.groups = groups
+        # every KEY = VALUE, for lookups anywhere in the tree (first occurrence wins)
+        self.values = dict()
+        self._flatten(groups)
+
+        self.spacecraft_id = self.get('SPACECRAFT_ID')
+        self.sensor_id = self.get('SENSOR_ID')
+        d = self.get('DATE_ACQUIRED')
+        self.date_acquired = datetime.strptime(d, "%Y-%m-%d").date() if isinstance(d, str) else None
+        self.scene_center_time = self.get('SCENE_CENTER_TIME')
+        self.sun_elevation = self.get('SUN_ELEVATION')
+        self.sun_azimuth = self.get('SUN_AZIMUTH')
+        self.earth_sun_distance = self.get('EARTH_SUN_DISTANCE')
+        self.cloud_cover = self.get('CLOUD_COVER')
+
+        self.reflectance_mult = self.per_band('REFLECTANCE_MULT')
+        self.reflectance_add = self.per_band('REFLECTANCE_ADD')
+        self.radiance_mult = self.per_band('RADIANCE_MULT')
+        self.radiance_add = self.per_band('RADIANCE_ADD')
+
+    def _flatten(self, group):
+        for key, value in group.items():
+            if isinstance(value, dict):
+                self._flatten(value)
+            else:
+                self.values.setdefault(key, value)
+
+    def get(self, key, default=None):
+        """Value of the first key anywhere in the file"""
+        return self.values.get(key, default)
+
+    def group(self, name):
+        """First group called name anywhere in the file, None if absent"""
+        todo = [self.groups]
+        while todo:
+            group = todo.pop(0)
+            if name in group and isinstance(group[name], dict):
+                return group[name]
+            todo += [v for v in group.values() if isinstance(v, dict)]
+
+    def per_band(self, prefix):
+        """{band number: value} of the prefix_BAND_n keys, e.g. per_band('REFLECTANCE_MULT')"""
+        out = dict()
+        for key, value in self.values.items():
+            m = BAND_PATTERN.match(key)
+            if m and m.group(1) == prefix:
+                out[int(m.group(2))] = value
+        return out
+
+    def band_array(self, prefix, bands):
+        """float64 array of prefix_BAND_n values for the band numbers in bands (KeyError if one is missing)"""
+        values = self.per_band(prefix)
+        return np.array([values[b] for b in bands], dtype=np.float64)
+
+def cache_fn(path, cache_dir=None):
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    return os.path.join(cache_dir, hashlib.sha1(path.encode()).hexdigest() + '.json')
+
+def load_groups(path, cache_dir=None):
+    """Parsed groups of the MTL at path, from the disk cache when path, mtime and size match"""
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    st = os.stat(path)
+    stamp = dict(version=CACHE_VERSION, path=path, mtime_ns=st.st_mtime_ns, size=st.st_size)
+    fn = cache_fn(path, cache_dir) if cache_dir else None
+    if fn is not None:
+        try:
+            with open(fn) as f:
+                cached = json.load(f)
+            if cached.get('stamp') == stamp:
+                return cached['groups']
+        except (OSError, ValueError):
+            pass
+
+    with open(path) as f:
+        groups = parse_mtl(f)
+
+    if fn is not None:
+        tmp = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(stamp=stamp, groups=groups), f)
+            os.replace(tmp, fn)
+        except OSError:
+            # a read-only or full cache only costs a reparse next time
+            if (tmp is not None) and os.path.exists(tmp):
+                os.remove(tmp)
+    return groups
+
+@lru_cache(maxsize=1024)
+def _read_mtl(path, mtime_ns, cache_dir):
+    return MTLMetadata(path, load_groups(path, cache_dir))
+
+def read_mtl(mtl_fn, cache_dir=None):
+    """Cached MTLMetadata for mtl_fn, reparsed only when the file changes.
+    cache_dir overrides CACHE_DIR; '' keeps the cache in memory only."""
+    path = os.path.abspath(mtl_fn)
+    return _read_mtl(path, os.stat(path).st_mtime_ns, cache_dir)
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Print Landsat MTL metadata as JSON')
+    parser.add_argument('-in', '--input_file', help='MTL text file', required=True)
+    parser.add_argument('-key', '--key', help='Only print these keys (searched in every group)', nargs='+')
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    md = read_mtl(args.input_file)
+    if args.key:
+        print(json.dumps(dict((key, md.get(key)) for key in args.key), indent=1))
+    else:
+        print(json.dumps(md.groups, indent=1))
+
+if __name__ == "__main__":
+    main()
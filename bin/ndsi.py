@@ -8,9 +8,13 @@ import numpy as np
 import rasterio as rio
 import sys
 
+from refl_io import read_refl
+import out_profile
+from cog import open_raster
+
 def read_file(fn):
     with rio.open(fn) as f:
-        arr=f.read()
+        arr=read_refl(f)
         prf=f.profile
         ndv=f.nodata
     return arr, prf, ndv
@@ -36,7 +40,7 @@ def calc_ndsi(green_arr, swir3_arr, g_ndv=None, swir3_ndv=None):
     
     return ndsi_3, ndsi_3_norm
 
-def run(multi_band_file, swir_file, out_fn, green_fn, s3_fn, px_res, modifier):
+def run(multi_band_file, swir_file, out_fn, green_fn, s3_fn, px_res, modifier, out_opts=None, cog=False):
     try:
         if (multi_band_file is not None) & (swir_file is not None):
             green_arr, prf, g_ndv = read_file(multi_band_file[:-4] + "_b3_" + modifier + "_refl.tif")
@@ -53,12 +57,13 @@ def run(multi_band_file, swir_file, out_fn, green_fn, s3_fn, px_res, modifier):
         try:
             with rio.Env():
                 prf.update(
+                    driver='GTiff',
                     dtype=rio.float32,
-                    count=1,
-                    compress='lzw')
-                with rio.open(out_fn, 'w', **prf) as dst:
+                    count=1)
+                out_profile.update_profile(prf, **(out_opts or {}))
+                with open_raster(out_fn, prf, cog) as dst:
                     dst.write(np.squeeze(ndsi_3).astype(rio.float32), 1)
-                with rio.open(out_fn[:-4]+"_minmax.tif", 'w', **prf) as dst:
+                with open_raster(out_fn[:-4]+"_minmax.tif", prf, cog) as dst:
                     dst.write(np.squeeze(ndsi_3_norm).astype(rio.float32), 1)
         except:
             print("Cannot write out calculated NDSI")
@@ -75,6 +80,7 @@ def get_parser():
     parser.add_argument('-s3', '--swir_3_band', help='Single band SWIR input', required=False)
     parser.add_argument('-res', '--px_res', help='Pixel resolution, default is 1.2 m', default="1.2", required=False)
     parser.add_argument('-m', '--mod', help='Modifiers to single band filenames')
+    out_profile.add_args(parser)
     return parser
 
 def main():
@@ -95,7 +101,7 @@ def main():
         modifier=args.mod + "_" + px_res[0]+px_res[-1]
     
 #     print(in_fn, swir_file, out_fn, green_fn, s3_fn, px_res, modifier)
-    run(in_fn, swir_file, out_fn, green_fn, s3_fn, px_res, modifier)
+    run(in_fn, swir_file, out_fn, green_fn, s3_fn, px_res, modifier, out_profile.from_args(args), args.cog)
         
 if __name__ == "__main__":    
     main()
\ No newline at end of file
@@ -8,9 +8,13 @@ import numpy as np
 import rasterio as rio
 import sys
 
+from refl_io import read_refl
+import out_profile
+from cog import open_raster
+
 def read_file(fn):
     with rio.open(fn) as f:
-        arr=f.read()
+        arr=read_refl(f)
         prf=f.profile
         ndv=f.nodata
     return arr, prf, ndv
@@ -36,7 +40,7 @@ def calc_ndvi(red_arr, nir1_arr, r_ndv=None, nir1_ndv=None):
     
     return ndvi, ndvi_norm
 
-def run(multi_band_file, out_fn, nir1_fn, red_fn, px_res, modifier):
+def run(multi_band_file, out_fn, nir1_fn, red_fn, px_res, modifier, out_opts=None, cog=False):
     try:
         if (multi_band_file is not None) & (modifier is not None):
             red_arr, prf, r_ndv = read_file(multi_band_file[:-4] + "_b5_" + modifier + "_refl.tif")
@@ -55,17 +59,18 @@ def run(multi_band_file, out_fn, nir1_fn, red_fn, px_res, modifier):
         try:
             with rio.Env():
                 prf.update(
+                    driver='GTiff',
                     dtype=rio.float32,
-                    count=1,
-                    compress='lzw')
-                with rio.open(out_fn, 'w', **prf) as dst:
+                    count=1)
+                out_profile.update_profile(prf, **(out_opts or {}))
+                with open_raster(out_fn, prf, cog) as dst:
                     dst.write(np.squeeze(ndvi).astype(rio.float32), 1)
-                with rio.open(out_fn[:-4]+"_minmax.tif", 'w', **prf) as dst:
+                with open_raster(out_fn[:-4]+"_minmax.tif", prf, cog) as dst:
                     dst.write(np.squeeze(ndvi_norm).astype(rio.float32), 1)
 
-                with rio.open(out_fn[:-4]+"_RE.tif", 'w', **prf) as dst:
+                with open_raster(out_fn[:-4]+"_RE.tif", prf, cog) as dst:
                     dst.write(np.squeeze(ndvi_RE).astype(rio.float32), 1)
-                with rio.open(out_fn[:-4]+"_RE_minmax.tif", 'w', **prf) as dst:
+                with open_raster(out_fn[:-4]+"_RE_minmax.tif", prf, cog) as dst:
                     dst.write(np.squeeze(ndvi_norm_RE).astype(rio.float32), 1)
         except:
             print("Cannot write out calculated NDVI")
@@ -80,6 +85,7 @@ def get_parser():
     parser.add_argument('-n', '--nir_band', help='Single-band NIR channel input', required=False)
     parser.add_argument('-res', '--px_res', help='Pixel resolution, default is 1.2m', default="1.2", required=False)
     parser.add_argument('-m', '--mod', help='Modifiers to single band filenames')
+    out_profile.add_args(parser)
     return parser
 
 def main():
@@ -102,7 +108,7 @@ def main():
         modifier=args.mod + "_" + px_res[0]+px_res[-1]
 
 #     print(in_fn, out_fn, nir1_fn, red_fn, px_res, modifier)
-    run(in_fn, out_fn, nir1_fn, red_fn, px_res, modifier)
+    run(in_fn, out_fn, nir1_fn, red_fn, px_res, modifier, out_profile.from_args(args), args.cog)
     
 if __name__ == "__main__":    
     main()
\ No newline at end of file
@@ -12,6 +12,10 @@ import numpy as np
 import rasterio as rio
 import sys
 
+from refl_io import read_refl
+import out_profile
+from cog import open_raster
+
 def get_parser():
     parser = argparse.ArgumentParser(description='Normalized Difference Water Index Calculation Script')
     parser.add_argument('-in', '--MS_input_file', help='Multiband MS image file', required=False)
@@ -20,11 +24,12 @@ def get_parser():
     parser.add_argument('-n', '--nir_band', help='Single-band NIR channel input', required=False)
     parser.add_argument('-res', '--px_res', help='Pixel resolution, default is 1.2m', default="1.2", required=False)
     parser.add_argument('-m', '--mod', help='Modifiers to single band filenames')
+    out_profile.add_args(parser)
     return parser
 
 def read_file(fn):
     with rio.open(fn) as f:
-        arr=f.read()
+        arr=read_refl(f)
         prf=f.profile
         ndv=f.nodata
     return arr, prf, ndv
@@ -52,7 +57,7 @@ def calc_ndwi(green_arr, nir2_arr, g_ndv=None, nir2_ndv=None):
 
 def run(multi_band_file=None, out_fn=None, 
         nir2_fn=None, green_fn=None, 
-        px_res="1.2", modifier=None):
+        px_res="1.2", modifier=None, out_opts=None, cog=False):
     print(multi_band_file, out_fn, nir2_fn, green_fn, px_res, modifier)
     try:
         if (multi_band_file is not None) & (modifier is not None):
@@ -71,12 +76,13 @@ def run(multi_band_file=None, out_fn=None,
         try:
             with rio.Env():
                 prf.update(
+                    driver='GTiff',
                     dtype=rio.float32,
-                    count=1,
-                    compress='lzw')
-                with rio.open(out_fn, 'w', **prf) as dst:
+                    count=1)
+                out_profile.update_profile(prf, **(out_opts or {}))
+                with open_raster(out_fn, prf, cog) as dst:
                     dst.write(np.squeeze(ndwi).astype(rio.float32), 1)
-                with rio.open(out_fn[:-4]+"_minmax.tif", 'w', **prf) as dst:
+                with open_raster(out_fn[:-4]+"_minmax.tif", prf, cog) as dst:
                     dst.write(np.squeeze(ndwi_norm).astype(rio.float32), 1)
         except:
             print("Cannot write out calculated NDWI")
@@ -107,7 +113,7 @@ def main():
     
     run(multi_band_file=in_fn, out_fn=out_fn, 
         nir2_fn=nir2_fn, green_fn=green_fn, 
-        px_res=px_res, modifier=modifier)
+        px_res=px_res, modifier=modifier, out_opts=out_profile.from_args(args), cog=args.cog)
     
 if __name__ == "__main__":    
     main()
@@ -17,10 +17,9 @@ cleanup=true
 
 # Extract geographic coordinates for the input image
 GCS_file=GCS_coords.txt
-dem_list=dem_list.txt
 utm_file=utm_zone.txt
-utm_list=utm_list.txt
-new_dem_list=same_proj.txt
+ned_list=ned_list.txt
+ned_utm=ned_utm.csv
 
 # Extract UTM zone epsg code from image center
 python $HOME/git_dirs/rs_tools/bin/utm_convert.py -in ${img} | tail -n 1 | tee ${utm_file} 
@@ -29,6 +28,7 @@ while read z
 do
   zone=${z}
 done < ${utm_file}
+img_zone=${zone}
 
 # Get NED filenames for this input image
 python $HOME/git_dirs/NED_download/bin/get_NED.py -in ${img} -NED 13 2>&1 | tee ${GCS_file}
@@ -36,65 +36,32 @@ python $HOME/git_dirs/NED_download/bin/get_NED.py -in ${img} -NED 13 2>&1 | tee
 while read NED_filename
 do
     NED=$(echo ${NED_filename} | tr "/" "\n" | tail -1)
-    python $HOME/git_dirs/rs_tools/bin/utm_convert.py -in ${NED%.*}.img | tail -n 1 | tee ${utm_file} >> ${utm_list}
-
-    while read z
-    do
-      zone=${z}
-    done < ${utm_file}
-    
-    dem=${NED%.*}-adj_${zone}.tif
-    echo ${dem} >> ${dem_list}
-    
-done < ${GCS_file}
+    echo ${NED%.*}.img
+done < ${GCS_file} > ${ned_list}
 
-dem_vrt=${img%.*}_NED_13.vrt
+# UTM zone of every NED tile from one utm_convert run: CSV rows of path,epsg,...
+python $HOME/git_dirs/rs_tools/bin/utm_convert.py -list ${ned_list} -fmt csv | tail -n +2 | tee ${ned_utm}
 
-if [ ! -f ${dem_vrt} ]; then
-
-    # Check that all projections are the same -- starting with 32 for UTM zones
-    dems=$(grep '32' ${utm_list} | sort | uniq | wc -l)
-    if [ ! ${dems} == "1" ] ; then
-        echo "Heterogeneous projections detected, select one"
-
-        # Figure out which version to use based on utm zone of center of image
-        python $HOME/git_dirs/rs_tools/bin/utm_convert.py -in ${img} | tail -n 1 | tee ${utm_file} 
-
-        while read z
-        do
-            zone=${z}
-        done < ${utm_file}
-        
-        # Use this projection as the main projection
-        while read NED_filename
-        do
-            NED=$(echo ${NED_filename} | tr "/" "\n" | tail -1)
-            
-            dem=${NED%.*}-adj_${zone}.tif
-            echo ${dem} >> ${new_dem_list}
-
-            if [ ! -f ${dem} ] ; then
-                if [ ! -f ${NED%.*}-adj.img ] ; then
-                    dem_geoid --reverse-adjustment ${NED%.*}.img ; 
-                fi
-                gdalwarp -co COMPRESS=LZW -co TILED=YES -co BIGTIFF=IF_SAFER -overwrite \
-                -r cubic -t_srs EPSG:${zone} -dstnodata -9999 -tr 10 10 ${NED%.*}-adj.tif ${dem}
-            fi
-            
-        done < ${GCS_file}
-        dem_list=${new_dem_list}
-    fi
-    
-    echo "Building vrt of dems..."
-    gdalbuildvrt -input_file_list ${dem_list} ${dem_vrt}
-    echo "vrt successfully built"
-    
+# Check that all projections are the same -- starting with 32 for UTM zones
+zones=$(cut -d, -f2 ${ned_utm} | grep '^32' | sort | uniq)
+if [ -n "${zones}" ] && [ "$(echo "${zones}" | wc -l)" == "1" ] ; then
+    zone=${zones}
 else
-    echo "NED vrt already exists"
+    echo "Heterogeneous projections detected, select one"
+    # Use the utm zone of the center of the image as the main projection
+    zone=${img_zone}
 fi
 
+dem_vrt=${img%.*}_NED_13.vrt
+
+# Geoid adjustment and reprojection of the tiles in parallel, reusing tiles cached by earlier runs
+# (the vrt points into the cache, so it is rebuilt every run)
+echo "Building vrt of dems..."
+python $HOME/git_dirs/rs_tools/bin/dem_prep.py -list ${ned_list} -epsg ${zone} -out ${dem_vrt}
+echo "vrt successfully built"
+
 $HOME/git_dirs/wv3_classification/code/working/wv3_ortho_resample.sh $img $dem_vrt "1.24" ${zone}
 
 if $cleanup ; then
-    rm ${utm_file} ${GCS_file} ${NED_names} ${dem_list}
+    rm ${utm_file} ${GCS_file} ${NED_names} ${ned_list} ${ned_utm}
 fi
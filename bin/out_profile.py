@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Shared GeoTIFF output options: codec, compression level, predictor, block size and GDAL
+# multi-threaded compression. Writers build their profile as before and pass it through
+# update_profile; add_args/from_args give every script the same command line options.
+# The defaults (LZW, no predictor, 512x512 tiles) reproduce the files the scripts always wrote.
+
+import numpy as np
+
+# Codec: creation option holding its level (None if it has none)
+CODECS = {
+'lzw': None,
+'deflate': 'zlevel',
+'zstd': 'zstd_level',
+'lerc': None,
+'lerc_deflate': 'zlevel',
+'lerc_zstd': 'zstd_level',
+'none': None,
+}
+
+# Keys that may be inherited from an input profile and no longer apply
+STALE_KEYS = ('predictor', 'zlevel', 'zstd_level', 'max_z_error', 'num_threads', 'jpeg_quality')
+
+def default_predictor(codec, dtype):
+    """Horizontal differencing (2) for integers and floating point prediction (3) for floats with
+    DEFLATE/ZSTD; none for LZW (the historical output), LERC and uncompressed files"""
+    if codec not in ('deflate', 'zstd'):
+        return None
+    return 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+
+def update_profile(profile, codec='lzw', level=None, predictor=None, block=None, threads=None, max_z_error=None):
+    """Set the compression options of a write profile in place and return it.
+
+    codec:       one of CODECS
+    level:       zlevel (1-12) for deflate, zstd_level (1-22) for zstd
+    predictor:   1, 2 or 3; None picks default_predictor for the profile dtype
+    block:       tile edge length, multiple of 16 (None keeps the profile's blocks)
+    threads:     GDAL compression threads, an int or 'ALL_CPUS'
+    max_z_error: LERC maximum error, 0 is lossless
+    """
+    codec = codec.lower()
+    if codec not in CODECS:
+        raise ValueError("Unknown codec %s, expected one of %s" % (codec, ', '.join(CODECS)))
+    for key in STALE_KEYS:
+        profile.pop(key, None)
+
+    profile['compress'] = codec
+    if (level is not None) & (CODECS[codec] is not None):
+        profile[CODECS[codec]] = level
+    if predictor is None:
+        predictor = default_predictor(codec, profile['dtype'])
+    if (predictor is not None) & (codec != 'none') & (not codec.startswith('lerc')):
+        profile['predictor'] = predictor
+    if codec.startswith('lerc'):
+        profile['max_z_error'] = 0 if max_z_error is None else max_z_error
+    if threads is not None:
+        profile['num_threads'] = threads
+    if block is not None:
+        if block % 16:
+            raise ValueError("Block size must be a multiple of 16, got %d" % block)
+        profile.update(tiled=True, blockxsize=block, blockysize=block)
+    return profile
+
+def add_args(parser):
+    """Add the output options to an argparse parser"""
+    parser.add_argument('-codec', '--codec', help='GeoTIFF compression, default is lzw', choices=list(CODECS), default='lzw')
+    parser.add_argument('-level', '--level', help='Compression level for deflate/zstd', type=int)
+    parser.add_argument('-predictor', '--predictor', help='TIFF predictor (1 none, 2 integer, 3 float), default is 3 for float deflate/zstd output',
+                        type=int, choices=[1, 2, 3])
+    parser.add_argument('-block', '--block', help='Output tile size, default is 512', type=int)
+    parser.add_argument('-threads', '--threads', help="GDAL compression threads, number or ALL_CPUS")
+    parser.add_argument('-zerr', '--max_z_error', help='LERC maximum error, default is 0 (lossless)', type=float)
+    parser.add_argument('-cog', '--cog', help='Write Cloud-Optimized GeoTIFFs with internal overviews built while writing', action='store_true')
+    return parser
+
+def from_args(args):
+    """update_profile keyword arguments from parsed add_args options (-cog is read by the writers)"""
+    return dict(codec=args.codec, level=args.level, predictor=args.predictor, block=args.block,
+                threads=args.threads, max_z_error=args.max_z_error)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# Scaled integer reflectance: reflectance is stored as int16 = round(refl / SCALE) with
+# INT16_NODATA as nodata, and the GeoTIFF band scale/offset metadata records SCALE.
+# read_refl returns float32 reflectance for these files and plain reads for everything else.
+
+import numpy as np
+
+# Reflectance [0, ~1.2] x 10000 fits int16 with 1e-4 resolution
+SCALE = 1e-4
+INT16_NODATA = -32768
+
+def int16_profile(profile):
+    """Update a write profile for scaled int16 reflectance"""
+    profile.update(dtype='int16', nodata=INT16_NODATA)
+    return profile
+
+def set_scales(dst):
+    """Record the int16 scale factor in every band's metadata"""
+    dst.scales = [SCALE] * dst.count
+    dst.offsets = [0.0] * dst.count
+
+def to_int16(refl, ndv=None):
+    """Scale float reflectance to int16; pixels equal to ndv (and NaN) become INT16_NODATA"""
+    scaled = np.rint(refl / SCALE)
+    np.clip(scaled, -32767, 32767, out=scaled)
+    out = scaled.astype(np.int16)
+    if ndv is not None:
+        out[refl == ndv] = INT16_NODATA
+    out[np.isnan(refl)] = INT16_NODATA
+    return out
+
+def is_scaled(f):
+    """True for integer rasters with a non-unit scale or non-zero offset in their band metadata"""
+    return (np.issubdtype(np.dtype(f.dtypes[0]), np.integer)
+            and any((s != 1.0) | (o != 0.0) for s, o in zip(f.scales, f.offsets)))
+
+def unscale(arr, scales, offsets, ndv=None):
+    """float32 arr * scale + offset, band by band; ndv pixels keep the value ndv"""
+    scales = np.asarray(scales, dtype=np.float32)
+    offsets = np.asarray(offsets, dtype=np.float32)
+    if arr.ndim == 3:
+        scales = scales.reshape(-1, 1, 1)
+        offsets = offsets.reshape(-1, 1, 1)
+    out = np.multiply(arr, scales, dtype=np.float32)
+    np.add(out, offsets, out=out)
+    if ndv is not None:
+        np.copyto(out, np.float32(ndv), where=(arr == ndv))
+    return out
+
+def read_refl(f, indexes=None, window=None):
+    """Read like f.read(indexes, window=window), returning float32 reflectance for scaled integer files.
+    A whole-file read of a scaled file is unscaled block by block into one float32 array.
+    """
+    if not is_scaled(f):
+        return f.read(indexes, window=window)
+
+    bands = list(range(1, f.count + 1)) if indexes is None else np.atleast_1d(indexes).tolist()
+    scales = [f.scales[i-1] for i in bands]
+    offsets = [f.offsets[i-1] for i in bands]
+    if window is not None:
+        return unscale(f.read(indexes, window=window), scales, offsets, f.nodata)
+
+    shape = (f.height, f.width) if np.isscalar(indexes) else (len(bands), f.height, f.width)
+    out = np.empty(shape, dtype=np.float32)
+    for ij, w in f.block_windows(1):
+        rows, cols = w.toslices()
+        out[..., rows, cols] = unscale(f.read(indexes, window=w), scales, offsets, f.nodata)
+    return out
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+# Resumable batch processing of many WorldView scenes: TOA reflectance of each band -> indices -> optional ortho.
+# Each scene becomes a small task graph:
+#   toa      one task per band needed by the indices (wv_TOA_refl.main_stream), writing the per-band
+#            _b<n>_<mod>_refl.tif files next to the image, as wv_TOA_refl.py -split does
+#   indices  one task per scene (indices.run), reading every band file once for all indices
+#   ortho    with -ortho, ortho.sh on the image once its indices are done
+# Tasks run in one process pool per stage (-n_toa, -n_idx, -n_ortho workers) as soon as the tasks they
+# depend on are done, so scenes flow through the stages instead of each stage waiting for the whole batch.
+# Every finished task is appended to a JSON lines manifest with a fingerprint of its options; a rerun skips
+# tasks recorded as done with the same options whose outputs still exist, so a crashed or interrupted batch
+# resumes where it stopped, and changing e.g. -int16 or -codec redoes the affected tasks. Tasks depending on
+# a failed task are skipped and retried on the next run.
+
+# USAGE:
+# python rs_batch.py -in '/data/order/*_M1BS_*.TIF' -idx ndvi ndwi -manifest batch.jsonl
+# python rs_batch.py -list scenes.txt -out_dir indices -n_toa 8 -n_idx 4 -ortho -n_ortho 1
+# scenes.txt lists one MS image per line, optionally followed by its SWIR image (for ndsi)
+
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import heapq
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import ExitStack
+from datetime import datetime
+
+import rasterio as rio
+
+import out_profile
+import indices
+from wv_TOA_refl import band_codes, band_fn, get_modifier, main_stream
+
+ORTHO_SH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ortho.sh')
+
+def find_xml(img_fn):
+    """DigitalGlobe xml next to an image (.xml or .XML)"""
+    for ext in ('.xml', '.XML'):
+        if os.path.exists(os.path.splitext(img_fn)[0] + ext):
+            return os.path.splitext(img_fn)[0] + ext
+    sys.exit("No xml file for %s" % img_fn)
+
+def read_scenes(patterns=None, list_fn=None):
+    """[(MS image, SWIR image or None), ...] from glob patterns and/or a list file, in order, each scene once"""
+    scenes = []
+    for pattern in patterns or []:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            sys.exit("No files match %s" % pattern)
+        scenes += [(fn, None) for fn in matches]
+    if list_fn is not None:
+        with open(list_fn) as f:
+            for line in f:
+                fields = line.split()
+                if fields and not fields[0].startswith('#'):
+                    scenes.append((fields[0], fields[1] if len(fields) > 1 else None))
+    out, seen = [], set()
+    for ms_fn, swir_fn in scenes:
+        ms_fn = os.path.abspath(ms_fn)
+        if ms_fn not in seen:
+            seen.add(ms_fn)
+            out.append((ms_fn, os.path.abspath(swir_fn) if swir_fn else None))
+    return out
+
+def toa_task(in_fn, xml_fn, n, out_fn, f32=False, int16=False, out_opts=None, cog=False):
+    """TOA reflectance of band n (1-based) of in_fn"""
+    with rio.open(in_fn) as f:
+        code = band_codes(xml_fn, f.count)[n - 1]
+    main_stream(in_fn, xml_fn, code, out_fn, f32=f32, int16=int16, out_opts=out_opts, cog=cog, bidx=n)
+
+def indices_task(names, srcs, outs, out_opts=None, cog=False):
+    os.makedirs(os.path.dirname(outs[names[0]][0]), exist_ok=True)
+    indices.run(names, srcs, outs, out_opts, cog)
+
+def ortho_task(img_fn):
+    """ortho.sh writes its temporary files to the working directory, so it runs in the image's directory"""
+    subprocess.run(['bash', ORTHO_SH, img_fn], cwd=os.path.dirname(img_fn), check=True)
+
+def fingerprint(params):
+    """sha1 of the options that change a task's outputs (everything but its paths)"""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def task(stage, func, args, deps=(), outputs=(), params=None):
+    return dict(stage=stage, func=func, args=args, deps=list(deps), outputs=list(outputs),
+                params=fingerprint(params or dict()))
+
+def build_tasks(scenes, names=None, out_dir=None, modifier='12', ortho=False, f32=False, int16=False,
+                out_opts=None, cog=False):
+    """Task graph of every scene as an ordered {task id: task} dict (dependencies listed before dependents).
+    names are the indices (default ndvi ndvi_RE ndwi, plus ndsi for scenes with a SWIR image); index images
+    go to out_dir/<scene name>/, or to <scene name>_indices/ next to the image."""
+    # threads only changes speed, so changing it does not redo finished tasks
+    opts = dict((k, v) for k, v in (out_opts or dict()).items() if k != 'threads')
+    toa_params = dict(f32=f32, int16=int16, out_opts=opts, cog=cog)
+    tasks = dict()
+    for ms_fn, swir_fn in scenes:
+        scene_names = names
+        if scene_names is None:
+            scene_names = ['ndvi', 'ndvi_RE', 'ndwi'] + (['ndsi'] if swir_fn is not None else [])
+        inputs = {'ms': ms_fn, 'swir': swir_fn}
+        stem = os.path.splitext(os.path.basename(ms_fn))[0]
+
+        srcs = dict()
+        for band in indices.required_bands(scene_names):
+            image, n = indices.BANDS[band]
+            if inputs[image] is None:
+                sys.exit("%s needs a SWIR image for %s" % (ms_fn, band))
+            srcs[band] = band_fn(inputs[image], n, modifier)
+            tid = 'toa:%s:b%d' % (inputs[image], n)
+            tasks[tid] = task('toa', toa_task, (inputs[image], find_xml(inputs[image]), n, srcs[band], f32, int16, out_opts, cog),
+                              outputs=[srcs[band]], params=toa_params)
+
+        scene_dir = os.path.join(out_dir, stem) if out_dir is not None else os.path.splitext(ms_fn)[0] + '_indices'
+        outs = indices.out_names(scene_names, scene_dir)
+        idx_id = 'indices:%s' % ms_fn
+        tasks[idx_id] = task('indices', indices_task, (scene_names, srcs, outs, out_opts, cog),
+                             deps=['toa:%s:b%d' % (inputs[indices.BANDS[b][0]], indices.BANDS[b][1]) for b in srcs],
+                             outputs=[fn for name in scene_names for fn in outs[name]],
+                             params=dict(indices=scene_names, out_opts=opts, cog=cog))
+
+        if ortho:
+            tasks['ortho:%s' % ms_fn] = task('ortho', ortho_task, (ms_fn,), deps=[idx_id])
+    return tasks
+
+def read_manifest(manifest_fn):
+    """{task id: last manifest record}; a truncated last line (crash while writing) is ignored"""
+    records = dict()
+    if not os.path.exists(manifest_fn):
+        return records
+    with open(manifest_fn) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            records[rec['task']] = rec
+    return records
+
+def is_done(rec, t):
+    """Recorded as done with the same parameters, and its outputs still exist"""
+    return (rec is not None and rec.get('status') == 'done' and rec.get('params') == t['params']
+            and all(os.path.exists(fn) for fn in t['outputs']))
+
+def log_task(log, tid, t, status, seconds, error=None):
+    rec = dict(task=tid, stage=t['stage'], status=status, params=t['params'], outputs=t['outputs'], seconds=round(seconds, 3),
+               time=datetime.now().isoformat(timespec='seconds'))
+    if error is not None:
+        rec['error'] = error
+    log.write(json.dumps(rec) + '\n')
+    log.flush()
+    os.fsync(log.fileno())
+
+def timed(func, args):
+    t0 = time.time()
+    func(*args)
+    return time.time() - t0
+
+def run(tasks, manifest_fn, workers, dry_run=False):
+    """Run the tasks not yet done according to manifest_fn, at most workers[stage] at a time per stage.
+    Returns {status: number of tasks} with statuses done (this run), skipped (done earlier), failed, blocked."""
+    records = read_manifest(manifest_fn)
+    # a task whose inputs are redone is redone too (tasks are in graph order)
+    done = set()
+    for tid, t in tasks.items():
+        if is_done(records.get(tid), t) and all(d in done for d in t['deps']):
+            done.add(tid)
+    todo = [tid for tid in tasks if tid not in done]
+    counts = dict(done=0, skipped=len(done), failed=0, blocked=0)
+    changed = sum(1 for tid in todo if tid in records and records[tid].get('status') == 'done'
+                  and records[tid].get('params') != tasks[tid]['params'])
+    print("%d tasks, %d already done, %d to run" % (len(tasks), len(done), len(todo)))
+    if changed:
+        print("%d tasks done earlier with other options are run again" % changed)
+    if dry_run:
+        for tid in todo:
+            print(tid)
+        return counts
+
+    # Unmet dependencies of each task to run and the tasks waiting on each one, so a finished task only
+    # touches its own dependents; ready tasks wait in per-stage heaps in graph order (earlier scenes first)
+    order = dict((tid, i) for i, tid in enumerate(todo))
+    dependents = dict((tid, []) for tid in todo)
+    unmet = dict()
+    stages = set(tasks[tid]['stage'] for tid in todo)
+    ready = dict((stage, []) for stage in stages)
+    for tid in todo:
+        deps = [d for d in tasks[tid]['deps'] if d not in done]
+        unmet[tid] = len(deps)
+        for d in deps:
+            dependents[d].append(tid)
+        if not deps:
+            ready[tasks[tid]['stage']].append((order[tid], tid))
+    failed = set()
+
+    def block(tid):
+        """Skip every task depending on the failed task tid, directly or not"""
+        stack = list(dependents[tid])
+        while stack:
+            dep = stack.pop()
+            if dep in failed:
+                continue
+            failed.add(dep)
+            counts['blocked'] += 1
+            print("Skipping %s: a task it depends on failed" % dep, file=sys.stderr)
+            stack += dependents[dep]
+
+    with ExitStack() as stack:
+        log = stack.enter_context(open(manifest_fn, 'a'))
+        pools = dict((stage, stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=workers[stage])))
+                     for stage in stages)
+        running = dict()    # future -> (task id, start time)
+        busy = dict((stage, 0) for stage in stages)
+        while True:
+            for stage, queue in ready.items():
+                while queue and busy[stage] < workers[stage]:
+                    tid = heapq.heappop(queue)[1]
+                    t = tasks[tid]
+                    running[pools[stage].submit(timed, t['func'], t['args'])] = (tid, time.time())
+                    busy[stage] += 1
+            if not running:
+                break
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                tid, start = running.pop(future)
+                t = tasks[tid]
+                busy[t['stage']] -= 1
+                try:
+                    seconds = future.result()
+                    error = None
+                    missing = [fn for fn in t['outputs'] if not os.path.exists(fn)]
+                    if missing:
+                        error = 'Missing outputs: %s' % ', '.join(missing)
+                except BaseException as e:
+                    # including sys.exit() calls in the processing scripts
+                    seconds = time.time() - start
+                    error = '%s: %s' % (type(e).__name__, e)
+                if error is not None:
+                    failed.add(tid)
+                    counts['failed'] += 1
+                    log_task(log, tid, t, 'failed', seconds, error)
+                    print("Failed %s: %s" % (tid, error), file=sys.stderr)
+                    block(tid)
+                    continue
+                done.add(tid)
+                counts['done'] += 1
+                log_task(log, tid, t, 'done', seconds)
+                print("Done %s (%.1f s)" % (tid, seconds))
+                for dep in dependents[tid]:
+                    unmet[dep] -= 1
+                    if unmet[dep] == 0 and dep not in failed:
+                        heapq.heappush(ready[tasks[dep]['stage']], (order[dep], dep))
+    return counts
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Resumable TOA reflectance, index and ortho batch runs over many WorldView scenes')
+    parser.add_argument('-in', '--input_files', help='MS images or glob patterns (quoted)', nargs='+')
+    parser.add_argument('-list', '--scene_list', help='Text file with one MS image per line, optionally followed by its SWIR image')
+    parser.add_argument('-idx', '--indices', help='Indices to calculate, default is ndvi ndvi_RE ndwi (and ndsi for scenes with SWIR)',
+                        nargs='+', choices=list(indices.INDICES))
+    parser.add_argument('-out_dir', '--output_dir', help='Index images go to out_dir/<scene>/, default is <scene>_indices/ next to the image')
+    parser.add_argument('-manifest', '--manifest', help='JSON lines record of finished tasks, default is rs_batch_manifest.jsonl',
+                        default='rs_batch_manifest.jsonl')
+    parser.add_argument('-ortho', '--ortho', help='Run ortho.sh on each image after its indices', action='store_true')
+    parser.add_argument('-n_toa', '--toa_workers', help='Concurrent TOA tasks, default is the number of CPUs', type=int)
+    parser.add_argument('-n_idx', '--index_workers', help='Concurrent index tasks, default is the number of CPUs', type=int)
+    parser.add_argument('-n_ortho', '--ortho_workers', help='Concurrent ortho tasks, default is 1', type=int, default=1)
+    parser.add_argument('-res', '--px_res', help='Pixel resolution for per-band filenames, default is 1.2m', default="1.2")
+    parser.add_argument('-m', '--mod', help='Modifiers to per-band filenames')
+    parser.add_argument('-int16', '--int16', help='Write reflectance x 10000 as int16 with scale metadata instead of float32', action='store_true')
+    parser.add_argument('-f32', '--f32', help='Float32 folded TOA kernel (differences ~1e-7)', action='store_true')
+    parser.add_argument('-dry_run', '--dry_run', help='Only print the tasks that would run', action='store_true')
+    out_profile.add_args(parser)
+    return parser
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if not (args.input_files or args.scene_list):
+        parser.error("Give scenes with -in and/or -list")
+
+    scenes = read_scenes(args.input_files, args.scene_list)
+    out_dir = os.path.abspath(args.output_dir) if args.output_dir else None
+    tasks = build_tasks(scenes, args.indices, out_dir, get_modifier(args.px_res, args.mod), args.ortho,
+                        args.f32, args.int16, out_profile.from_args(args), args.cog)
+    ncpu = os.cpu_count() or 1
+    workers = dict(toa=args.toa_workers or ncpu, indices=args.index_workers or ncpu, ortho=args.ortho_workers)
+    for stage, n in workers.items():
+        if n < 1:
+            parser.error("Number of %s workers must be at least 1" % stage)
+
+    print("%d scenes" % len(scenes))
+    counts = run(tasks, args.manifest, workers, args.dry_run)
+    print("%(done)d done, %(skipped)d already done, %(failed)d failed, %(blocked)d skipped after failures" % counts)
+    if counts['failed']:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+# Slope, aspect, TRI and roughness of a DEM in one pass, replacing the four gdaldem runs of topo_var.sh.
+# The DEM is read once per output block with a 1 pixel halo and all products are computed from the same
+# 3x3 neighbourhood, using the gdaldem formulas (Horn slope/aspect, Riley or Wilson TRI, max - min
+# roughness). Like gdaldem without -compute_edges, pixels with a nodata or off-raster neighbour are
+# -9999 in every output. With -n > 1 blocks are computed in a process pool.
+
+# With -scales, local statistics over k x k windows (mean, std, range and RMS TRI) are written for every
+# k, at a cost per pixel that does not depend on k: sums come from integral images computed once per
+# block, and the range from separable van Herk/Gil-Werman running max/min. Blocks are read with a halo of
+# k // 2 for the largest k, so memory stays bounded for any DEM size. These statistics skip nodata and
+# off-raster pixels in the window; they are only -9999 where the centre pixel is nodata.
+
+# USAGE:
+# python terrain.py -in dem.tif
+# python terrain.py -in dem.tif -products slope TRI -tri wilson -n 8 -out_dir terrain/
+# python terrain.py -in dem.tif -scales 5 11 21 51 101 -stats std range tri -n 8
+
+import argparse
+import concurrent.futures
+import os
+import sys
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+
+import out_profile
+from cog import open_raster
+from window_sched import run_windows
+
+PRODUCTS = ('slope', 'aspect', 'TRI', 'roughness')
+
+# Multi-scale window statistics
+STATS = ('mean', 'std', 'range', 'tri')
+
+# Output nodata, as written by gdaldem
+NDV = -9999.
+
+def out_names(dem_fn, products=PRODUCTS, out_dir=None, scales=(), stats=STATS):
+    """Output filenames next to the DEM or in out_dir: {product: dem_<product>.tif} (as written by
+    topo_var.sh) and {(stat, k): dem_<stat>_<k>.tif} for the multi-scale statistics"""
+    base = os.path.splitext(dem_fn)[0]
+    if out_dir is not None:
+        base = os.path.join(out_dir, os.path.basename(base))
+    outs = dict((p, '%s_%s.tif' % (base, p)) for p in products)
+    for k in scales:
+        for stat in stats:
+            outs[(stat, k)] = '%s_%s_%d.tif' % (base, stat, k)
+    return outs
+
+def read_halo(src, window, halo=1, band=1):
+    """Window of the DEM with a halo of halo pixels as float64, nodata and pixels off the raster as NaN"""
+    r0, c0 = int(window.row_off), int(window.col_off)
+    h, w = int(window.height), int(window.width)
+    rr0, rr1 = max(r0 - halo, 0), min(r0 + h + halo, src.height)
+    cc0, cc1 = max(c0 - halo, 0), min(c0 + w + halo, src.width)
+    z = src.read(band, window=Window(cc0, rr0, cc1 - cc0, rr1 - rr0)).astype(np.float64)
+    if src.nodata is not None:
+        z[z == src.nodata] = np.nan
+    pad = ((rr0 - (r0 - halo), (r0 + h + halo) - rr1), (cc0 - (c0 - halo), (c0 + w + halo) - cc1))
+    return np.pad(z, pad, constant_values=np.nan)
+
+def calc_terrain(z, ewres, nsres, products=PRODUCTS, scale=1., slope_pct=False, tri='riley', zero_for_flat=False):
+    """Terrain products of the interior of z, an (h+2, w+2) array with NaN for nodata.
+
+    ewres, nsres:   geotransform pixel sizes (nsres is negative for north-up rasters)
+    scale:          ratio of vertical to horizontal units (gdaldem -s), e.g. 111120 for meters over degrees
+    slope_pct:      slope in percent instead of degrees
+    tri:            'riley' (root of summed squared differences, gdaldem default) or 'wilson' (mean absolute difference)
+    zero_for_flat:  aspect 0 instead of nodata for flat pixels
+    Returns {product: float32 array of the interior shape, NDV for nodata}
+    """
+    # 3x3 neighbourhood, row by row: a b c / d e f / g h i
+    a, b, c = z[:-2, :-2], z[:-2, 1:-1], z[:-2, 2:]
+    d, e, f = z[1:-1, :-2], z[1:-1, 1:-1], z[1:-1, 2:]
+    g, h, i = z[2:, :-2], z[2:, 1:-1], z[2:, 2:]
+
+    out = dict()
+    with np.errstate(invalid='ignore'):
+        if ('slope' in products) | ('aspect' in products):
+            # Horn: 8 times the west-east and north-south gradients in pixels
+            dx = (c + 2*f + i) - (a + 2*d + g)
+            dy = (g + 2*h + i) - (a + 2*b + c)
+        if 'slope' in products:
+            key = np.hypot(dx / ewres, dy / nsres) / (8 * scale)
+            out['slope'] = 100 * key if slope_pct else np.degrees(np.arctan(key))
+        if 'aspect' in products:
+            # azimuth of the downslope direction, clockwise from north
+            # float32 before the 360 wrap, as in gdaldem
+            aspect = np.degrees(np.arctan2(dy, -dx)).astype(np.float32)
+            aspect = np.where(aspect > 90, 450 - aspect, 90 - aspect)
+            aspect[aspect == 360] = 0
+            aspect[(dx == 0) & (dy == 0)] = 0 if zero_for_flat else np.nan
+            out['aspect'] = aspect
+        if ('TRI' in products) | ('roughness' in products):
+            neighbours = (a, b, c, d, f, g, h, i)
+        if 'TRI' in products:
+            if tri == 'wilson':
+                out['TRI'] = sum(np.abs(n - e) for n in neighbours) / 8
+            else:
+                out['TRI'] = np.sqrt(sum((n - e)**2 for n in neighbours))
+        if 'roughness' in products:
+            # np.maximum/minimum propagate NaN, so any nodata neighbour gives nodata
+            hi, lo = e.copy(), e.copy()
+            for n in neighbours:
+                np.maximum(hi, n, out=hi)
+                np.minimum(lo, n, out=lo)
+            out['roughness'] = hi - lo
+
+    for name, arr in out.items():
+        arr = arr.astype(np.float32)
+        arr[np.isnan(arr)] = NDV
+        out[name] = arr
+    return out
+
+def integral(a):
+    """Integral image of a 2D array, with a leading row and column of zeros"""
+    s = np.zeros((a.shape[0] + 1, a.shape[1] + 1))
+    np.cumsum(np.cumsum(a, axis=0), axis=1, out=s[1:, 1:])
+    return s
+
+def box_sum(s, halo, r, shape):
+    """Sums over the (2r+1) x (2r+1) windows centred on the interior pixels (shape) of an array with
+    a halo of halo pixels, from its integral image s: four lookups per pixel whatever r"""
+    o, k = halo - r, 2*r + 1
+    rows, cols = shape
+    return (s[o+k:o+k+rows, o+k:o+k+cols] - s[o:o+rows, o+k:o+k+cols]
+            - s[o+k:o+k+rows, o:o+cols] + s[o:o+rows, o:o+cols])
+
+def running_max(a, k, axis):
+    """Maximum over every run of k elements along axis (output shorter by k - 1), van Herk/Gil-Werman:
+    prefix and suffix maxima within blocks of k, so three comparisons per element whatever k"""
+    a = np.moveaxis(a, axis, -1)
+    n = a.shape[-1]
+    m = -(-n // k) * k
+    blocks = np.concatenate([a, np.full(a.shape[:-1] + (m - n,), -np.inf)], axis=-1).reshape(a.shape[:-1] + (m // k, k))
+    prefix = np.maximum.accumulate(blocks, axis=-1).reshape(a.shape[:-1] + (m,))
+    suffix = np.maximum.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1].reshape(a.shape[:-1] + (m,))
+    # run [j, j+k) spans the end of one block and the start of the next
+    out = np.maximum(suffix[..., :n-k+1], prefix[..., k-1:n])
+    return np.moveaxis(out, -1, axis)
+
+def box_range(z, halo, r):
+    """max - min over the (2r+1) x (2r+1) windows centred on the interior pixels, NaN ignored"""
+    k = 2*r + 1
+    o = halo - r
+    sub = z[o:z.shape[0]-o, o:z.shape[1]-o]
+    nan = np.isnan(sub)
+    hi = running_max(running_max(np.where(nan, -np.inf, sub), k, 0), k, 1)
+    lo = -running_max(running_max(np.where(nan, -np.inf, -sub), k, 0), k, 1)
+    return hi - lo
+
+def calc_multiscale(z, halo, scales, stats=STATS):
+    """Window statistics of the interior of z (NaN for nodata, halo >= max(scales) // 2) for odd window
+    sizes k in scales, ignoring NaN in the windows:
+        mean, std:  of the valid pixels
+        range:      max - min (local relief)
+        tri:        root mean square difference between the neighbours and the centre pixel
+                    (times sqrt(8) at k = 3 this is the Riley TRI)
+    Returns {(stat, k): float32 array of the interior shape, NDV where the centre pixel is nodata}
+    """
+    shape = (z.shape[0] - 2*halo, z.shape[1] - 2*halo)
+    valid = ~np.isnan(z)
+    # relative to the block mean, so the sums of squares keep their precision
+    ref = z[valid].mean() if valid.any() else 0.
+    z0 = np.where(valid, z - ref, 0.)
+    centre = z0[halo:halo+shape[0], halo:halo+shape[1]]
+    s_n = integral(valid.astype(np.float64))
+    s_1 = integral(z0)
+    s_2 = integral(z0 * z0) if ('std' in stats) | ('tri' in stats) else None
+
+    out = dict()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for k in scales:
+            r = k // 2
+            n = box_sum(s_n, halo, r, shape)
+            mean = box_sum(s_1, halo, r, shape) / n
+            if 'mean' in stats:
+                out[('mean', k)] = mean + ref
+            if s_2 is not None:
+                var = np.maximum(box_sum(s_2, halo, r, shape) / n - mean**2, 0)
+            if 'std' in stats:
+                out[('std', k)] = np.sqrt(var)
+            if 'tri' in stats:
+                # sum of squared differences to the centre is n * (var + (mean - centre)^2), the centre adds 0
+                out[('tri', k)] = np.sqrt((var + (mean - centre)**2) * n / np.maximum(n - 1, 1))
+            if 'range' in stats:
+                out[('range', k)] = box_range(z, halo, r)
+
+    nodata = ~valid[halo:halo+shape[0], halo:halo+shape[1]]
+    for name, arr in out.items():
+        arr = arr.astype(np.float32)
+        arr[nodata] = NDV
+        out[name] = arr
+    return out
+
+def calc_window(z, halo, ewres, nsres, products=PRODUCTS, scales=(), stats=STATS, **kwargs):
+    """3x3 products (kwargs as calc_terrain) and multi-scale statistics of one block read with read_halo"""
+    out = dict()
+    if products:
+        inner = z[halo-1:z.shape[0]-halo+1, halo-1:z.shape[1]-halo+1]
+        out.update(calc_terrain(inner, ewres, nsres, products, **kwargs))
+    if scales:
+        out.update(calc_multiscale(z, halo, scales, stats))
+    return out
+
+# Per-process state for the pool, filled in by init_worker
+_worker = {}
+
+def init_worker(dem_fn, kwargs):
+    """Process pool initializer: open the DEM once and keep it for every block"""
+    _worker['src'] = rio.open(dem_fn)
+    _worker['kwargs'] = kwargs
+
+def compute(window, halo):
+    src = _worker['src']
+    return calc_window(read_halo(src, window, halo), halo, src.transform.a, src.transform.e, **_worker['kwargs'])
+
+def get_profile(prof, out_opts=None):
+    """Output profile of a terrain product: single band float32, nodata -9999, 512x512 tiles"""
+    profile = prof.copy()
+    profile.update(
+        driver='GTiff',
+        dtype=rio.float32,
+        count=1,
+        nodata=NDV,
+        interleave='band',
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        BIGTIFF='IF_SAFER'
+    )
+    out_profile.update_profile(profile, **(out_opts or {}))
+    return profile
+
+def run(dem_fn, outs, scale=1., slope_pct=False, tri='riley', zero_for_flat=False, max_workers=1,
+        out_opts=None, cog=False):
+    """Write the outputs in outs (from out_names) of dem_fn, reading the DEM once"""
+    products = tuple(name for name in outs if name in PRODUCTS)
+    scales = sorted(set(name[1] for name in outs if name not in PRODUCTS))
+    stats = tuple(s for s in STATS if any((s, k) in outs for k in scales))
+    halo = max([1] + [k // 2 for k in scales])
+    kwargs = dict(products=products, scales=scales, stats=stats, scale=scale, slope_pct=slope_pct, tri=tri,
+                  zero_for_flat=zero_for_flat)
+    with rio.Env(), ExitStack() as stack:
+        src = stack.enter_context(rio.open(dem_fn))
+        if src.transform.b or src.transform.d:
+            sys.exit("Rotated DEMs are not supported: %s" % dem_fn)
+        prf = get_profile(src.profile, out_opts)
+        dsts = dict((name, stack.enter_context(open_raster(fn, prf, cog))) for name, fn in outs.items())
+        windows = [window for ij, window in next(iter(dsts.values())).block_windows(1)]
+
+        def write(window, result):
+            for name, arr in result.items():
+                if name in dsts:
+                    dsts[name].write(arr, 1, window=window)
+
+        if max_workers <= 1:
+            for window in windows:
+                write(window, calc_window(read_halo(src, window, halo), halo, src.transform.a, src.transform.e, **kwargs))
+            return
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                                    initargs=(dem_fn, kwargs)) as executor:
+            submit = lambda window: executor.submit(compute, window, halo)
+            run_windows(submit, windows, write, 2 * max_workers)
+
+def odd_size(value):
+    k = int(value)
+    if (k < 3) | (k % 2 == 0):
+        raise argparse.ArgumentTypeError("window sizes must be odd and at least 3, got %s" % value)
+    return k
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Slope, aspect, TRI, roughness and multi-scale window statistics of a DEM in one windowed pass')
+    parser.add_argument('-in', '--input_file', help='DEM raster', required=True)
+    parser.add_argument('-products', '--products', help='3x3 products to write (gdaldem formulas), default is all without -scales, none with it',
+                        nargs='+', choices=PRODUCTS)
+    parser.add_argument('-scales', '--scales', help='Window sizes (odd, e.g. 5 11 21 51 101) for the multi-scale statistics',
+                        nargs='+', type=odd_size, default=[])
+    parser.add_argument('-stats', '--stats', help='Multi-scale statistics, default is all', nargs='+', choices=STATS,
+                        default=list(STATS))
+    parser.add_argument('-out_dir', '--output_dir', help='Output directory, default is next to the DEM')
+    parser.add_argument('-s', '--scale', help='Ratio of vertical to horizontal units (111120 for meters over degrees), default is 1',
+                        type=float, default=1.)
+    parser.add_argument('-slope_pct', '--slope_pct', help='Slope in percent instead of degrees', action='store_true')
+    parser.add_argument('-tri', '--tri', help='TRI algorithm, default is riley (gdaldem default)', choices=['riley', 'wilson'],
+                        default='riley')
+    parser.add_argument('-zero_for_flat', '--zero_for_flat', help='Aspect 0 instead of nodata for flat areas', action='store_true')
+    parser.add_argument('-n', '--number', help='Number of worker processes, default is 1', type=int, default=1)
+    out_profile.add_args(parser)
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    products = args.products
+    if products is None:
+        products = [] if args.scales else list(PRODUCTS)
+    outs = out_names(args.input_file, products, args.output_dir, sorted(set(args.scales)), args.stats)
+    print("Calculating %d outputs for %s" % (len(outs), args.input_file))
+    run(args.input_file, outs, args.scale, args.slope_pct, args.tri, args.zero_for_flat, args.number,
+        out_profile.from_args(args), args.cog)
+    for fn in outs.values():
+        print(fn)
+
+if __name__ == "__main__":
+    main()
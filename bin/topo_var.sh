@@ -25,14 +25,7 @@ fi
 echo "Executing: topo_var.sh $1"
 echo "Calculating topographic variability dem products"
 
-# Slope map
-gdaldem slope $dem ${dem%.*}_slope.tif
-
-# Aspect map
-gdaldem aspect $dem ${dem%.*}_aspect.tif
-
-# Terrain Ruggedness Index (TRI): Terrain Ruggedness Index, which is defined as the mean difference between a central pixel and its surrounding cells
-gdaldem TRI $dem ${dem%.*}_TRI.tif
-
-# Topographic roughness: 3x3 grid around center pixel (8 pixels in neighborhood) with difference in elevation range indicating degree of roughness
-gdaldem roughness $dem ${dem%.*}_roughness.tif
+# Slope, aspect, Terrain Ruggedness Index (TRI) and topographic roughness in one pass over the dem (gdaldem formulas)
+# TRI: Terrain Ruggedness Index, differences between a central pixel and its surrounding cells (Riley, as gdaldem; -tri wilson for the mean difference)
+# Roughness: 3x3 grid around center pixel (8 pixels in neighborhood) with difference in elevation range indicating degree of roughness
+python $HOME/git_dirs/rs_tools/bin/terrain.py -in $dem
@@ -9,10 +9,16 @@
 '''Usage from command line:
 utm_convert.py -in image.tif -L left -B bottom -R right -T top -z T/F (get_utm_zone) -c T/F (get_projected_coordinates)
 output format: print epsg and utm zones 
+utm_convert.py -in a.tif b.tif ... / -list files.txt (- for stdin) [-fmt csv/json] [-coords T]
+output format: one CSV row (with header) or JSON line per input: path,epsg,zone,left,bottom,right,top[,eastings/northings],error
+utm_convert.py -pts points.csv -out zones.csv (one lat, lon per line; -lonlat for lon, lat)
+output format: lat,lon,zone,hemisphere,epsg CSV
 '''
 
-import argparse, gdal, osr, math
+import argparse, math
 import sys, os
+from functools import lru_cache
+from dg_xml import read_xml
 
 def round_down(n, decimals=2):
     '''Function to implement floor function and round down to nearest hundredths place'''
@@ -26,42 +32,56 @@ def round_up(n, decimals=2):
 
 def getTag(xml_fn, tag):
     '''From David Shean's dgtools'''
-    import xml.etree.ElementTree as ET
-    tree = ET.parse(xml_fn)
-
-    # Want to check to make sure tree contains tag
-    elem = tree.find('.//%s' % tag)
-    if elem is not None:
-        return elem.text
+    return read_xml(xml_fn).tag(tag)
 
 def xml_dt(xml_fn):
     '''From David Shean's dgtools'''
-    t = getTag(xml_fn, 'FIRSTLINETIME')
-    dt = datetime.strptime(t,"%Y-%m-%dT%H:%M:%S.%fZ")
-    return dt
+    return read_xml(xml_fn).firstlinetime
 
 def getAllTag(xml_fn, tag):
     '''From David Shean's dgtools'''
-    import xml.etree.ElementTree as ET
-    tree = ET.parse(xml_fn)
-    elem = tree.findall('.//%s' % tag)
-    return [i.text for i in elem]
+    return read_xml(xml_fn).all_tags(tag)
+
+@lru_cache(maxsize=64)
+def get_transformer(src_crs, tgt_crs):
+    '''pyproj Transformer between two CRS strings (e.g. 'epsg:4326' or WKT), built once per pair.
+    Coordinates are always x, y (lon, lat) order.'''
+    from pyproj import Transformer
+    return Transformer.from_crs(src_crs, tgt_crs, always_xy=True)
+
+@lru_cache(maxsize=64)
+def geodetic_crs(crs):
+    '''WKT of the geographic CRS underlying crs (like osr CloneGeogCS)'''
+    from pyproj import CRS
+    return CRS.from_user_input(crs).geodetic_crs.to_wkt()
+
+def crs_key(srs):
+    '''Hashable transformer key for a CRS string or an osr.SpatialReference'''
+    return srs if isinstance(srs, str) else srs.ExportToWkt()
 
-def GetExtent(gt, cols, rows):
+def transform_points(coords, src_crs, tgt_crs):
+    '''Transform [[x,y],...] or an (n, 2) array in one call with the cached transformer.
+    Returns an (n, 2) array.'''
+    import numpy as np
+    xy = np.asarray(coords, dtype=float).reshape(-1, 2)
+    x, y = get_transformer(crs_key(src_crs), crs_key(tgt_crs)).transform(xy[:, 0], xy[:, 1])
+    return np.column_stack([x, y])
+
+def GetExtent(gt, cols, rows, src_crs=None, tgt_crs=None):
     '''Get spatial extent of input raster based on geotransform information.
-    corners:   coordinates of each corner (CCW): TL, BL, BR, TR'''
-    gdal_ext=[]
-    corners=[]
-    xarr=[0,cols]
-    yarr=[0,rows]
-    for px in xarr:
-        for py in yarr:
-            x=gt[0]+(px*gt[1])+(py*gt[2])
-            y=gt[3]+(px*gt[4])+(py*gt[5])
-            corners.append([x,y])
-        yarr.reverse()
-    gdal_ext=[corners[0][0], corners[2][1], corners[2][0], corners[0][1]] # L, B, R, T
-    return gdal_ext, corners
+    corners:   coordinates of each corner (CCW): TL, BL, BR, TR
+    With src_crs and tgt_crs the corners are transformed to tgt_crs and the extent is their bounding box.'''
+    import numpy as np
+    px = np.array([0, 0, cols, cols])
+    py = np.array([0, rows, rows, 0])
+    corners = np.column_stack([gt[0] + px*gt[1] + py*gt[2], gt[3] + px*gt[4] + py*gt[5]])
+    if tgt_crs is None:
+        corners = corners.tolist()
+        gdal_ext=[corners[0][0], corners[2][1], corners[2][0], corners[0][1]] # L, B, R, T
+        return gdal_ext, corners
+    corners = transform_points(corners, src_crs, tgt_crs)
+    gdal_ext = np.concatenate([corners.min(axis=0), corners.max(axis=0)]).tolist()
+    return gdal_ext, corners.tolist()
 
 def ReprojectCoords(coords, src_srs, tgt_srs):
     ''' Function to reproject a list of x,y coordinates.
@@ -73,46 +93,53 @@ def ReprojectCoords(coords, src_srs, tgt_srs):
         @param tgt_srs: OSR SpatialReference object
         @rtype:         C{tuple/list}
         @return:        List of transformed [[x,y],...[x,y]] coordinates
+        CRS strings work too; the transformation is cached per CRS pair (get_transformer).
     '''
-    trans_coords=[]
-    transform = osr.CoordinateTransformation(src_srs, tgt_srs)
-    for x,y in coords:
-        x,y,z = transform.TransformPoint(x,y)
-        trans_coords.append([x,y])
-    return trans_coords
+    return transform_points(coords, src_srs, tgt_srs).tolist()
 
-def get_utm_epsg_code(lat, lon, z=None):
-    import shapely.geometry
+UTM_ZONES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'UTM_Zone_Boundaries.geojson')
+
+class InputError(Exception):
+    '''Raised for points outside every UTM zone polygon'''
+
+@lru_cache(maxsize=None)
+def load_utm_zones(path=UTM_ZONES_PATH):
+    '''Read the UTM zone polygons once: (zone strings such as '10,n', prepared geometries, STRtree),
+    in file order'''
     import json
+    import numpy as np
+    import shapely
+    import shapely.geometry
+
+    with open(path, "r") as f_obj:
+        zones_dict = json.load(f_obj)
+    # Some entries are written '44, n': drop the space so the hemisphere parses as north
+    zone_strs = [feature["properties"]["Zone_Hemi"].replace(" ", "") for feature in zones_dict["features"]]
+    zone_geoms = np.array([shapely.geometry.shape(feature["geometry"]) for feature in zones_dict["features"]])
+    shapely.prepare(zone_geoms)
+    return zone_strs, zone_geoms, shapely.STRtree(zone_geoms)
+
+def get_utm_epsg_code(lat, lon, z=None):
     """Modified from https://github.com/DigitalGlobe/gdal_ortho/blob/master/gdal_ortho/gdal_ortho.py
     Looks up the UTM zone for a point. This function uses the UTM Zone Boundaries shapefile from this
     location: http://earth-info.nga.mil/GandG/coordsys/grids/universal_grid_system.html
+    The zones are loaded once (load_utm_zones) and only those whose bounding box holds the point are tested.
     Args:
         lat: Latitude of the point to use.
         lon: Longitude of the point to use.
     Returns the integer EPSG code for the UTM zone containing the input point.
     """
+    import shapely.geometry
 
-    UTM_ZONES_PATH="../data/UTM_Zone_Boundaries.geojson"
-
-    # Load the UTM zones
-    zone_geoms = {}
-    with open(UTM_ZONES_PATH, "r") as f_obj:
-        zones_dict = json.load(f_obj)
-    for feature in zones_dict["features"]:
-        zone_geom = shapely.geometry.shape(feature["geometry"])
-        zone_str = feature["properties"]["Zone_Hemi"]
-        zone_geoms[zone_str] = zone_geom
+    zone_strs, zone_geoms, tree = load_utm_zones()
 
-    # Loop through zones and find the zone that contains the point
+    # Zones containing the point; like the original loop over every zone, the last one in file order wins
     pt = shapely.geometry.Point([lon, lat])
-    found_zone = None
-    for (zone_str, zone_geom) in zone_geoms.items():
-        if zone_geom.contains(pt):
-            found_zone = zone_str
-    if found_zone is None:
+    hits = tree.query(pt, predicate='within')
+    if len(hits) == 0:
         raise InputError("Latitude %.10f Longitude %.10f is not in any UTM zone" % \
                          (lat, lon))
+    found_zone = zone_strs[hits.max()]
     # Parse the zone
     (zone_num, hemisphere) = found_zone.split(",")
     if hemisphere == "n":
@@ -127,47 +154,115 @@ def get_utm_epsg_code(lat, lon, z=None):
         print("EPSG:", epsg)
     return('epsg:'+str(epsg), epsg)
 
-def run(in_fn=None, l=None, b=None, r=None, t=None, z=None, c=None):
+def get_utm_epsg_codes(lats, lons):
+    '''Vectorized get_utm_epsg_code for arrays of points, same zone table and last-match rule.
+    Returns (zone numbers, hemispheres 'n'/'s', EPSG codes) arrays shaped like lats. Points outside
+    every zone, which get_utm_epsg_code rejects with InputError, get zone 0, hemisphere '' and EPSG 0.
+    '''
+    import numpy as np
+    import shapely
+
+    zone_strs, zone_geoms, tree = load_utm_zones()
+    zone_nums = np.array([int(zs.split(",")[0]) for zs in zone_strs])
+    zone_hemis = np.array([zs.split(",")[1] for zs in zone_strs])
+
+    lats = np.asarray(lats, dtype=float)
+    lons = np.broadcast_to(np.asarray(lons, dtype=float), lats.shape)
+
+    # Points sorted by longitude, so each zone's bounding box is a slice plus a latitude test.
+    # Zones are visited in file order and overwrite earlier matches: the last match wins.
+    order = np.argsort(lons, axis=None)
+    s_lons, s_lats = lons.ravel()[order], lats.ravel()[order]
+    found = np.full(lats.size, -1)
+    for k, (minx, miny, maxx, maxy) in enumerate(shapely.bounds(zone_geoms)):
+        lo, hi = np.searchsorted(s_lons, minx, 'left'), np.searchsorted(s_lons, maxx, 'right')
+        sel = lo + np.nonzero((s_lats[lo:hi] >= miny) & (s_lats[lo:hi] <= maxy))[0]
+        inside = shapely.contains_xy(zone_geoms[k], s_lons[sel], s_lats[sel])
+        found[order[sel[inside]]] = k
+
+    missing = found < 0
+    found[missing] = 0
+    zones = np.where(missing, 0, zone_nums[found])
+    hemis = np.where(missing, '', zone_hemis[found])
+    epsgs = np.where(missing, 0, np.where(hemis == 'n', 32600, 32700) + zones)
+    return zones.reshape(lats.shape), hemis.reshape(lats.shape), epsgs.reshape(lats.shape)
+
+def read_points(pts_fn, lonlat=False):
+    '''lat, lon arrays from a text file with one point per line, comma or whitespace separated,
+    optionally with a header line. With lonlat the columns are lon, lat.'''
+    import numpy as np
+
+    with open(pts_fn) as f:
+        first = f.readline()
+    delimiter = ',' if ',' in first else None
     try:
-        if os.path.exists(in_fn[:-3]+'xml'):
-            xml = in_fn[:-3]+'xml'
-        elif os.path.exists(in_fn[:-3]+'XML'):
-            xml = in_fn[:-3]+'XML'    
-        ur_lon=float(getTag(xml, 'URLON'))
-        ur_lat=float(getTag(xml, 'URLAT'))
+        [float(v) for v in first.replace(',', ' ').split()[:2]]
+        skip = 0
+    except ValueError:
+        skip = 1
+    pts = np.loadtxt(pts_fn, delimiter=delimiter, skiprows=skip, usecols=(0, 1), ndmin=2)
+    if lonlat:
+        return pts[:, 1], pts[:, 0]
+    return pts[:, 0], pts[:, 1]
 
-        ul_lon=float(getTag(xml, 'ULLON'))
-        ul_lat=float(getTag(xml, 'ULLAT'))
+def run_points(pts_fn, out_fn=None, lonlat=False):
+    '''Write lat,lon,zone,hemisphere,epsg CSV for every point in pts_fn (stdout if out_fn is None)'''
+    lats, lons = read_points(pts_fn, lonlat)
+    zones, hemis, epsgs = get_utm_epsg_codes(lats, lons)
+    out = sys.stdout if out_fn is None else open(out_fn, 'w')
+    try:
+        out.write("lat,lon,zone,hemisphere,epsg\n")
+        for row in zip(lats.tolist(), lons.tolist(), zones.tolist(), hemis.tolist(), epsgs.tolist()):
+            out.write("%r,%r,%d,%s,%d\n" % row)
+    finally:
+        if out_fn is not None:
+            out.close()
+    if (epsgs == 0).any():
+        print("%d points are not in any UTM zone (epsg 0)" % (epsgs == 0).sum(), file=sys.stderr)
 
-        lr_lon=float(getTag(xml, 'LRLON'))
-        lr_lat=float(getTag(xml, 'LRLAT'))
+def corner_bounds(corners):
+    '''Whole-degree geographic bounds (xmin, ymin, xmax, ymax) enclosing a dict of ULLON, ULLAT, ... LLLAT corners'''
+    if None in corners.values():
+        raise ValueError("Missing corner coordinates")
+    ur_lon, ur_lat = corners['URLON'], corners['URLAT']
+    ul_lon, ul_lat = corners['ULLON'], corners['ULLAT']
+    lr_lon, lr_lat = corners['LRLON'], corners['LRLAT']
+    ll_lon, ll_lat = corners['LLLON'], corners['LLLAT']
 
-        ll_lon=float(getTag(xml, 'LLLON'))
-        ll_lat=float(getTag(xml, 'LLLAT'))
+    # Round to nearest degree (largest extent)
+    xmin=int(round_down(min(ul_lon, ll_lon), decimals=0))  # Left
+    ymin=int(round_down(min(lr_lat, ll_lat), decimals=0))  # Bottom
+    xmax=int(round_up(max(ur_lon, lr_lon), decimals=0))    # Right
+    ymax=int(round_up(max(ul_lat, ur_lat), decimals=0))    # Top
+    return xmin, ymin, xmax, ymax
 
-        # Round to nearest degree (largest extent)
-        xmin=int(round_down(min(ul_lon, ll_lon), decimals=0))  # Left
-        ymin=int(round_down(min(lr_lat, ll_lat), decimals=0))  # Bottom
-        xmax=int(round_up(max(ur_lon, lr_lon), decimals=0))    # Right
-        ymax=int(round_up(max(ul_lat, ur_lat), decimals=0))    # Top
+def image_bounds(in_fn=None, l=None, b=None, r=None, t=None):
+    '''Whole-degree geographic bounds (xmin, ymin, xmax, ymax) of an image: from the corners in its
+    DigitalGlobe xml, else the given l, b, r, t, else the raster's own extent'''
+    try:
+        if os.path.exists(in_fn[:-3]+'xml'):
+            xml = in_fn[:-3]+'xml'
+        elif os.path.exists(in_fn[:-3]+'XML'):
+            xml = in_fn[:-3]+'XML'    
+        xmin, ymin, xmax, ymax = corner_bounds(read_xml(xml).corners)
     except:
         if l is not None:
             xmin, ymin, xmax, ymax=l, b, r, t
         else:
+            # GDAL bindings are only needed here, so the zone lookups work without them
+            try:
+                from osgeo import gdal
+            except ImportError:
+                import gdal
             # Call functions on input image
             raster_ds = gdal.Open(in_fn, gdal.GA_ReadOnly)
             # Fetch number of rows and columns
             ncol = raster_ds.RasterXSize
             nrow = raster_ds.RasterYSize
-            # Fetch geotransform
+            # Fetch geotransform and corners in the geographic CRS of the image
             gt = raster_ds.GetGeoTransform()
-            ext, corners = GetExtent(gt, ncol, nrow)
-
-            src_srs=osr.SpatialReference()
-            src_srs.ImportFromWkt(raster_ds.GetProjection())
-            tgt_srs=src_srs.CloneGeogCS()
-
-            geo_ext=ReprojectCoords(corners,src_srs,tgt_srs)
+            src_wkt = raster_ds.GetProjection()
+            ext, geo_ext = GetExtent(gt, ncol, nrow, src_wkt, geodetic_crs(src_wkt))
 
             # Close dataset to free up resources
             raster_ds=None
@@ -182,7 +277,17 @@ def run(in_fn=None, l=None, b=None, r=None, t=None, z=None, c=None):
         xmin=xmin-360
     if xmax>180:
         xmax=xmax-360
-        
+    return xmin, ymin, xmax, ymax
+
+def utm_bounds(proj_str, xmin, ymin, xmax, ymax):
+    '''Projected (min_easting, min_northing, max_easting, max_northing) of geographic bounds'''
+    (min_easting, min_northing), (max_easting, max_northing) = \
+        transform_points([[xmin, ymin], [xmax, ymax]], 'epsg:4326', proj_str).tolist()
+    return min_easting, min_northing, max_easting, max_northing
+
+def run(in_fn=None, l=None, b=None, r=None, t=None, z=None, c=None):
+    xmin, ymin, xmax, ymax = image_bounds(in_fn, l, b, r, t)
+
     # Get center coordinates and pull UTM zone from these
     x_center=(xmin + xmax)/2
     y_center=(ymin + ymax)/2
@@ -193,22 +298,72 @@ def run(in_fn=None, l=None, b=None, r=None, t=None, z=None, c=None):
     if c is None:
         print(epsg)
     else:
-        from pyproj import Proj, transform
-        inProj = Proj(init='epsg:4326')
-        outProj = Proj(init=proj_str)
-        min_easting, min_northing =transform(inProj, outProj, xmin, ymin)
-        max_easting, max_northing =transform(inProj, outProj, xmax, ymax)
-        print(min_easting, min_northing, max_easting, max_northing)
+        print(*utm_bounds(proj_str, xmin, ymin, xmax, ymax))
+
+BATCH_FIELDS = ['path', 'epsg', 'zone', 'left', 'bottom', 'right', 'top']
+UTM_FIELDS = ['min_easting', 'min_northing', 'max_easting', 'max_northing']
+
+def utm_info(in_fn, c=None):
+    '''dict of BATCH_FIELDS (plus UTM_FIELDS with c) for one image, as run would print them'''
+    xmin, ymin, xmax, ymax = image_bounds(in_fn)
+    proj_str, epsg = get_utm_epsg_code((ymin + ymax)/2, (xmin + xmax)/2)
+    info = dict(path=in_fn, epsg=epsg, zone='%d%s' % (epsg % 100, 'N' if epsg < 32700 else 'S'),
+                left=xmin, bottom=ymin, right=xmax, top=ymax)
+    if c is not None:
+        info.update(zip(UTM_FIELDS, utm_bounds(proj_str, xmin, ymin, xmax, ymax)))
+    return info
+
+def read_inputs(in_fns=None, list_fn=None):
+    '''Input paths from the command line and/or a list file with one path per line ('-' is stdin)'''
+    paths = list(in_fns or [])
+    if list_fn is not None:
+        f = sys.stdin if list_fn == '-' else open(list_fn)
+        try:
+            paths += [line.strip() for line in f if line.strip()]
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    return paths
+
+def run_batch(in_fns, fmt='csv', c=None, out=None):
+    '''One CSV row or JSON line per input, in one process. Inputs that fail are written with empty
+    values and an error message. Returns the number of failed inputs.'''
+    import csv
+    import json
+
+    out = sys.stdout if out is None else out
+    fields = BATCH_FIELDS + (UTM_FIELDS if c is not None else []) + ['error']
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, fieldnames=fields, lineterminator='\n')
+        writer.writeheader()
+    failed = 0
+    for in_fn in in_fns:
+        try:
+            info = utm_info(in_fn, c)
+        except Exception as e:
+            failed += 1
+            info = dict(path=in_fn, error='%s: %s' % (type(e).__name__, e))
+        if fmt == 'csv':
+            writer.writerow(info)
+        else:
+            out.write(json.dumps(info) + '\n')
+        out.flush()
+    return failed
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Geographic coordinates to UTM zone converter')
-    parser.add_argument('-in', '--input_file', help='GeoTiff image file', required=False)
+    parser.add_argument('-in', '--input_file', help='GeoTiff image file(s), several inputs give one output line each', nargs='+', required=False)
+    parser.add_argument('-list', '--input_list', help="File listing input images, one per line ('-' reads stdin)", required=False)
+    parser.add_argument('-fmt', '--format', help='Batch output format, one line per input, default is csv', choices=['csv', 'json'], required=False)
     parser.add_argument('-L', '--left', help='Leftmost bound', required=False, type=float)
     parser.add_argument('-B', '--bottom', help='Bottom-most bound', required=False, type=float)
     parser.add_argument('-R', '--right', help='Rightmost bound', required=False, type=float)
     parser.add_argument('-T', '--top', help='Top bound', required=False, type=float)
     parser.add_argument('-zone', '--get_utm_zone', help='Flag to block returning UTM zone', required=False)
     parser.add_argument('-coords', '--convert_coords', help='Flag to convert coordinates to UTM', required=False)
+    parser.add_argument('-pts', '--points_file', help='Text/CSV file of lat lon points, writes lat,lon,zone,hemisphere,epsg CSV', required=False)
+    parser.add_argument('-lonlat', '--lonlat', help='Points file columns are lon lat', action='store_true')
+    parser.add_argument('-out', '--output_file', help='CSV output for -pts, default is stdout', required=False)
     return parser
         
 def main():
@@ -221,7 +376,17 @@ def main():
     t=args.top
     z=args.get_utm_zone
     c=args.convert_coords
-    
+
+    if args.points_file is not None:
+        run_points(args.points_file, args.output_file, args.lonlat)
+        return
+
+    in_fns = read_inputs(in_fn, args.input_list)
+    if (len(in_fns) > 1) | (args.input_list is not None) | (args.format is not None):
+        failed = run_batch(in_fns, args.format or 'csv', c)
+        sys.exit(1 if failed else 0)
+    in_fn = in_fns[0] if in_fns else None
+
     run(in_fn=in_fn, l=l, b=b, r=r, t=t, z=z, c=c)
     
 if __name__ == "__main__":    
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# Bounded scheduler for block-window processing with a single writer.
+# At most max_in_flight windows are submitted but not yet written, so finished results
+# cannot pile up in memory when the writer falls behind the workers.
+
+import concurrent.futures
+
+_DONE = object()
+
+def run_windows(submit, items, write, max_in_flight, ordered=False):
+    """Submit items, writing each result as it completes.
+
+    submit:         callable(item) returning a concurrent.futures.Future
+    items:          iterable of windows (or batches of windows), consumed lazily
+    write:          callable(item, result), always called from the calling thread
+    max_in_flight:  maximum number of items submitted but not yet written
+    ordered:        write in the order items were given (e.g. raster order for the
+                    block_windows of a tiled GeoTIFF) instead of completion order
+    """
+    max_in_flight = max(1, int(max_in_flight))
+    items = iter(items)
+    pending = dict()    # future -> (index, item)
+    finished = dict()   # index -> (item, result), held only in ordered mode
+    in_flight = 0
+    next_submit = 0
+    next_write = 0
+    exhausted = False
+
+    while True:
+        while not exhausted and in_flight < max_in_flight:
+            item = next(items, _DONE)
+            if item is _DONE:
+                exhausted = True
+                break
+            pending[submit(item)] = (next_submit, item)
+            next_submit += 1
+            in_flight += 1
+
+        if not pending:
+            break
+
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            index, item = pending.pop(future)
+            result = future.result()
+            if ordered:
+                finished[index] = (item, result)
+            else:
+                write(item, result)
+                in_flight -= 1
+
+        while next_write in finished:
+            item, result = finished.pop(next_write)
+            write(item, result)
+            next_write += 1
+            in_flight -= 1
@@ -5,9 +5,14 @@
 
 # import libraries
 import argparse
-from datetime import datetime
+import os
+from contextlib import ExitStack
 import numpy as np
 import rasterio as rio
+from dg_xml import read_xml
+from refl_io import int16_profile, set_scales, to_int16
+import out_profile
+from cog import open_raster, GDAL_DTYPES
 
 # Irradiance dictionary band values
 EsunDict = {
@@ -140,62 +145,147 @@ OrderDict = {
 }
 
 def getTag(xml_fn, tag):
-    import xml.etree.ElementTree as ET
-    tree = ET.parse(xml_fn)
-    #Want to check to make sure tree contains tag
-    elem = tree.find('.//%s' % tag)
-    if elem is not None:
-        return elem.text
+    return read_xml(xml_fn).tag(tag)
 
 def xml_dt(xml_fn):
-    t = getTag(xml_fn, 'FIRSTLINETIME')
-    dt = datetime.strptime(t,"%Y-%m-%dT%H:%M:%S.%fZ")
-    return dt
+    return read_xml(xml_fn).firstlinetime
 
 def getAllTag(xml_fn, tag):
-    import xml.etree.ElementTree as ET
-    tree = ET.parse(xml_fn)
-    #Want to check to make sure tree contains tag
-    elem = tree.findall('.//%s' % tag)
-    return [i.text for i in elem]
+    return read_xml(xml_fn).all_tags(tag)
 
 def toa_rad(xml_fn, band):
     """Calculate scaling factor abs/effbw for top-of-atmosphere radiance
     """
-    sat = getTag(xml_fn, 'SATID')
-    band = band.upper()
-    key = '%s_BAND_%s' % (sat, band)
-    abscal = np.array((getAllTag(xml_fn, 'ABSCALFACTOR')), dtype=float)
-    effbw = np.array((getAllTag(xml_fn, 'EFFECTIVEBANDWIDTH')), dtype=float)
-#     print(abscal, effbw)
+    md = read_xml(xml_fn)
     #Multiply L1B DN by this to obtain top-of-atmosphere spectral radiance image pixels
-    toa_rad_coeff_list = abscal/effbw
-    toa_rad_coeff = toa_rad_coeff_list[OrderDict[key]]
+    toa_rad_coeff = md.toa_rad_coeffs[OrderDict[md.key(band)]]
     return toa_rad_coeff
 
-def toa_refl(xml_fn, band, data):
-    """Calculate scaling factor for top-of-atmosphere reflectance
+def toa_coeffs(xml_fn, band):
+    """Collect the per-band factors used in top-of-atmosphere reflectance
+    Returns (gain, toa_rad_coeff, offset, esd, Esun, sunang)
     """
     #These need to be pulled out by individual band
-    sat = getTag(xml_fn, 'SATID')
+    md = read_xml(xml_fn)
     if band is None:
-        band = getTag(xml_fn, 'BANDID')
-    band = band.upper()
-    key = '%s_BAND_%s' % (sat, band)
+        band = md.bandid
+    key = md.key(band)
     Esun = EsunDict[key]
     gain = GainDict[key]
     offset = OffsetDict[key]
-#     print(sat, key, Esun, gain, offset)
-    msunel = float(getTag(xml_fn, 'MEANSUNEL'))
-    sunang = 90.0 - msunel
-    dt = xml_dt(xml_fn)
-    esd = calcEarthSunDist(dt)
-#     print(msunel, sunang, dt, esd)
+    sunang = 90.0 - md.meansunel
+    esd = calcEarthSunDist(md.firstlinetime)
     toa_rad_coeff = toa_rad(xml_fn, band)
-#     print("AbsCalFactor/EffBW is ", toa_rad_coeff)
+    return gain, toa_rad_coeff, offset, esd, Esun, sunang
+
+def calc_toa(data, gain, toa_rad_coeff, offset, esd, Esun, sunang):
+    """Apply top-of-atmosphere reflectance factors to L1B DN
+    """
     TOA_arr = (gain * data * toa_rad_coeff + offset) * (esd**2 * np.pi) / (Esun * np.cos(np.radians(sunang)))
     return TOA_arr
 
+def fold_coeffs(gain, toa_rad_coeff, offset, esd, Esun, sunang, dtype=np.float32):
+    """Fold the TOA factors into refl = scale * DN + bias, returned as dtype (scalars or per-band arrays)
+    """
+    k = (esd**2 * np.pi) / (Esun * np.cos(np.radians(sunang)))
+    return dtype(gain * toa_rad_coeff * k), dtype(offset * k)
+
+def calc_toa_f32(data, scale, bias, ndv=None, out=None):
+    """TOA reflectance as a single float32 multiply-add, without float64 temporaries.
+    out is an optional preallocated float32 buffer (flat or shaped) with at least data.size
+    elements, so one buffer can be reused across windows; the result is a view into it.
+    Pixels equal to ndv are set to ndv.
+    """
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+    else:
+        out = out.reshape(-1)[:data.size].reshape(data.shape)
+    np.multiply(data, scale, out=out)
+    np.add(out, bias, out=out)
+    if ndv is not None:
+        np.copyto(out, np.float32(ndv), where=(data == ndv))
+    return out
+
+def toa_refl(xml_fn, band, data):
+    """Calculate scaling factor for top-of-atmosphere reflectance
+    """
+    return calc_toa(data, *toa_coeffs(xml_fn, band))
+
+def band_codes(xml_fn, count):
+    """Band codes (e.g. C, B, G, ...) for each band of a count-band product, in file order
+    """
+    md = read_xml(xml_fn)
+    if len(md.bands) == count:
+        return md.bands
+    # Fall back to the calibration order for this satellite, SWIR or VNIR
+    swir = md.bandid is not None and md.bandid.upper().startswith('S')
+    keys = [k for k in OrderDict if k.startswith(md.satid + '_BAND_') and not k.endswith('_P')
+            and k.split('_BAND_')[1].startswith('S') == swir]
+    bands = [k.split('_BAND_')[1] for k in sorted(keys, key=OrderDict.get)]
+    if len(bands) != count:
+        raise ValueError("Cannot match %d input bands to %s bands in %s" % (count, md.satid, xml_fn))
+    return bands
+
+def toa_coeff_arrays(xml_fn, bands):
+    """toa_coeffs for every band, stacked as (nbands, 1, 1) arrays that broadcast over a (nbands, rows, cols) block
+    """
+    coeffs = [toa_coeffs(xml_fn, band) for band in bands]
+    return [np.array(c, dtype=float).reshape(-1, 1, 1) for c in zip(*coeffs)]
+
+def get_modifier(px_res="1.2", mod=None):
+    """Per-band filename modifier, as in the index scripts (e.g. 12 or mos_12)
+    """
+    if (mod == "None") | (mod is None):
+        return px_res[0]+px_res[-1]
+    return mod + "_" + px_res[0]+px_res[-1]
+
+def band_fn(in_fn, n, modifier):
+    """Per-band reflectance filename read by ndvi.py/ndwi.py/ndsi.py, n is the 1-based band number
+    """
+    return in_fn[:-4] + "_b%d_" % n + modifier + "_refl.tif"
+
+def write_toa_vrt(in_fn, xml_fn, out_fn, bands):
+    """Write a VRT presenting DN bands of in_fn as float32 TOA reflectance, bands is a list of
+    (1-based band number, band code). Each band is a ComplexSource with ScaleRatio/ScaleOffset
+    from fold_coeffs, so GDAL applies the transform on read and no reflectance copy is stored.
+    """
+    import xml.etree.ElementTree as ET
+
+    with rio.open(in_fn) as f:
+        ndv = f.nodata
+        vrt = ET.Element('VRTDataset', rasterXSize=str(f.width), rasterYSize=str(f.height))
+        if f.crs is not None:
+            ET.SubElement(vrt, 'SRS').text = f.crs.to_wkt()
+        if not f.transform.is_identity:
+            ET.SubElement(vrt, 'GeoTransform').text = ', '.join(repr(v) for v in f.transform.to_gdal())
+        if f.rpcs is not None:
+            md = ET.SubElement(vrt, 'Metadata', domain='RPC')
+            for key, val in f.rpcs.to_gdal().items():
+                ET.SubElement(md, 'MDI', key=key).text = str(val)
+
+        src_fn = os.path.relpath(os.path.abspath(in_fn), os.path.dirname(os.path.abspath(out_fn)))
+        bh, bw = f.block_shapes[0]
+        size = dict(xSize=str(f.width), ySize=str(f.height))
+        for i, (n, code) in enumerate(bands):
+            scale, bias = fold_coeffs(*toa_coeffs(xml_fn, code), dtype=float)
+            band = ET.SubElement(vrt, 'VRTRasterBand', dataType='Float32', band=str(i + 1))
+            ET.SubElement(band, 'Description').text = code.upper()
+            if ndv is not None:
+                ET.SubElement(band, 'NoDataValue').text = repr(ndv)
+            src = ET.SubElement(band, 'ComplexSource')
+            ET.SubElement(src, 'SourceFilename', relativeToVRT='1').text = src_fn
+            ET.SubElement(src, 'SourceBand').text = str(n)
+            ET.SubElement(src, 'SourceProperties', RasterXSize=str(f.width), RasterYSize=str(f.height),
+                          DataType=GDAL_DTYPES[f.dtypes[n-1]], BlockXSize=str(bw), BlockYSize=str(bh))
+            ET.SubElement(src, 'SrcRect', xOff='0', yOff='0', **size)
+            ET.SubElement(src, 'DstRect', xOff='0', yOff='0', **size)
+            ET.SubElement(src, 'ScaleOffset').text = repr(bias)
+            ET.SubElement(src, 'ScaleRatio').text = repr(scale)
+            if ndv is not None:
+                ET.SubElement(src, 'NODATA').text = repr(ndv)
+
+    ET.ElementTree(vrt).write(out_fn)
+
 def calcEarthSunDist(dt):
     """Calculate Earth-Sun distance"""
     #Astronomical Units (AU), should have a value between 0.983 and 1.017
@@ -221,12 +311,52 @@ def calcEarthSunDist(dt):
 def get_parser():
     parser = argparse.ArgumentParser(description='GeoTiff WorldView Multispectral Image to TOA Reflection Image Conversion Script')
     parser.add_argument('-in', '--input_file', help='GeoTiff multi band MS image file', required=True)
-    parser.add_argument('-in_band', '--input_band', help='GeoTiff multi band', required=True)
+    parser.add_argument('-in_band', '--input_band', help='GeoTiff multi band, "all" converts every band of the input in one pass', required=True)
     parser.add_argument('-in_x', '--input_xml', help='GeoTiff multi band xml file', required=True)
-    parser.add_argument('-out', '--output_file', help='Where TOA reflectance image is to be saved', required=True)
+    parser.add_argument('-out', '--output_file', help='Where TOA reflectance image is to be saved', required=False)
+    parser.add_argument('-stream', '--stream', help='Read, convert and write block by block to bound memory use', action='store_true')
+    parser.add_argument('-split', '--split', help='With -in_band all, write per-band _bN_<mod>_refl.tif files next to the input', action='store_true')
+    parser.add_argument('-res', '--px_res', help='Pixel resolution for per-band filenames, default is 1.2m', default="1.2", required=False)
+    parser.add_argument('-m', '--mod', help='Modifiers to per-band filenames')
+    parser.add_argument('-vrt', '--vrt', help='Write a VRT that applies TOA reflectance to the DN file on read instead of a float32 GeoTIFF', action='store_true')
+    parser.add_argument('-int16', '--int16', help='Write reflectance x 10000 as int16 with scale metadata instead of float32', action='store_true')
+    parser.add_argument('-f32', '--f32', help='Block by block float32 kernel with one folded multiply-add (not bit-identical, differences ~1e-7)', action='store_true')
+    out_profile.add_args(parser)
     return parser
 
-def main(in_fn, xml_fn, in_band, out_fn):
+def get_profile(prof, int16=False, out_opts=None):
+    """Output profile for TOA reflectance: single band float32 (or scaled int16), 512x512 tiles.
+    out_opts are out_profile.update_profile keyword arguments (codec, level, predictor, block, ...)
+    """
+    profile = prof.copy()
+    profile.update(
+        dtype=rio.float32,
+        count=1,
+        interleave='band',
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        BIGTIFF='YES'
+    )
+    if int16:
+        int16_profile(profile)
+    out_profile.update_profile(profile, **(out_opts or {}))
+    return profile
+
+def open_out(fn, profile, int16=False, cog=False):
+    """Open a TOA output for writing (a CogWriter with cog), recording the int16 scale factor if needed"""
+    dst = open_raster(fn, profile, cog)
+    if int16:
+        set_scales(dst)
+    return dst
+
+def encode(TOA_arr, ndv, int16=False):
+    """float32 reflectance as written, or scaled int16 with ndv pixels as the int16 nodata"""
+    if int16:
+        return to_int16(TOA_arr, ndv)
+    return TOA_arr.astype(rio.float32, copy=False)
+
+def main(in_fn, xml_fn, in_band, out_fn, int16=False, out_opts=None, cog=False):
     with rio.open(in_fn) as f:
         data=f.read(1)
         ndv=f.nodata
@@ -236,20 +366,91 @@ def main(in_fn, xml_fn, in_band, out_fn):
     TOA_arr[data==ndv] = ndv
 
     with rio.Env():
-        profile = prof
-        profile.update(
-            dtype=rio.float32,
-            count=1,
-            compress='lzw',
-            interleave='band',
-            tiled=True,
-            blockxsize=512,
-            blockysize=512,
-            BIGTIFF='YES'
-        )
-
-        with rio.open(out_fn, 'w', **profile) as dst:
-            dst.write(np.squeeze(TOA_arr).astype(rio.float32), 1)
+        profile = get_profile(prof, int16, out_opts)
+
+        with open_out(out_fn, profile, int16, cog) as dst:
+            dst.write(encode(np.squeeze(TOA_arr), ndv, int16), 1)
+
+def main_stream(in_fn, xml_fn, in_band, out_fn, f32=False, int16=False, out_opts=None, cog=False, bidx=1):
+    """Same output as main, but only one output block is held in memory at a time.
+    With f32, uses calc_toa_f32 and a single reused output buffer.
+    bidx is the band of in_fn to convert (in_band is its band code), for per-band runs on multiband images.
+    """
+    coeffs = toa_coeffs(xml_fn, in_band)
+    scale, bias = fold_coeffs(*coeffs)
+
+    with rio.Env():
+        with rio.open(in_fn) as f:
+            ndv=f.nodata
+            profile = get_profile(f.profile, int16, out_opts)
+
+            with open_out(out_fn, profile, int16, cog) as dst:
+                if f32:
+                    buf = np.empty(profile['blockxsize'] * profile['blockysize'], dtype=np.float32)
+                for ij, window in dst.block_windows(1):
+                    data=f.read(bidx, window=window)
+                    if f32:
+                        TOA_arr=calc_toa_f32(data, scale, bias, ndv, buf)
+                    else:
+                        TOA_arr=calc_toa(data, *coeffs)
+                        TOA_arr[data==ndv] = ndv
+                    dst.write(encode(TOA_arr, ndv, int16), 1, window=window)
+
+def main_all_bands(in_fn, xml_fn, out_fn=None, modifier=None, f32=False, int16=False, out_opts=None, cog=False):
+    """Convert every band of a multiband L1B image, reading each block of the input once.
+    Writes a multiband out_fn and/or, if modifier is given, the per-band band_fn files.
+    With f32, uses calc_toa_f32 and a single reused output buffer.
+    """
+    with rio.Env(), ExitStack() as stack:
+        f = stack.enter_context(rio.open(in_fn))
+        ndv = f.nodata
+        bands = band_codes(xml_fn, f.count)
+        coeffs = toa_coeff_arrays(xml_fn, bands)
+        scale, bias = fold_coeffs(*coeffs)
+
+        dst = None
+        if out_fn is not None:
+            profile = get_profile(f.profile, int16, out_opts)
+            profile.update(count=f.count)
+            dst = stack.enter_context(open_out(out_fn, profile, int16, cog))
+
+        band_dsts = []
+        if modifier is not None:
+            profile = get_profile(f.profile, int16, out_opts)
+            for n in range(1, f.count + 1):
+                band_dsts.append(stack.enter_context(open_out(band_fn(in_fn, n, modifier), profile, int16, cog)))
+
+        ref = dst if dst is not None else band_dsts[0]
+        if f32:
+            buf = np.empty(f.count * ref.profile['blockxsize'] * ref.profile['blockysize'], dtype=np.float32)
+        for ij, window in ref.block_windows(1):
+            data = f.read(window=window)
+            if f32:
+                TOA_arr = calc_toa_f32(data, scale, bias, ndv, buf)
+            else:
+                TOA_arr = calc_toa(data, *coeffs)
+                TOA_arr[data==ndv] = ndv
+            TOA_arr = encode(TOA_arr, ndv, int16)
+            if dst is not None:
+                dst.write(TOA_arr, window=window)
+            for i, band_dst in enumerate(band_dsts):
+                band_dst.write(TOA_arr[i], 1, window=window)
+
+def main_vrt(in_fn, xml_fn, in_band, out_fn=None, modifier=None):
+    """VRT counterpart of main (one band) and main_all_bands (in_band 'all'): nothing is converted,
+    the VRTs reference in_fn. Per-band VRTs are named like band_fn with a .vrt extension.
+    """
+    if in_band.lower() != 'all':
+        write_toa_vrt(in_fn, xml_fn, out_fn, [(1, in_band)])
+        return
+
+    with rio.open(in_fn) as f:
+        bands = list(enumerate(band_codes(xml_fn, f.count), 1))
+    if out_fn is not None:
+        write_toa_vrt(in_fn, xml_fn, out_fn, bands)
+    if modifier is not None:
+        for n, code in bands:
+            write_toa_vrt(in_fn, xml_fn, band_fn(in_fn, n, modifier)[:-4] + ".vrt", [(n, code)])
 
 if __name__ == "__main__":
     parser = get_parser()
@@ -260,4 +461,20 @@ if __name__ == "__main__":
     xml_fn = args.input_xml
     out_fn = args.output_file
     
-    main(in_fn, xml_fn, in_band, out_fn)
+    out_opts = out_profile.from_args(args)
+
+    if (out_fn is None) and not (args.split and in_band.lower() == 'all'):
+        parser.error("-out is required unless writing per-band files with -in_band all -split")
+    if args.vrt and args.cog:
+        parser.error("-vrt and -cog cannot be combined")
+
+    if args.vrt:
+        modifier = get_modifier(args.px_res, args.mod) if args.split else None
+        main_vrt(in_fn, xml_fn, in_band, out_fn, modifier)
+    elif in_band.lower() == 'all':
+        modifier = get_modifier(args.px_res, args.mod) if args.split else None
+        main_all_bands(in_fn, xml_fn, out_fn, modifier, f32=args.f32, int16=args.int16, out_opts=out_opts, cog=args.cog)
+    elif args.stream or args.f32:
+        main_stream(in_fn, xml_fn, in_band, out_fn, f32=args.f32, int16=args.int16, out_opts=out_opts, cog=args.cog)
+    else:
+        main(in_fn, xml_fn, in_band, out_fn, int16=args.int16, out_opts=out_opts, cog=args.cog)
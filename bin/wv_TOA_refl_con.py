@@ -6,7 +6,11 @@
 # import libraries
 import rasterio as rio
 import argparse, numpy as np
-from datetime import datetime, timedelta
+from dg_xml import read_xml
+from wv_TOA_refl import fold_coeffs, calc_toa_f32
+from refl_io import int16_profile, set_scales, to_int16
+import out_profile
+from cog import open_raster
 
 
 # Irradiance dictionary band values
@@ -140,36 +144,20 @@ OrderDict = {
 }
 
 def getTag(xml_fn, tag):
-    import xml.etree.ElementTree as ET
-    tree = ET.parse(xml_fn)
-    elem = tree.find('.//%s' % tag)
-    if elem is not None:
-        return elem.text
+    return read_xml(xml_fn).tag(tag)
 
 def xml_dt(xml_fn):
-    t = getTag(xml_fn, 'FIRSTLINETIME')
-    dt = datetime.strptime(t,"%Y-%m-%dT%H:%M:%S.%fZ")
-    return dt
+    return read_xml(xml_fn).firstlinetime
 
 def getAllTag(xml_fn, tag):
-    import xml.etree.ElementTree as ET
-    tree = ET.parse(xml_fn)
-    elem = tree.findall('.//%s' % tag)
-    return [i.text for i in elem]
+    return read_xml(xml_fn).all_tags(tag)
 
 def toa_rad(xml_fn, band):
     """Calculate scaling factor abs/effbw for top-of-atmosphere radiance
     """
-    sat = getTag(xml_fn, 'SATID')
-    band = band.upper()
-    key = '%s_BAND_%s' % (sat, band)
-    abscal = np.array((getAllTag(xml_fn, 'ABSCALFACTOR')), dtype=float)
-    effbw = np.array((getAllTag(xml_fn, 'EFFECTIVEBANDWIDTH')), dtype=float)
-#     print(abscal, effbw)
-
+    md = read_xml(xml_fn)
     #Multiply L1B DN by this to obtain top-of-atmosphere spectral radiance image pixels
-    toa_rad_coeff_list = abscal/effbw
-    toa_rad_coeff = toa_rad_coeff_list[OrderDict[key]]
+    toa_rad_coeff = md.toa_rad_coeffs[OrderDict[md.key(band)]]
     return toa_rad_coeff
 
 def toa_refl(gain, data, toa_rad_coeff, offset, esd, Esun, sunang):
@@ -200,6 +188,21 @@ def calcEarthSunDist(dt):
     d = 1.00014 - 0.01671 * np.cos(np.radians(g)) - 0.00014 * np.cos(np.radians(2*g))
     return d
 
+def toa_coeffs(xml_fn, band):
+    """Collect the per-band factors passed to toa_refl
+    Returns (gain, toa_rad_coeff, offset, esd, Esun, sunang)
+    """
+    md = read_xml(xml_fn)
+    key = md.key(band)
+    Esun = EsunDict[key]
+    gain = GainDict[key]
+    offset = OffsetDict[key]
+    sunang = 90.0 - md.meansunel
+    esd = calcEarthSunDist(md.firstlinetime)
+
+    toa_rad_coeff = toa_rad(xml_fn, band)
+    return gain, toa_rad_coeff, offset, esd, Esun, sunang
+
 def compute(gain, toa_rad_coeff, offset, esd, Esun, sunang, in_fn, window):
     with rio.open(in_fn) as src:
         ndv=src.nodata
@@ -207,13 +210,25 @@ def compute(gain, toa_rad_coeff, offset, esd, Esun, sunang, in_fn, window):
         TOA_arr=toa_refl(gain, data, toa_rad_coeff, offset, esd, Esun, sunang)
         TOA_arr[data==ndv] = ndv
     return TOA_arr
+
+def compute_f32(scale, bias, in_fn, window):
+    """compute with the folded float32 kernel from wv_TOA_refl"""
+    with rio.open(in_fn) as src:
+        data=src.read(window=window)
+        TOA_arr=calc_toa_f32(data, scale, bias, src.nodata)
+    return TOA_arr
     
 
 import concurrent.futures
 from itertools import islice
+from multiprocessing import shared_memory
+from window_sched import run_windows
 
 CHUNK = 100
 
+# Windows handed to a process worker per task
+BATCH = 16
+
 def chunkify(iterable, chunk=CHUNK):
     it = iter(iterable)
     while True:
@@ -223,38 +238,129 @@ def chunkify(iterable, chunk=CHUNK):
         else:
             return
 
-def main(infile, gain, toa_rad_coeff, offset, esd, Esun, sunang, outfile, max_workers=2):
+# Per-process state for the process backend, filled in by init_worker
+_worker = {}
+
+def init_worker(in_fn, coeffs, f32=False):
+    """Process pool initializer: open the input once and keep it for every batch
+    """
+    _worker['src'] = rio.open(in_fn)
+    _worker['coeffs'] = coeffs
+    _worker['folded'] = fold_coeffs(*coeffs) if f32 else None
+    _worker['shm'] = {}
+
+def compute_batch(shm_name, windows, slot_px):
+    """Convert a batch of windows in a worker process.
+    Results are written as float32 into the shared memory block shm_name, window i
+    starting at element i*slot_px, so only the window list goes back through pickle.
+    """
+    src = _worker['src']
+    shm = _worker['shm'].get(shm_name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker['shm'][shm_name] = shm
+    ndv = src.nodata
+    gain, toa_rad_coeff, offset, esd, Esun, sunang = _worker['coeffs']
+    for i, window in enumerate(windows):
+        data = src.read(1, window=window)
+        out = np.ndarray(data.shape, dtype=np.float32, buffer=shm.buf, offset=i * slot_px * 4)
+        if _worker['folded'] is not None:
+            calc_toa_f32(data, *_worker['folded'], ndv=ndv, out=out)
+        else:
+            TOA_arr = toa_refl(gain, data, toa_rad_coeff, offset, esd, Esun, sunang)
+            TOA_arr[data==ndv] = ndv
+            out[...] = TOA_arr
+        del out
+    return shm_name, windows
+
+def run_threads(dst, infile, coeffs, windows, max_workers, max_in_flight=None, ordered=False, f32=False, encode=None):
+    gain, toa_rad_coeff, offset, esd, Esun, sunang = coeffs
+    scale, bias = fold_coeffs(*coeffs)
+    if max_in_flight is None:
+        max_in_flight = 4 * max_workers
+
+    def write(window, result):
+        if encode is not None:
+            result = encode(result)
+        dst.write(result, window=window)
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        with rio.open(infile) as src:
-            profile=src.profile
-            with rio.Env():
-                # And then change the band count to 1, set the
-                # dtype to float 32, and specify LZW compression.
-                profile.update(
-                    dtype=rio.float32,
-                    count=1,
-                    compress='lzw',
-                    interleave='band',
-                    tiled=True,
-                    blockxsize=512,
-                    blockysize=512,
-                )
-
-            with rio.open(outfile, "w", **profile) as dst:
-                windows = [window for ij, window in dst.block_windows()]
-                
-                for chunk in [windows]:  # chunkify(windows):
-                    future_to_window = dict()
-                    
-                    for window in chunk:
-                        future = executor.submit(compute, gain, toa_rad_coeff, offset, esd, Esun, sunang, infile, window)
-                        future_to_window[future] = window
-                        
-                    for future in concurrent.futures.as_completed(future_to_window):
-                        window = future_to_window[future]
-                        result = future.result()
-                        dst.write(result, window=window)        
+        if f32:
+            submit = lambda window: executor.submit(compute_f32, scale, bias, infile, window)
+        else:
+            submit = lambda window: executor.submit(compute, gain, toa_rad_coeff, offset, esd, Esun, sunang, infile, window)
+        run_windows(submit, windows, write, max_in_flight, ordered)
+
+def run_processes(dst, infile, coeffs, windows, max_workers, batch=BATCH, max_in_flight=None, ordered=False, f32=False,
+                  encode=None):
+    # One shared memory slot per in-flight batch, each big enough for batch full blocks
+    if max_in_flight is None:
+        n_slots = 2 * max_workers
+    else:
+        n_slots = max(1, max_in_flight // batch)
+    bh, bw = dst.block_shapes[0]
+    slot_px = bh * bw
+    slots = dict()
+    for i in range(n_slots):
+        slot = shared_memory.SharedMemory(create=True, size=batch * slot_px * 4)
+        slots[slot.name] = slot
+    free = list(slots)
+
+    def write(piece, result):
+        shm_name, piece = result
+        slot = slots[shm_name]
+        for i, window in enumerate(piece):
+            shape = (int(window.height), int(window.width))
+            arr = np.ndarray(shape, dtype=np.float32, buffer=slot.buf, offset=i * slot_px * 4)
+            dst.write(arr if encode is None else encode(arr), 1, window=window)
+            del arr
+        free.append(shm_name)
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                    initializer=init_worker,
+                                                    initargs=(infile, coeffs, f32)) as executor:
+            submit = lambda piece: executor.submit(compute_batch, free.pop(), piece, slot_px)
+            run_windows(submit, chunkify(windows, batch), write, n_slots, ordered)
+    finally:
+        for slot in slots.values():
+            slot.close()
+            slot.unlink()
+
+def main(infile, gain, toa_rad_coeff, offset, esd, Esun, sunang, outfile, max_workers=2, backend='thread', batch=BATCH,
+         max_in_flight=None, ordered=False, f32=False, int16=False, out_opts=None, cog=False):
+    coeffs = (gain, toa_rad_coeff, offset, esd, Esun, sunang)
+
+    with rio.open(infile) as src:
+        profile=src.profile
+        with rio.Env():
+            # And then change the band count to 1, set the
+            # dtype to float 32, and specify LZW (or out_opts) compression.
+            profile.update(
+                dtype=rio.float32,
+                count=1,
+                interleave='band',
+                tiled=True,
+                blockxsize=512,
+                blockysize=512,
+            )
+        # Workers always return float32 reflectance; int16 scaling happens as blocks are written
+        encode = None
+        if int16:
+            int16_profile(profile)
+            ndv = src.nodata
+            encode = lambda arr: to_int16(arr, ndv)
+        out_profile.update_profile(profile, **(out_opts or {}))
+
+        with open_raster(outfile, profile, cog) as dst:
+            if int16:
+                set_scales(dst)
+            windows = (window for ij, window in dst.block_windows())
+
+            if backend == 'process':
+                run_processes(dst, infile, coeffs, windows, max_workers, batch, max_in_flight, ordered, f32, encode)
+            else:
+                run_threads(dst, infile, coeffs, windows, max_workers, max_in_flight, ordered, f32, encode)
 
 def get_parser():
     parser = argparse.ArgumentParser(description='GeoTiff WorldView Multispectral Image to TOA Reflection Image Conversion Script')
@@ -262,6 +368,14 @@ def get_parser():
     parser.add_argument('-in_band', '--input_band', help='GeoTiff multi band', required=True)
     parser.add_argument('-in_x', '--input_xml', help='GeoTiff multi band xml file', required=True)
     parser.add_argument('-out', '--output_file', help='Where TOA reflectance image is to be saved', required=True)
+    parser.add_argument('-n', '--number', help='Number of workers, default is 2', type=int, default=2)
+    parser.add_argument('-backend', '--backend', help='Execution backend, default is thread', choices=['thread', 'process'], default='thread')
+    parser.add_argument('-batch', '--batch', help='Windows per process worker task, default is %d' % BATCH, type=int, default=BATCH)
+    parser.add_argument('-inflight', '--max_in_flight', help='Windows submitted but not yet written, default is 4 per thread or 2 batches per process', type=int)
+    parser.add_argument('-ordered', '--ordered', help='Write blocks in raster order', action='store_true')
+    parser.add_argument('-f32', '--f32', help='Use the float32 folded TOA kernel (differences ~1e-7)', action='store_true')
+    parser.add_argument('-int16', '--int16', help='Write reflectance x 10000 as int16 with scale metadata instead of float32', action='store_true')
+    out_profile.add_args(parser)
     return parser       
                         
 if __name__ == "__main__":
@@ -273,17 +387,9 @@ if __name__ == "__main__":
     xml_fn = args.input_xml
     out_fn = args.output_file
 
-    sat = getTag(xml_fn, 'SATID')
-    band = in_band.upper()
-    key = '%s_BAND_%s' % (sat, band)
-    Esun = EsunDict[key]
-    gain = GainDict[key]
-    offset = OffsetDict[key]
-    msunel = float(getTag(xml_fn, 'MEANSUNEL'))
-    sunang = 90.0 - msunel
-    dt = xml_dt(xml_fn)
-    esd = calcEarthSunDist(dt)
-
-    toa_rad_coeff = toa_rad(xml_fn, band)
+    gain, toa_rad_coeff, offset, esd, Esun, sunang = toa_coeffs(xml_fn, in_band)
     
-    main(in_fn, gain, toa_rad_coeff, offset, esd, Esun, sunang, out_fn)
+    main(in_fn, gain, toa_rad_coeff, offset, esd, Esun, sunang, out_fn,
+         max_workers=args.number, backend=args.backend, batch=args.batch,
+         max_in_flight=args.max_in_flight, ordered=args.ordered, f32=args.f32, int16=args.int16,
+         out_opts=out_profile.from_args(args), cog=args.cog)